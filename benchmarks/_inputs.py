@@ -0,0 +1,104 @@
+'''
+Generated inputs of the benchmark suite.
+
+The inputs are the stamps of a synthetic field (see
+:mod:`scubes.utilities.synthetic`), written with the same names and
+headers of the S-PLUS Cloud stamps, so :class:`scubes.core.SCubes`
+builds the cube without any download. The stamps and the cube of each size are created
+only once and kept at :data:`INPUTS_DIR`.
+'''
+from os.path import join, isfile, expanduser
+
+INPUTS_DIR = join('~', '.cache', 'scubes', 'benchmarks')
+TILE = 'SPLUS-bench'
+GALAXY = 'BENCH'
+RA, DEC = 150.0, -5.0
+SEED = 42
+
+def inputs_dir(size):
+    '''
+    Working directory (``--work_dir``) of the inputs of `size`.
+    '''
+    return join(expanduser(INPUTS_DIR), f'{size}')
+
+def synthetic_field(size):
+    '''
+    :class:`scubes.utilities.synthetic.synthetic_field` of the stamps of
+    `size`.
+    '''
+    from scubes.utilities.synthetic import synthetic_field
+
+    return synthetic_field(RA, DEC, size, seed=SEED + size)
+
+def scubes_args(size, *extra):
+    '''
+    :class:`scubes.core.SCubes` arguments of the inputs of `size`.
+    '''
+    from scubes.utilities.args import create_parser
+    from scubes.entry_points import SCUBES_ARGS, scubes_argparse
+
+    argv = ['-r', '-w', inputs_dir(size), '-l', f'{size}', '--data_source', 'mock', *extra, '--', TILE, f'{RA}', f'{DEC}', GALAXY]
+    return scubes_argparse(create_parser(args_dict=SCUBES_ARGS).parse_args(argv))
+
+def make_stamps(size):
+    '''
+    Write the 12-band stamps (and weights) of `size`, if needed.
+
+    Returns
+    -------
+    str
+        Output directory of the stamps.
+    '''
+    output_dir = join(inputs_dir(size), GALAXY)
+    synthetic_field(size).write_stamps(output_dir, GALAXY, tile=TILE)
+    return output_dir
+
+def load_scubes(size, *extra):
+    '''
+    :class:`scubes.core.SCubes` object with the stamps of `size` read
+    (i.e. ready for :meth:`scubes.core.SCubes.spectra`).
+    '''
+    from scubes.core import SCubes
+
+    make_stamps(size)
+    scubes = SCubes(scubes_args(size, *extra))
+    scubes.get_stamps()
+    scubes.calibrate_stamps()
+    return scubes
+
+def make_cube(size):
+    '''
+    Create the cube of `size`, if needed.
+
+    Returns
+    -------
+    str
+        Path to the cube.
+    '''
+    cube_path = join(inputs_dir(size), GALAXY, f'{GALAXY}_cube.fits')
+    if not isfile(cube_path):
+        load_scubes(size).create_cube(download=False)
+    return cube_path
+
+def available_memory():
+    '''
+    Available memory in bytes (None if unknown).
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+def skip_if_no_memory(size, n_copies):
+    '''
+    Skip a benchmark (asv convention: :exc:`NotImplementedError` raised by
+    ``setup``) that keeps about `n_copies` 12-band float64 cubes of `size`
+    in memory if they do not fit in the available memory.
+    '''
+    mem = available_memory()
+    if (mem is not None) and (n_copies*12*8*size**2 > mem):
+        raise NotImplementedError(f'{size}: not enough memory')
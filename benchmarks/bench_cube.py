@@ -0,0 +1,169 @@
+'''
+Benchmarks of the cube build and analysis hot paths.
+
+The classes follow the `asv <https://asv.readthedocs.io>`_ conventions
+(``setup``, ``teardown``, ``params`` and ``time_*`` methods), so they run
+with ``asv run`` or with ``python benchmarks/run.py``, which needs no
+extra dependency and keeps a JSON lines history of the results. All the
+inputs are generated (see :mod:`benchmarks._inputs`), no S-PLUS Cloud
+access is needed.
+'''
+import numpy as np
+from os import chdir, getcwd
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from ._inputs import load_scubes, make_cube, synthetic_field, skip_if_no_memory
+
+# stamp sizes in pixels
+SIZES = [200, 1000, 2000, 4000]
+
+class _tmp_output:
+    def _mkdtemp(self):
+        self.tmp_dir = mkdtemp(prefix='scubes-bench-')
+
+    def teardown(self, size):
+        rmtree(self.tmp_dir, ignore_errors=True)
+
+class cube_build(_tmp_output):
+    '''
+    :class:`scubes.core.SCubes` spectra calculation and cube writing, from
+    stamps already read (the download is not timed).
+    '''
+    params = SIZES
+    param_names = ['size']
+    timeout = 1200
+
+    def setup(self, size):
+        skip_if_no_memory(size, 6)
+        self._mkdtemp()
+        self.scubes = load_scubes(size)
+        self.scubes.control.output_dir = self.tmp_dir
+        self.scubes_streaming = load_scubes(size, '--streaming')
+        self.scubes_streaming.control.output_dir = self.tmp_dir
+
+    def time_spectra(self, size):
+        self.scubes.spectra()
+
+    def time_create_cube(self, size):
+        self.scubes.create_cube(download=False)
+
+    def time_create_cube_streaming(self, size):
+        self.scubes_streaming.create_cube(download=False)
+
+class cube_read:
+    '''
+    :class:`scubes.utilities.readscube.read_scube` and the analysis
+    functions used by the masks and plots.
+    '''
+    params = SIZES
+    param_names = ['size']
+    timeout = 1200
+
+    def setup(self, size):
+        from scubes.utilities.readscube import read_scube
+
+        skip_if_no_memory(size, 5)
+        self.cube_path = make_cube(size)
+        self.scube = read_scube(self.cube_path)
+        self.bin_r = np.arange(0, size/2, 5)
+
+    def time_read_scube(self, size):
+        from scubes.utilities.readscube import read_scube
+
+        read_scube(self.cube_path)
+
+    def time_mag_values(self, size):
+        self.scube._mag_values()
+
+    def time_get_iso_sky(self, size):
+        self.scube.get_iso_sky()
+
+    def time_radial_profile(self, size):
+        from scubes.utilities.readscube import radial_profile
+
+        scube = self.scube
+        radial_profile(scube.flux__lyx, self.bin_r, scube.x0, scube.y0)
+
+    def time_make_RGB_tom(self, size):
+        from scubes.utilities.readscube import make_RGB_tom
+
+        make_RGB_tom(self.scube.flux__lyx)
+
+class masks(_tmp_output):
+    '''
+    :meth:`scubes.utilities.masks.masks_builder.mask_procedure` as run by
+    ``scube_mask --no_interact`` (including the plots).
+    '''
+    params = SIZES
+    param_names = ['size']
+    timeout = 1800
+
+    def setup(self, size):
+        import matplotlib
+        matplotlib.use('Agg')
+
+        from scubes.utilities.args import create_parser
+        from scubes.utilities.utils import SCUBE_MASK_ARGS
+        from scubes.utilities.readscube import read_scube
+
+        skip_if_no_memory(size, 8)
+        cube_path = make_cube(size)
+        self.args = create_parser(args_dict=SCUBE_MASK_ARGS).parse_args(['-N', cube_path])
+        self.scube = read_scube(cube_path)
+        # mask_procedure writes its outputs to the current directory
+        self._mkdtemp()
+        self.cwd = getcwd()
+        chdir(self.tmp_dir)
+
+    def teardown(self, size):
+        chdir(self.cwd)
+        super().teardown(size)
+
+    def time_mask_procedure(self, size):
+        from scubes.utilities.masks import masks_builder
+
+        masks_builder(self.scube, self.args).mask_procedure()
+
+class psf:
+    '''
+    :func:`scubes.utilities.psf.calc_PSF_scube` on all the stars of the
+    cube (about one each 200x200 pixels).
+    '''
+    params = SIZES
+    param_names = ['size']
+    timeout = 1800
+
+    def setup(self, size):
+        from scubes.utilities.readscube import read_scube
+
+        skip_if_no_memory(size, 5)
+        self.flux__lyx = read_scube(make_cube(size)).flux__lyx
+        stars = synthetic_field(size).stars
+        self.centers_xy = np.transpose([stars['x'], stars['y']])
+
+    def time_calc_PSF_scube(self, size):
+        from scubes.utilities.psf import calc_PSF_scube
+
+        calc_PSF_scube(self.flux__lyx, self.centers_xy)
+
+class stats:
+    '''
+    :func:`scubes.utilities.stats.robustStat` on the pixels of a band.
+    '''
+    params = SIZES
+    param_names = ['size']
+    timeout = 1200
+
+    def setup(self, size):
+        from scubes.utilities.readscube import read_scube
+
+        skip_if_no_memory(size, 5)
+        scube = read_scube(make_cube(size))
+        # band 7: rSDSS
+        self.arr = scube.flux__lyx[7].ravel()
+
+    def time_robustStat(self, size):
+        from scubes.utilities.stats import robustStat
+
+        robustStat(self.arr)
@@ -0,0 +1,83 @@
+'''
+Import-time regression check of the S-CUBES entry-point modules.
+
+Each module is imported in a new interpreter with ``python -X importtime``.
+The check fails (exit status 1) if the cumulative import time of a module
+is over its budget or if it imports any of the heavy optional packages
+(plotting, photutils, regions, sewpy, splusdata and pandas), which must
+only be imported by the functions that use them.
+
+Usage:
+
+    python benchmarks/import_time.py [-s SCALE] [-j OUTPUT.json]
+'''
+import re
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+
+HEAVY_MODULES = ['matplotlib', 'photutils', 'regions', 'sewpy', 'splusdata', 'pandas']
+
+# module: (entry points using it, budget in seconds)
+# The budgets are ~1.5x the measured import times (0.21, 0.65 and 0.79 s),
+# so the check only fails on real regressions, not on timing noise.
+IMPORT_BUDGETS = {
+    'scubes.entry_points': (['scubes', 'scubesml', 'scubesml_batch', 'scubes_filters'], 0.35),
+    'scubes.utilities.utils': (['ml2header', 'scube_mask', 'splots', 'get_lupton_RGB', 'scube_sex_mask_stars', 'scubes_mock_cloud'], 1.0),
+    'scubes.core': (['scubes (cube creation)'], 1.2),
+}
+
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+def import_time(module):
+    '''
+    Import `module` in a new interpreter with ``-X importtime``.
+
+    Returns
+    -------
+    tuple
+        Cumulative import time of `module` in seconds and the set of all
+        imported modules.
+    '''
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+    if p.returncode:
+        raise RuntimeError(f'{module}: import failed\n{p.stderr}')
+    cumulative, imported = None, set()
+    for line in p.stderr.splitlines():
+        m = _IMPORTTIME_LINE.match(line)
+        if m is None:
+            continue
+        name = m.group(4)
+        imported.add(name)
+        if name == module:
+            cumulative = int(m.group(2))*1e-6
+    return cumulative, imported
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-s', '--scale', type=float, default=1, help='Multiply the time budgets (e.g. on slow machines).')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='Imports of each module (the fastest is used).')
+    parser.add_argument('-j', '--json', default=None, help='Write the results to a JSON file.')
+    args = parser.parse_args()
+
+    failed = False
+    results = {}
+    for module, (entry_points, budget) in IMPORT_BUDGETS.items():
+        runs = [import_time(module) for _ in range(args.repeat)]
+        t = min(_[0] for _ in runs)
+        heavy = sorted(m for m in runs[0][1] if m.split('.')[0] in HEAVY_MODULES and '.' not in m)
+        ok = (t <= budget*args.scale) and not heavy
+        failed |= not ok
+        results[module] = dict(entry_points=entry_points, time=t, budget=budget*args.scale, heavy=heavy, ok=ok)
+        msg = f'{"OK  " if ok else "FAIL"} {module:24s} {t:6.3f} s (budget {budget*args.scale:.3f} s)'
+        if heavy:
+            msg += f' - imports {", ".join(heavy)}'
+        print(msg)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
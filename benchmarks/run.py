@@ -0,0 +1,217 @@
+'''
+Run the S-CUBES benchmark suite and keep a history of the results.
+
+Runs the ``time_*`` methods of the asv-style benchmark classes of the
+``benchmarks/bench_*.py`` modules for each parameter (stamp size) and
+appends a record with the timings, the package version, the git commit and
+the machine to a JSON lines history file. With ``--compare`` the results
+are compared with a previous record of the same machine and the run fails
+(exit status 1) if any benchmark is slower than the ``--threshold``.
+
+Usage:
+
+    python benchmarks/run.py [-b REGEX] [-s SIZE ...] [-r REPEAT] [--compare [REF]]
+'''
+import re
+import sys
+import json
+import platform
+import importlib
+import subprocess
+from glob import glob
+from os import makedirs, devnull
+from time import perf_counter
+from datetime import datetime
+from contextlib import redirect_stdout
+from statistics import median
+from argparse import ArgumentParser
+from os.path import join, dirname, abspath, basename, isfile
+
+ROOT = dirname(dirname(abspath(__file__)))
+HISTORY_FILE = join(ROOT, 'benchmarks', 'results', 'history.jsonl')
+
+def _git_commit():
+    try:
+        p = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+    except OSError:
+        return None
+    return p.stdout.strip() if p.returncode == 0 else None
+
+def environment():
+    '''
+    Description of the benchmarked code and machine.
+
+    Returns
+    -------
+    dict
+        Package version, git commit, machine and the versions of python
+        and of the main dependencies.
+    '''
+    import numpy
+    import astropy
+    import scubes
+
+    return dict(
+        version=scubes.__version__, commit=_git_commit(),
+        machine=platform.node(), cpu=platform.processor() or platform.machine(),
+        python=platform.python_version(), numpy=numpy.__version__, astropy=astropy.__version__,
+    )
+
+def discover(pattern=None):
+    '''
+    Benchmarks of the ``bench_*.py`` modules.
+
+    Parameters
+    ----------
+    pattern : str, optional
+        Regular expression. Only the benchmarks with names (e.g.
+        ``bench_cube.cube_build.time_spectra``) matching it are returned.
+
+    Returns
+    -------
+    list of tuple
+        Name, class and method name of each benchmark.
+    '''
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    benchmarks = []
+    for filename in sorted(glob(join(ROOT, 'benchmarks', 'bench_*.py'))):
+        modname = basename(filename)[:-3]
+        module = importlib.import_module(f'benchmarks.{modname}')
+        for clsname, cls in vars(module).items():
+            if not isinstance(cls, type) or clsname.startswith('_') or cls.__module__ != module.__name__:
+                continue
+            for meth in sorted(vars(cls)):
+                name = f'{modname}.{clsname}.{meth}'
+                if meth.startswith('time_') and ((pattern is None) or re.search(pattern, name)):
+                    benchmarks.append((name, cls, meth))
+    return benchmarks
+
+def run_benchmark(cls, meth, param, repeat=3):
+    '''
+    Run ``cls().meth(param)`` `repeat` times, calling ``setup`` once
+    before and ``teardown`` once after the runs. An untimed run is done
+    first (e.g. the stamps are decompressed at their first access). The
+    output of the benchmarked code is discarded.
+
+    Returns
+    -------
+    dict or None
+        Minimum and median times in seconds, or None if the benchmark was
+        skipped (``setup`` raised :exc:`NotImplementedError`).
+    '''
+    bench = cls()
+    with open(devnull, 'w') as null, redirect_stdout(null):
+        try:
+            if hasattr(bench, 'setup'):
+                bench.setup(param)
+        except NotImplementedError:
+            return None
+        try:
+            func = getattr(bench, meth)
+            func(param)
+            times = []
+            for _ in range(repeat):
+                t0 = perf_counter()
+                func(param)
+                times.append(perf_counter() - t0)
+        finally:
+            if hasattr(bench, 'teardown'):
+                bench.teardown(param)
+    return dict(min=min(times), median=median(times), repeat=repeat)
+
+def read_history(filename=HISTORY_FILE):
+    '''
+    Records of the history file (oldest first).
+    '''
+    if not isfile(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _common(results, reference):
+    return any(
+        (r is not None) and (reference.get(name, {}).get(param, None) is not None)
+        for name, by_param in results.items() for param, r in by_param.items()
+    )
+
+def reference_record(history, env, results, ref=None):
+    '''
+    Last record of the machine of `env` matching `ref` (a version or the
+    start of a git commit hash) with any of the benchmarks of `results`. 
+    If `ref` is None, any version or commit is accepted.
+    '''
+    for rec in reversed(history):
+        if rec['env']['machine'] != env['machine']:
+            continue
+        if (ref is not None) and (rec['env']['version'] != ref) and not (rec['env']['commit'] or '').startswith(ref):
+            continue
+        if _common(results, rec['results']):
+            return rec
+    return None
+
+def compare(results, reference, threshold=0.2):
+    '''
+    Compare the minimum times of `results` with the `reference` results.
+
+    Returns
+    -------
+    list of tuple
+        Benchmark name, parameter and ratio (new/reference) of the
+        benchmarks slower than ``1 + threshold`` times the reference.
+    '''
+    regressions = []
+    print(f'{"benchmark":52s} {"size":>5s} {"ref (s)":>9s} {"new (s)":>9s} {"ratio":>6s}')
+    for name, by_param in results.items():
+        for param, r in by_param.items():
+            r0 = reference.get(name, {}).get(param, None)
+            if (r is None) or (r0 is None):
+                continue
+            ratio = r['min']/r0['min']
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = ' REGRESSION'
+                regressions.append((name, param, ratio))
+            print(f'{name:52s} {param:>5s} {r0["min"]:9.4f} {r["min"]:9.4f} {ratio:6.2f}{flag}')
+    return regressions
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-b', '--bench', default=None, help='Run only the benchmarks matching this regular expression.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=None, help='Stamp sizes (default: the params of each benchmark).')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of each benchmark (the fastest is compared).')
+    parser.add_argument('-o', '--history', default=HISTORY_FILE, help='History file (JSON lines).')
+    parser.add_argument('--no_save', action='store_true', default=False, help='Do not append the results to the history.')
+    parser.add_argument('--compare', nargs='?', const='', default=None, metavar='REF', help='Compare with the last record of this machine (or of the version or commit REF).')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative slowdown reported as regression.')
+    args = parser.parse_args()
+
+    env = environment()
+    history = read_history(args.history)
+    results = {}
+    for name, cls, meth in discover(args.bench):
+        results[name] = {}
+        for param in (getattr(cls, 'params', [None]) if args.sizes is None else args.sizes):
+            r = run_benchmark(cls, meth, param, repeat=args.repeat)
+            results[name][f'{param}'] = r
+            msg = 'skipped' if r is None else f'{r["min"]:9.4f} s (median {r["median"]:.4f} s)'
+            print(f'{name:52s} {param!s:>5s} {msg}', flush=True)
+
+    record = dict(date=datetime.now().isoformat(timespec='seconds'), env=env, results=results)
+    if not args.no_save:
+        makedirs(dirname(args.history), exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    if args.compare is not None:
+        ref = reference_record(history, env, results, ref=args.compare or None)
+        if ref is None:
+            print(f'{args.compare or env["machine"]}: no reference record in {args.history}')
+            sys.exit(1)
+        print(f'\nreference: {ref["date"]} {ref["env"]["version"]} {ref["env"]["commit"]}')
+        regressions = compare(results, ref['results'], threshold=args.threshold)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Startup time of the S-CUBES entry-point scripts.
+
+Each entry point is run with ``--help`` in a new Python process, which
+measures the imports, the package data loading and the argument parser
+creation, i.e. the overhead paid by every call of the scripts (e.g. on
+the shell loops of ``scripts/run_scubes_ml.sh``).
+
+Usage:
+
+    python benchmarks/startup.py [-n REPEAT] [-e ENTRY_POINT ...] [-j OUTPUT.json]
+'''
+import sys
+import json
+import subprocess
+from time import perf_counter
+from statistics import median
+from argparse import ArgumentParser
+from importlib.metadata import distribution
+
+_RUN_ENTRY_POINT = '''
+import sys
+from {module} import {func} as main
+sys.argv = ['{name}', '--help']
+try:
+    main()
+except SystemExit:
+    pass
+'''
+
+def scubes_entry_points():
+    '''
+    Console scripts of the installed s-cubes distribution.
+
+    Returns
+    -------
+    dict
+        Script name to ``module:function``.
+    '''
+    eps = distribution('s-cubes').entry_points
+    return {ep.name: ep.value for ep in eps if ep.group == 'console_scripts'}
+
+def entry_point_times(name, value, repeat=5):
+    '''
+    Wall-clock time of ``name --help`` in a new interpreter.
+
+    Returns
+    -------
+    list of float
+        Time in seconds of each run.
+    '''
+    module, func = value.split(':')
+    code = _RUN_ENTRY_POINT.format(module=module, func=func, name=name)
+    times = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(perf_counter() - t0)
+    return times
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Runs of each entry point.')
+    parser.add_argument('-e', '--entry_points', nargs='+', default=None, help='Entry points to run (default: all).')
+    parser.add_argument('-j', '--json', default=None, help='Write the results to a JSON file.')
+    args = parser.parse_args()
+
+    eps = scubes_entry_points()
+    names = sorted(eps) if args.entry_points is None else args.entry_points
+    # python startup alone, as a baseline
+    t_python = entry_point_times('python', 'sys:exit', repeat=args.repeat)
+    results = {'python': dict(min=min(t_python), median=median(t_python))}
+    print(f'{"entry point":24s} {"min (s)":>8s} {"median (s)":>10s}')
+    print(f'{"python (baseline)":24s} {min(t_python):8.3f} {median(t_python):10.3f}')
+    for name in names:
+        t = entry_point_times(name, eps[name], repeat=args.repeat)
+        results[name] = dict(min=min(t), median=median(t))
+        print(f'{name:24s} {min(t):8.3f} {median(t):10.3f}')
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,5 @@
 import os
 
-from astropy.io import ascii
 from importlib.metadata import version, metadata
 
 from . import data
@@ -17,4 +16,13 @@ __dr5_jyp_zpcorr_path__ = os.path.join(data.__path__[0], 'zpcorr_iDR5', 'jype')
 
 __dr5_zpcorr__ = {'mar': __dr5_mar_zpcorr_path__, 'jype': __dr5_jyp_zpcorr_path__}
 
-__filters_table__ = ascii.read(os.path.join(data.__path__[0], 'central_wavelengths.csv'))
\ No newline at end of file
+__filters_table_file__ = os.path.join(data.__path__[0], 'central_wavelengths.csv')
+
+def __getattr__(name):
+    # The filters table is only read at the first access
+    if name == '__filters_table__':
+        from .utilities.datatables import read_data_table
+
+        globals()[name] = read_data_table(__filters_table_file__)
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
\ No newline at end of file
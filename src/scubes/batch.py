@@ -0,0 +1,459 @@
+import subprocess
+from time import time
+from queue import Queue
+from os.path import join, abspath
+from threading import Thread, Lock
+from dataclasses import dataclass, field
+
+from .utilities.io import print_level
+from .utilities.jobqueue import job_queue
+from .utilities.manifest import job_manifest
+from .utilities.buildgraph import build_graph
+from .utilities.telemetry import download_stats
+from .utilities.ratelimit import limiter_from_args
+
+_DONE = object()
+
+# control attributes that change the cube (see the ``cube`` stage of scubesml_batch._graph)
+_CUBE_PARAMS = [
+    'tile', 'ra', 'dec', 'size', 'bands', 'data_release', 'zpcorr', 'store_zp', 'cube_format', 
+    'noise_quantization', 'cube_container', 'hdf5_chunks', 'hdf5_compression',
+]
+
+@dataclass
+class _galaxy_result:
+    '''
+    A data class representing the result of a galaxy build in a batch run.
+
+    Attributes
+    ----------
+    galaxy : str
+        Galaxy's masterlist nickname.
+
+    status : str
+        ``done``, ``skipped`` or ``failed``.
+
+    cube_path : str
+        Path to the created cube.
+
+    error : str
+        Failure reason.
+
+    times : dict
+        Wall-clock time (in seconds) of each stage.
+
+    stages : dict
+        ``done`` or ``skipped`` for each stage after the cube (see
+        :meth:`scubesml_batch._graph`).
+    '''
+    galaxy: str
+    status: str = 'failed'
+    cube_path: str = None
+    error: str = None
+    times: dict = field(default_factory=dict)
+    stages: dict = field(default_factory=dict)
+
+def _error_msg(e):
+    if isinstance(e, SystemExit):
+        return f'exited with status {e.code}'
+    return f'{type(e).__name__}: {e}'
+
+class scubesml_batch:
+    '''
+    Build the cubes of a list of galaxies from a masterlist in a single
+    process.
+
+    The masterlist is read once and the data source connection (e.g. the
+    S-PLUS Cloud login) is shared by all galaxies. The stamps of the next
+    galaxies are downloaded by `download_threads` producer threads while
+    the main thread calibrates, computes the spectra and writes the cube
+    of the current one. The producers are kept at most `prefetch` galaxies
+    ahead of the consumer by a bounded queue.
+
+    A failure on one galaxy (including the ``sys.exit`` calls from
+    :class:`scubes.core.SCubes`) is recorded and the batch goes on.
+
+    The products of each galaxy (cube, masterlist header and, optionally,
+    the ``splots`` images and the ``scube_mask`` masked cube) are stages
+    of a :class:`~scubes.utilities.buildgraph.build_graph` (see 
+    :meth:`_graph`). With ``--incremental`` only the stale stages are 
+    built, e.g. an existing cube is rebuilt if its stamps, zero-points 
+    table or parameters changed, and the plots are recreated if the cube
+    was rebuilt.
+
+    With ``--manifest`` the state of each stage of each galaxy is recorded
+    at a durable :class:`~scubes.utilities.manifest.job_manifest`. A 
+    batch interrupted by a crash is continued by the same command with 
+    ``--resume``: only the galaxies not finished (or failed) are processed,
+    from their first stale stage. ``--retry_failed`` processes only the 
+    failed galaxies.
+
+    With ``--queue_dir`` the galaxies are taken from a 
+    :class:`~scubes.utilities.jobqueue.job_queue` shared by independent
+    ``scubesml_batch`` workers (on one or several nodes with a shared 
+    filesystem) running the same masterlist: each galaxy is built by the 
+    worker which claimed it, the claims of a crashed worker are taken over
+    when their lease expires, and each worker holds at most 
+    ``--max_claims`` galaxies at the same time. The galaxies are built
+    incrementally, so a galaxy taken over from a crashed worker goes on
+    from its first stale stage. A worker whose claim was taken over (e.g.
+    it was stalled longer than the lease) skips the galaxy: it checks the
+    claim before each stage and before moving the written cube to its
+    path.
+
+    Parameters
+    ----------
+    args : :class:`argparse.Namespace`
+        Parsed command-line arguments (see :data:`scubes.entry_points.SCUBESML_ARGS`)
+        with the masterlist read at `args.ml`.
+
+    galaxies : list of str, optional
+        Galaxies to be built. Defaults to all the masterlist.
+
+    prefetch : int, optional
+        Maximum number of downloaded galaxies waiting to be processed.
+        Default is 2.
+
+    download_threads : int, optional
+        Number of galaxies downloaded simultaneously. Default is 1.
+
+    Attributes
+    ----------
+    results : list of :class:`_galaxy_result`
+        Results of the batch in the order the galaxies were processed.
+    '''
+    def __init__(self, args, galaxies=None, prefetch=2, download_threads=1):
+        self.args = args
+        self.galaxies = list(args.ml['SNAME']) if galaxies is None else list(galaxies)
+        self.prefetch = max(prefetch, 1)
+        self.download_threads = max(download_threads, 1)
+        self.verbose = args.verbose
+        self.incremental = getattr(args, 'incremental', False)
+        manifest = getattr(args, 'manifest', None)
+        self.manifest = None if manifest is None else job_manifest(manifest, verbose=self.verbose)
+        if getattr(args, 'resume', False) or getattr(args, 'retry_failed', False):
+            self._resume()
+        queue_dir = getattr(args, 'queue_dir', None)
+        self.queue = None
+        if queue_dir is not None:
+            self.queue = job_queue(
+                queue_dir, lease=getattr(args, 'lease', 600), 
+                max_claims=getattr(args, 'max_claims', None), verbose=self.verbose,
+            )
+            self.incremental = True
+        self.results = []
+        self._conn = None
+        self._conn_lock = Lock()
+        self.download_stats = download_stats()
+        # the concurrency and rate limits are shared by the downloads of all galaxies
+        self.limiter = limiter_from_args(args)
+
+    def _resume(self):
+        '''
+        Keep only the galaxies of the manifest which were not finished 
+        (``--resume``) or failed (``--retry_failed``). The stages of these
+        galaxies are built incrementally.
+        '''
+        if self.manifest is None:
+            raise ValueError('--resume and --retry_failed require --manifest')
+        states = self.manifest.states()
+        if getattr(self.args, 'retry_failed', False):
+            keep = lambda status: status == 'failed'
+        else:
+            keep = lambda status: status not in ['done', 'skipped']
+        n = len(self.galaxies)
+        self.galaxies = [g for g in self.galaxies if keep(self.manifest.galaxy_status(g, states=states))]
+        self.incremental = True
+        print_level(f'batch: resuming {len(self.galaxies)} of {n} galaxies from {self.manifest.filename}')
+
+    def _record(self, galaxy, stage, status, error=None):
+        if self.manifest is not None:
+            self.manifest.record(galaxy, stage, status, error=error)
+
+    @property
+    def conn(self):
+        '''
+        Data source connection shared by all the galaxies of the batch,
+        opened the first time a galaxy needs to download anything.
+        '''
+        with self._conn_lock:
+            if self._conn is None:
+                from .utilities.splusdata import connect_data_source
+
+                a = self.args
+                self._conn = connect_data_source(
+                    a.data_source, a.username, a.password,
+                    tiles_dir=a.tiles_dir, mock_url=a.mock_url, stats=self.download_stats, 
+                    token_cache=a.token_cache, max_connections=max(16, a.download_workers), 
+                    verbose=a.verbose,
+                )
+        return self._conn
+
+    def _new_scubes(self, galaxy):
+        from .core import SCubes
+        from .entry_points import ml_galaxy_args
+
+        scubes = SCubes(ml_galaxy_args(self.args, galaxy))
+        scubes._conn_factory = lambda: self.conn
+        # the batch statistics are exported after each galaxy download
+        scubes.download_stats = self.download_stats
+        scubes._limiter = self.limiter
+        if self.queue is not None:
+            # the cube is not written if the claim of the galaxy was lost
+            scubes._write_guard = lambda: self.queue.check(galaxy)
+        return scubes
+
+    def _graph(self, scubes):
+        '''
+        Build graph of the products of a galaxy, recorded at
+        ``GALAXY_build.json`` next to the cube. The stages are:
+
+        - ``cube``: built by :meth:`_download` and :meth:`_build`, depends
+          on the stamps, the zero-points table, the parameters of the cube 
+          (see :data:`_CUBE_PARAMS`) and the flux scale.
+        - ``ml2header``: masterlist information added to the cube, depends 
+          on the masterlist row of the galaxy.
+        - ``splots`` (``--splots``): images created by ``splots``.
+        - ``mask`` (``--mask_args``): masked cube created by ``scube_mask``,
+          depends on the content of the ``--mask_args`` file.
+
+        Returns
+        -------
+        :class:`~scubes.utilities.buildgraph.build_graph`
+            The build graph.
+        '''
+        from . import __dr4_zp_cat__, __dr5_zp_cat__
+        from .utilities.utils import ml2header_updheader
+
+        a = self.args
+        ctrl = scubes.control
+        galaxy = ctrl.galaxy
+        output_dir = ctrl.output_dir
+        cube_path = scubes._cube_path()
+        graph = build_graph(join(output_dir, f'{galaxy}_build.json'), verbose=self.verbose)
+
+        params = {k: getattr(ctrl, k, None) for k in _CUBE_PARAMS}
+        params['flam_scale'] = 1e-19
+        inputs = [scubes.stamp_filename(band, weight=w) for band in ctrl.bands for w in [False, True]]
+        zp_table = __dr5_zp_cat__ if '5' in ctrl.data_release else __dr4_zp_cat__
+        graph.add('cube', params=params, inputs=inputs + [zp_table], outputs=[cube_path])
+
+        row = a.ml[a.ml['SNAME'] == galaxy][0]
+        graph.add(
+            # the keys of an existing cube are only updated if the masterlist row changed
+            'ml2header', func=lambda: ml2header_updheader(cube_path, a.ml, force='cube' not in graph.rebuilt),
+            params={c: str(row[c]) for c in a.ml.colnames}, deps=['cube'],
+        )
+        if getattr(a, 'splots', False):
+            graph.add(
+                'splots', func=lambda: subprocess.run(['splots', abspath(cube_path)], cwd=output_dir, check=True),
+                deps=['ml2header'], outputs=[join(output_dir, f'{galaxy}_rings_spec.png')],
+            )
+        mask_args = getattr(a, 'mask_args', None)
+        if mask_args is not None:
+            argv = ['scube_mask', f'@{abspath(mask_args)}', '--no_interact', '--', abspath(cube_path)]
+            graph.add(
+                'mask', func=lambda: subprocess.run(argv, cwd=output_dir, check=True),
+                inputs=[abspath(mask_args)], deps=['ml2header'], outputs=[join(output_dir, f'{galaxy}.fits')],
+            )
+        return graph
+
+    def _download(self, galaxy):
+        '''
+        Producer stage: create the :class:`SCubes` object and download its
+        data. With ``--incremental``, an up-to-date cube is skipped and a 
+        stale cube is rebuilt.
+        '''
+        res = _galaxy_result(galaxy=galaxy)
+        scubes = None
+        graph = None
+        t0 = time()
+        try:
+            self._record(galaxy, 'galaxy', 'started')
+            scubes = self._new_scubes(galaxy)
+            graph = self._graph(scubes)
+            if self.incremental:
+                if not graph.stale('cube'):
+                    res.status = 'skipped'
+                    res.cube_path = scubes._cube_path()
+                    res.times['download'] = time() - t0
+                    self._record(galaxy, 'cube', 'skipped')
+                    return res, None, graph
+                scubes.control.redo = True
+            scubes.check_cube()
+            self._record(galaxy, 'download', 'started')
+            with scubes.timer.span('download'):
+                scubes.download_data()
+            self._record(galaxy, 'download', 'done')
+        except OSError as e:
+            if str(e) == 'Cube exists!':
+                res.status = 'skipped'
+                res.cube_path = scubes.cube_path
+                self._record(galaxy, 'cube', 'skipped')
+            else:
+                self._record(galaxy, 'download', 'failed', _error_msg(e))
+            res.error = _error_msg(e)
+            scubes = None
+        except (Exception, SystemExit) as e:
+            res.error = _error_msg(e)
+            self._record(galaxy, 'download', 'failed', res.error)
+            scubes = None
+        res.times['download'] = time() - t0
+        return res, scubes, graph
+
+    def _next(self, todo):
+        '''
+        Next galaxy to be downloaded: the next claimed galaxy of the job 
+        queue (``--queue_dir``) or of the `todo` queue.
+        '''
+        if self.queue is None:
+            return todo.get()
+        galaxy = self.queue.next(self.galaxies)
+        return _DONE if galaxy is None else galaxy
+
+    def _producer(self, todo, ready):
+        '''
+        Download thread: put the downloaded galaxies at the `ready` queue.
+        A galaxy raising an exception is put as failed and the thread
+        always ends with ``_DONE``, so :meth:`run` does not wait forever.
+        '''
+        try:
+            while True:
+                galaxy = self._next(todo)
+                if galaxy is _DONE:
+                    return
+                try:
+                    item = self._download(galaxy)
+                except Exception as e:
+                    item = (_galaxy_result(galaxy=galaxy, error=_error_msg(e)), None, None)
+                ready.put(item)
+        except Exception as e:
+            print_level(f'batch: download thread stopped: {_error_msg(e)}')
+        finally:
+            ready.put(_DONE)
+
+    def _build(self, res, scubes, graph):
+        '''
+        Consumer stage: calibrate, compute the spectra and write the cube,
+        then build the other products of the galaxy (see :meth:`_stages`).
+        '''
+        t0 = time()
+        self._record(res.galaxy, 'cube', 'started')
+        try:
+            if self.queue is not None:
+                self.queue.check(res.galaxy)
+            scubes.create_cube(flam_scale=None, download=False)
+            res.cube_path = scubes.cube_path
+            graph.record('cube')
+            self._record(res.galaxy, 'cube', 'done')
+            res.times['build'] = time() - t0
+            return self._stages(res, graph)
+        except (Exception, SystemExit) as e:
+            res.error = _error_msg(e)
+            self._record(res.galaxy, 'cube', 'failed', res.error)
+        res.times['build'] = time() - t0
+        return res
+
+    def _stages(self, res, graph):
+        '''
+        Build the stages of the galaxy after the cube (all of them, or only
+        the stale ones with ``--incremental``). A galaxy with a skipped cube
+        is ``done`` if any stage was built.
+        '''
+        t0 = time()
+        try:
+            def callback(stage, status, error):
+                if (status == 'started') and (self.queue is not None):
+                    self.queue.check(res.galaxy)
+                self._record(res.galaxy, stage, status, error)
+
+            res.stages = graph.run(force=not self.incremental, callback=callback)
+            if (res.status != 'skipped') or ('done' in res.stages.values()):
+                res.status = 'done'
+            res.error = None
+        except (Exception, SystemExit) as e:
+            res.status = 'failed'
+            res.error = _error_msg(e)
+        res.times['stages'] = time() - t0
+        return res
+
+    def run(self):
+        '''
+        Run the batch.
+
+        Returns
+        -------
+        list of :class:`_galaxy_result`
+            Results of the batch.
+        '''
+        todo = Queue()
+        ready = Queue(maxsize=self.prefetch)
+        if self.queue is None:
+            for galaxy in self.galaxies:
+                todo.put(galaxy)
+            for _ in range(self.download_threads):
+                todo.put(_DONE)
+        else:
+            self.queue.start_heartbeat()
+        producers = [Thread(target=self._producer, args=(todo, ready), daemon=True) for _ in range(self.download_threads)]
+        for p in producers:
+            p.start()
+        n_done = 0
+        while n_done < len(producers):
+            item = ready.get()
+            if item is _DONE:
+                n_done += 1
+                continue
+            res, scubes, graph = item
+            if scubes is not None:
+                res = self._build(res, scubes, graph)
+            elif self.incremental and (res.status == 'skipped'):
+                res = self._stages(res, graph)
+            if (self.queue is not None) and not self.queue.owns(res.galaxy):
+                # built (or being built) by the worker which took over the claim
+                res.status = 'skipped'
+                res.error = 'claim lost to another worker'
+            self.results.append(res)
+            self._record(res.galaxy, 'galaxy', res.status, res.error)
+            if self.queue is not None:
+                self.queue.release(res.galaxy, res.status, res.error)
+            msg = f'{res.galaxy}: {res.status}'
+            if res.error is not None:
+                msg += f' - {res.error}'
+            print_level(msg)
+        for p in producers:
+            p.join()
+        if self.queue is not None:
+            self.queue.stop()
+        if self.args.download_stats is not None:
+            self.download_stats.write(self.args.download_stats)
+        return self.results
+
+    def summary(self):
+        '''
+        Print the number of galaxies done, skipped and failed and the list
+        of failed galaxies.
+
+        Returns
+        -------
+        dict
+            Number of galaxies by status.
+        '''
+        count = {'done': 0, 'skipped': 0, 'failed': 0}
+        for r in self.results:
+            count[r.status] += 1
+        print_level(f'batch: {len(self.results)} galaxies: ' + ', '.join(f'{v} {k}' for k, v in count.items()))
+        if self.queue is not None:
+            qcount = self.queue.status(self.galaxies)
+            print_level(f'batch: queue {self.queue.queue_dir}: ' + ', '.join(f'{v} {k}' for k, v in qcount.items()))
+        dl = self.download_stats.summary()
+        if dl['requests']:
+            rate = '' if dl['throughput'] is None else f', {dl["throughput"]/2**20:.2f} MiB/s'
+            print_level(
+                f'batch: {dl["requests"]} downloads ({dl["failed"]} failed, {dl["retries"]} retries): '
+                f'{dl["bytes"]/2**20:.1f} MiB{rate}, latency p50 {dl["p50"]:.2f} s, p90 {dl["p90"]:.2f} s'
+            )
+        for r in self.results:
+            if r.status == 'failed':
+                print_level(f'batch: failed: {r.galaxy}: {r.error}')
+        return count
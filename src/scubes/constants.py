@@ -1,8 +1,7 @@
 from os.path import join
-from astropy.io import ascii
 from .utilities.sextractor import SEX_TOPHAT_FILTER, SEX_DEFAULT_STARNNW
 
-from . import __filters_table__, data
+from . import data
 
 
 # This dictionary links the original filter names to the ones recorded on the 
@@ -15,12 +14,6 @@ FILTER_NAMES_FITS = {
 
 FILTER_NAMES = {v: k for k, v in FILTER_NAMES_FITS.items()}
 
-FILTER_TRANSMITTANCE = {}
-for v in FILTER_NAMES.values():
-    FILTER_TRANSMITTANCE[v] = ascii.read(join(data.__path__[0], f'{v}.csv'))
-    FILTER_TRANSMITTANCE[v]['wavelength'] *= 10
-    FILTER_TRANSMITTANCE[v]['transmittance'] *= 100
-
 FILTER_NAMES_DR4_ZP_TABLE = {
     'F378': 'J0378', 
     'F395': 'J0395', 
@@ -47,11 +40,6 @@ FILTER_COLORS = {
     'Z': 'darkred',
 }
 
-BANDS = [FILTER_NAMES_FITS[x] for x in __filters_table__['filter']]
-
-# EFF is the same as the pivot
-CENTRAL_WAVE = {FILTER_NAMES_FITS[row['filter']]: row['pivot_wave'] for row in __filters_table__}
-
 METADATA_NAMES = {
     'filter': 'FILTER',
     'central_wave': 'CENTWAVE',
@@ -65,6 +53,7 @@ METADATA_NAMES = {
     'pivot_wave': 'PIVOTWAVE',
     'alambda_av': 'ALAMBDAAV',
     'psf_fwhm': 'PSFFWHM',
+    'magzp': 'MAGZP',
 }
 
 EXPTIMES = {
@@ -104,3 +93,39 @@ SPLUS_DEFAULT_SEXTRACTOR_PARAMS = [
 ]
 
 #iDR4_FORNAX_RUN_7_106_Fornax_SPLUS-s28s33.00025, HYDRA_FULL+SPLUS-n17s10.00020, SPLUS-n16s09.00003
+
+def _filter_transmittance():
+    from .utilities.datatables import read_data_table
+
+    filter_transmittance = {}
+    for v in FILTER_NAMES.values():
+        filter_transmittance[v] = read_data_table(join(data.__path__[0], f'{v}.csv'))
+        filter_transmittance[v]['wavelength'] *= 10
+        filter_transmittance[v]['transmittance'] *= 100
+    return filter_transmittance
+
+def _filters_array():
+    from . import __filters_table_file__
+    from .utilities.datatables import read_data_table
+
+    return read_data_table(__filters_table_file__, as_array=True)
+
+def _bands():
+    return [FILTER_NAMES_FITS[str(x)] for x in _filters_array()['filter']]
+
+def _central_wave():
+    # EFF is the same as the pivot
+    return {FILTER_NAMES_FITS[str(row['filter'])]: row['pivot_wave'] for row in _filters_array()}
+
+# Constants built from the package data tables, only read at the first access
+_LAZY_CONSTANTS = {
+    'FILTER_TRANSMITTANCE': _filter_transmittance,
+    'BANDS': _bands,
+    'CENTRAL_WAVE': _central_wave,
+}
+
+def __getattr__(name):
+    if name in _LAZY_CONSTANTS:
+        globals()[name] = _LAZY_CONSTANTS[name]()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
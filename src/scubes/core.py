@@ -1,30 +1,71 @@
 import sys
 import numpy as np
-import pandas as pd
 from PIL import Image
-from tqdm import tqdm
 import astropy.units as u
 from astropy.io import fits
 from astropy.wcs import WCS
-from os import remove, makedirs
-from astropy.table import Table
+from os import remove, makedirs, replace, getpid
+from astropy.table import Table, vstack
 from dataclasses import dataclass
 import astropy.constants as const
 from astropy.coordinates import SkyCoord
-from os.path import join, exists, isfile
-from scipy.interpolate import RectBivariateSpline
+from os.path import join, exists, isfile, basename
 
-from . import __filters_table__, __dr4_zp_cat__, __dr4_zpcorr_path__, \
-    __dr5_zp_cat__, __dr5_zpcorr__
+from . import __filters_table__, __dr4_zp_cat__, __dr5_zp_cat__
 
 from .control import control
 from .headers import get_author, get_key
-from .constants import FILTER_NAMES_DR4_ZP_TABLE, CENTRAL_WAVE, METADATA_NAMES
+from .zeropoints import get_zero_points_index, get_zpcorr_spline, zpcorr_stamp
+from .recalibrate import zpcorr_hdu
+from .constants import FILTER_NAMES_FITS, CENTRAL_WAVE, METADATA_NAMES
 
 from .utilities.io import print_level
-from .utilities.splusdata import connect_splus_cloud, detection_image_hdul, get_lupton_rgb
+from .utilities.timings import stage_timer
+from .utilities.telemetry import download_stats, file_bytes
+from .utilities.ratelimit import limiter_from_args
+from .utilities.cache import stamp_cache
+from .utilities.h5scube import write_scube_hdf5, open_scube
+from .utilities.splusdata import connect_data_source, detection_image_hdul, get_lupton_rgb, download_stamps
+from .utilities.images import DETECTION_BANDS, LUPTON_RGB_BANDS, lupton_rgb_image
+from .utilities.images import detection_image_hdul as stamps_detection_image_hdul
+
+_CUBE_COMPRESSION_TYPES = {'rice': 'RICE_1', 'hcompress': 'HCOMPRESS_1', 'gzip': 'GZIP_2'}
+_INT32_BLANK = -2**31
+
+def _noise_quantization_steps(data__byx, errors__byx=None, q=16):
+    '''
+    Calculate the quantization step of each band as the noise level of the
+    band divided by `q`. The noise level is the median of the finite and
+    positive errors or, if `errors__byx` is None, the normalized median
+    absolute deviation of the data.
+
+    Parameters
+    ----------
+    data__byx : :class:`numpy.ndarray`
+        Data cube.
+
+    errors__byx : :class:`numpy.ndarray`, optional
+        Errors cube.
+
+    q : float, optional
+        Number of quantization levels inside the noise, by default 16.
 
-_disable_zpcorr = True  # waiting S-PLUS iDR6...
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Quantization step of each band.
+    '''
+    steps__b = np.ones(data__byx.shape[0])
+    for i in range(data__byx.shape[0]):
+        if errors__byx is not None:
+            e = errors__byx[i][np.isfinite(errors__byx[i]) & (errors__byx[i] > 0)]
+            noise = np.median(e) if e.size else np.nan
+        else:
+            d = data__byx[i][np.isfinite(data__byx[i])]
+            noise = 1.4826*np.median(np.abs(d - np.median(d))) if d.size else np.nan
+        if np.isfinite(noise) and noise > 0:
+            steps__b[i] = noise/q
+    return steps__b
 
 @dataclass
 class _galaxy:
@@ -71,6 +112,69 @@ class _galaxy:
         '''      
         return SkyCoord(ra=self.ra, dec=self.dec, frame=frame, unit='deg')
     
+_STRUCTURAL_KEYS = ['SIMPLE', 'XTENSION', 'BITPIX', 'EXTEND', 'PCOUNT', 'GCOUNT', 'TFIELDS']
+
+class _stamp:
+    '''
+    A S-PLUS stamp kept in memory.
+
+    The header is read at the creation of the object and the image is 
+    decompressed only once, at the first access to :attr:`data`. Header
+    edits are kept in memory and only written to the stamp file by 
+    :meth:`write`, which keeps the (compressed) image untouched.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the (tile-compressed) stamp FITS file.
+
+    ext : int, optional
+        FITS extension of the image, by default 1.
+
+    Attributes
+    ----------
+    header : :class:`~astropy.io.fits.Header`
+        Image header.
+
+    data : :class:`~numpy.ndarray`
+        Image data.
+
+    Methods
+    -------
+    write()
+        Write the header edits back to `filename`.
+    '''
+    def __init__(self, filename, ext=1):
+        self.filename = filename
+        self.ext = ext
+        self.header = fits.getheader(filename, ext=ext)
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            with fits.open(self.filename) as hdul:
+                self._data = hdul[self.ext].data
+        return self._data
+
+    def release(self):
+        '''
+        Release the decompressed image from memory.
+        '''
+        self._data = None
+
+    def write(self):
+        # only the header cards are updated: the compressed table is opened
+        # as it is, so the (quantized) image is not compressed again
+        with fits.open(self.filename, mode='update', disable_image_compression=True) as hdul:
+            header = hdul[self.ext].header
+            for card in self.header.cards:
+                key = card.keyword
+                if (key in _STRUCTURAL_KEYS) or key.startswith('NAXIS') or (key in ['', 'COMMENT', 'HISTORY']):
+                    continue
+                if (key not in header) or (header[key] != card.value) or (header.comments[key] != card.comment):
+                    header[key] = (card.value, card.comment)
+
 class _control(control):
     '''
     Extended :class:`control` for handling specific arguments and directories.
@@ -105,11 +209,26 @@ class _control(control):
             Parsed command-line arguments.
         '''
         super().__init__(args)
+        self.bands = self._sort_bands(self.bands)
         self.output_dir = join(self.work_dir, self.galaxy)
         print_level(f'output_dir: {self.output_dir}', 2, self.verbose)
         print_level(f'prefix_filename: {self.prefix_filename}', 2, self.verbose)
         self._make_output_dir()
 
+    def _sort_bands(self, bands):
+        '''
+        S-PLUS FITS names (see :data:`scubes.constants.FILTER_NAMES_FITS`)
+        of `bands` in wavelength order, without repetitions.
+        '''
+        names = []
+        for band in bands:
+            name = FILTER_NAMES_FITS.get(band, band.upper())
+            if name not in CENTRAL_WAVE:
+                print_level(f'{band}: unknown S-PLUS band')
+                sys.exit(1)
+            names.append(name)
+        return [band for band in CENTRAL_WAVE.keys() if band in names]
+
     def _make_output_dir(self):
         '''
         Create the output directory.
@@ -131,6 +250,21 @@ class SCubes:
     _conn : object
         Connection object to the S-PLUS Cloud.
 
+    timer : :class:`~scubes.utilities.timings.stage_timer`
+        Records the stages of the cube build (see ``--timings`` and
+        ``--profile``).
+
+    download_stats : :class:`~scubes.utilities.telemetry.download_stats`
+        Telemetry of the data-source requests (see ``--download_stats``).
+
+    _limiter : :class:`~scubes.utilities.ratelimit.adaptive_limiter`
+        Limiter of the data-source requests (see :attr:`limiter`).
+
+    _conn_factory : callable
+        If set, called (instead of connecting to ``--data_source``) to get
+        the connection object the first time it is needed (e.g. the
+        connection shared by a batch run).
+
     control : :class:`~_control`
         Control object for handling specific arguments and directories.
 
@@ -155,6 +289,30 @@ class SCubes:
     headers__b : list
         List of headers for each band.
 
+    stamps__b : list of :class:`~_stamp`
+        In-memory stamps for each band.
+
+    wstamps__b : list of :class:`~_stamp`
+        In-memory weight stamps for each band.
+
+    _append_bands : list of str
+        Bands of the existing cube (``--append_bands``, see 
+        :meth:`check_cube`), None otherwise.
+
+    _append_cal : dict
+        Calibration of the existing cube (``--append_bands``): ``zpsource``
+        and ``zpcorr`` (``ZPSOURCE`` and ``ZPCORR`` primary keys) and 
+        ``magzp`` (stored zero points at the METADATA).
+
+    _store_zp : bool
+        Store the calibration of the cube (``--store_zp``, see 
+        :meth:`_zpcorr_hdu`).
+
+    _write_guard : callable
+        Called (without arguments) before the written cube is moved to
+        the cube path; an exception cancels the write (see
+        :meth:`_replace_cube`). None by default.
+
     See Also
     --------
     :class:`~_control`, :class:`~_galaxy`, :class:`control`
@@ -169,13 +327,72 @@ class SCubes:
             Parsed command-line arguments.
         '''        
         self._conn = None
+        self._conn_factory = None
+        self._limiter = None
+        self._cache = None
+        self._append_bands = None
+        self._append_cal = None
+        self._append = None
+        self._write_guard = None
+        self._store_zp = False
+        self.zp_table = None
+        self.download_stats = download_stats()
+        self.dzp__byx = None
         self.args = args
         self.control = _control(self.args)
+        self._init_timer()
         self.detection_image = None
         self.lupton_rgb_filename = None
         self._init_galaxy()
         self._init_spectra()
 
+    def _init_timer(self):
+        '''
+        Initialize the stages timer. The records are written to
+        ``GALAXY_timings.jsonl`` next to the cube (see :meth:`write_timings`)
+        and the profiles to ``GALAXY_STAGE.prof``.
+        '''
+        ctrl = self.control
+        profile = getattr(ctrl, 'profile', None)
+        self.timer = stage_timer(
+            enabled=getattr(ctrl, 'timings', False) or bool(profile), profile=profile,
+            profile_dir=ctrl.output_dir, prefix=f'{ctrl.galaxy}_',
+            context=dict(galaxy=ctrl.galaxy, tile=ctrl.tile, size=ctrl.size),
+            verbose=ctrl.verbose,
+        )
+
+    @property
+    def limiter(self):
+        '''
+        Adaptive concurrency and rate limiter of the data-source requests
+        (up to ``--download_workers`` simultaneous requests and 
+        ``--rate_limit`` requests per second shared by the processes of 
+        the host through ``--rate_limit_file``).
+
+        Returns
+        -------
+        :class:`~scubes.utilities.ratelimit.adaptive_limiter`
+            The limiter.
+        '''
+        if self._limiter is None:
+            self._limiter = limiter_from_args(self.control)
+        return self._limiter
+
+    @property
+    def timings_path(self):
+        '''
+        Path to the stages timings file (JSON lines).
+        '''
+        return join(self.control.output_dir, f'{self.control.galaxy}_timings.jsonl')
+
+    def write_timings(self):
+        '''
+        Append the records of the stages timer to :attr:`timings_path`.
+        '''
+        if self.timer.records:
+            self.timer.write(self.timings_path)
+            print_level(f'stages timings: {self.timings_path}', 1, self.control.verbose)
+
     def _init_galaxy(self):
         '''
         Initialize the _galaxy object.
@@ -191,28 +408,65 @@ class SCubes:
         '''
         Initialize the spectra arrays.
         '''        
-        self.wl__b = np.array(sorted([CENTRAL_WAVE[b] for b in self.control.bands]))*u.Angstrom
+        self.wl__b = np.array([CENTRAL_WAVE[b] for b in self.control.bands])*u.Angstrom
         self.flam_unit = u.erg / u.s / u.cm / u.cm / u.AA
         self.fnu_unit = u.erg / u.s / u.cm / u.cm / u.Hz
         self.flam__b = None
         self.fnu__b = None
         self.headers__b = None
+        self.stamps__b = None
+        self.wstamps__b = None
 
     @property
     def conn(self):
         '''
-        Get the connection object to the S-PLUS Cloud.
+        Get the connection object to the data source (S-PLUS Cloud by
+        default, see ``--data_source``).
 
         Returns
         -------
         object
-            Connection object to the S-PLUS Cloud.
+            Connection object to the data source.
         '''        
+        if (self._conn is None) and (self._conn_factory is not None):
+            self._conn = self._conn_factory()
         if self._conn is None:
             ctrl = self.control
-            self._conn = connect_splus_cloud(ctrl.username, ctrl.password)
+            self._conn = connect_data_source(
+                ctrl.data_source, ctrl.username, ctrl.password, 
+                tiles_dir=ctrl.tiles_dir, mock_url=ctrl.mock_url, stats=self.download_stats, 
+                token_cache=ctrl.token_cache, max_connections=max(16, ctrl.download_workers), 
+                verbose=ctrl.verbose,
+            )
         return self._conn
 
+    @property
+    def cache(self):
+        '''
+        Get the shared stamps cache.
+
+        Returns
+        -------
+        :class:`~scubes.utilities.cache.stamp_cache` or None
+            The stamps cache or None if ``--cache_dir`` is not set.
+        '''
+        ctrl = self.control
+        if (self._cache is None) and (ctrl.cache_dir is not None):
+            max_bytes = None if ctrl.cache_max_size is None else int(ctrl.cache_max_size*1024**3)
+            self._cache = stamp_cache(ctrl.cache_dir, max_bytes=max_bytes, verbose=ctrl.verbose)
+        return self._cache
+
+    def _cache_kw(self, kind='stamp', band=None, weight=False):
+        '''
+        Keyword arguments used to address a product in the stamps cache.
+        '''
+        ctrl = self.control
+        gal = self.galaxy
+        return dict(
+            kind=kind, data_release=ctrl.data_release, tile=ctrl.tile, 
+            ra=gal.ra, dec=gal.dec, size=ctrl.size, band=band, weight=weight,
+        )
+
     def _check_errors(self):
         '''
         Check if there are any errors in the data.
@@ -260,6 +514,10 @@ class SCubes:
             Array of data spectra from the specified FITS images.
         '''        
         images = self.images if images is None else images
+        if (ext == 1) and (self.stamps__b is not None):
+            stamps = {s.filename: s for s in self.stamps__b + self.wstamps__b}
+            if all(img in stamps for img in images):
+                return np.array([stamps[img].data for img in images])
         return np.array([fits.getdata(img, ext=ext) for img in images])
 
     def _header_key_spectra(self, key):
@@ -335,73 +593,154 @@ class SCubes:
         gal = self.galaxy
         ctrl = self.control
         # UPDATE IMAGES HEADER - WILL ADD TILE INFO AND WCS TO THE HEADERS
-        for img in self.images:
-            with fits.open(img, 'update') as f:
-                print_level(f'{gal.name}: {ctrl.tile}: {img}: add OBJECT and TILE to header', 2, ctrl.verbose)
-                w = WCS(f[1].header)
-                f[1].header['OBJECT'] = gal.name
-                f[1].header['TILE'] = ctrl.tile
-                f[1].header.update(w.to_header())
+        for stamp in self.stamps__b:
+            print_level(f'{gal.name}: {ctrl.tile}: {stamp.filename}: add OBJECT and TILE to header', 2, ctrl.verbose)
+            h = stamp.header
+            w = WCS(h)
+            h['OBJECT'] = gal.name
+            h['TILE'] = ctrl.tile
+            h.update(w.to_header())
+
+    def _from_cache(self, filename, kind='stamp', band=None, weight=False):
+        '''
+        Retrieve `filename` from the stamps cache, if enabled. The cache is
+        not used if ``--force`` is active.
+
+        Returns
+        -------
+        bool
+            True if `filename` was retrieved from the cache.
+        '''
+        if (self.cache is None) or self.control.force:
+            return False
+        return self.cache.get(filename, **self._cache_kw(kind=kind, band=band, weight=weight))
+
+    def stamp_filename(self, band, weight=False):
+        '''
+        Path of the stamp (or weight stamp) of `band`.
+        '''
+        gal = self.galaxy
+        ctrl = self.control
+        suffix = 'swpweight' if weight else 'swp'
+        return join(ctrl.output_dir, f'{gal.name}_{ctrl.tile}_{band}_{ctrl.size}x{ctrl.size}_{suffix}.fits.fz')
 
     def get_stamps(self):
         '''
-        Download stamps for each band.
+        Download stamps for each band of ``--bands``.
         '''
         gal = self.galaxy
         ctrl = self.control
         self.stamps = []
-        for filt in tqdm(list(CENTRAL_WAVE.keys()), desc=f'{gal.name} @ {ctrl.tile} - downloading', leave=True, position=0):
-            fname = join(ctrl.output_dir, f'{gal.name}_{ctrl.tile}_{filt}_{ctrl.size}x{ctrl.size}_swp.fits.fz')
-            self.stamps.append(fname)
-            if not isfile(fname) or ctrl.force:
-                kw_stamp = dict(ra=gal.ra, dec=gal.dec, size=ctrl.size, band=filt, weight=False, outfile=fname, field_name=ctrl.tile)
-                kw_stamp['data_release'] = ctrl.data_release
-                _ = self.conn.stamp(**kw_stamp)
-            # Download_weight:
-            fname = join(ctrl.output_dir, f'{gal.name}_{ctrl.tile}_{filt}_{ctrl.size}x{ctrl.size}_swpweight.fits.fz')
-            self.stamps.append(fname)
-            if not isfile(fname) or ctrl.force:
-                kw_stamp = dict(ra=gal.ra, dec=gal.dec, size=ctrl.size, band=filt, weight=True, outfile=fname, field_name=ctrl.tile)
-                kw_stamp['data_release'] = ctrl.data_release
-                _ = self.conn.stamp(**kw_stamp)
+        stamps_kw = []
+        for filt in ctrl.bands:
+            for weight in [False, True]:
+                fname = self.stamp_filename(filt, weight=weight)
+                self.stamps.append(fname)
+                if (not isfile(fname) or ctrl.force) and not self._from_cache(fname, band=filt, weight=weight):
+                    kw_stamp = dict(ra=gal.ra, dec=gal.dec, size=ctrl.size, band=filt, weight=weight, outfile=fname, field_name=ctrl.tile)
+                    kw_stamp['data_release'] = ctrl.data_release
+                    kw_stamp['timeout'] = ctrl.download_timeout
+                    stamps_kw.append(kw_stamp)
+        # the data source is only connected if there is anything to download
+        if stamps_kw:
+            desc = f'{gal.name} @ {ctrl.tile} - downloading'
+            download_stamps(
+                self.conn, stamps_kw, desc=desc, retries=ctrl.download_retries, 
+                stats=self.download_stats, galaxy=gal.name, limiter=self.limiter,
+            )
+        if self.cache is not None:
+            for kw in stamps_kw:
+                self.cache.put(kw['outfile'], **self._cache_kw(band=kw['band'], weight=kw['weight']))
         # SHORTCUTS
         self.images = [img for img in self.stamps if 'swp.' in img]
         self.wimages = [img for img in self.stamps if 'swpweight.' in img]
+        self.stamps__b = [_stamp(img) for img in self.images]
+        self.wstamps__b = [_stamp(img) for img in self.wimages]
         self._add_info_stamps_header()
-        self.headers__b = self._get_headers_list(self.images, ext=1)
+        self.headers__b = [stamp.header for stamp in self.stamps__b]
         for header in self.headers__b:
             self._check_write_mar_author(header)
        
+    def _bands_stamps(self, bands):
+        '''
+        Stamps (:class:`_stamp`) of `bands`.
+
+        Returns
+        -------
+        list of :class:`_stamp` or None
+            The stamps, or None if the stamps were not read yet (see
+            :meth:`get_stamps`), if any of `bands` is missing or if
+            ``--download_images`` is set.
+        '''
+        if self.control.download_images or (self.stamps__b is None):
+            return None
+        stamps = {s.header.get(get_key('FILTER', get_author(s.header))): s for s in self.stamps__b}
+        if not all(band in stamps for band in bands):
+            return None
+        return [stamps[band] for band in bands]
+
     def get_detection_image(self):
         '''
-        Download the detection image.        
+        Create the detection image: the sum of the G, R, I and Z stamps
+        (see :func:`scubes.utilities.images.detection_image_hdul`), or 
+        downloaded from the data source if the stamps are not available
+        or with ``--download_images``.
         '''
         gal = self.galaxy
         ctrl = self.control
-        band = 'G,R,I,Z'
+        band = ','.join(DETECTION_BANDS)
         self.detection_image = join(ctrl.output_dir, f'{gal.name}_{ctrl.tile}_{ctrl.size}x{ctrl.size}_detection.fits')
-        if not isfile(self.detection_image) or ctrl.force:
+        if isfile(self.detection_image) and not ctrl.force:
+            return
+        stamps = self._bands_stamps(DETECTION_BANDS)
+        if stamps is not None:
+            print_level(f'{gal.name} @ {ctrl.tile} - creating detection image from the stamps', 1, ctrl.verbose)
+            hdul = stamps_detection_image_hdul([s.data for s in stamps], [s.header for s in stamps], bands=DETECTION_BANDS)
+            self._check_write_mar_author(hdul[1].header)
+            hdul.writeto(self.detection_image, overwrite=ctrl.force)
+        elif not self._from_cache(self.detection_image, kind='detection', band=band):
             print_level(f' {gal.name} @ {ctrl.tile} - downloading detection image')
             kw = dict(ra=gal.ra, dec=gal.dec, size=ctrl.size, bands=band, option=ctrl.tile)
             kw['_data_relase'] = ctrl.data_release
-            hdul = detection_image_hdul(self.conn, wcs=True, **kw)
-            self._check_write_mar_author(hdul[1].header)
-            hdul.writeto(self.detection_image, overwrite=ctrl.force)
+            with self.download_stats.request('detection', galaxy=gal.name, band=band) as rec:
+                with self.limiter.request():
+                    hdul = detection_image_hdul(self.conn, wcs=True, **kw)
+                self._check_write_mar_author(hdul[1].header)
+                hdul.writeto(self.detection_image, overwrite=ctrl.force)
+                rec['bytes'] = file_bytes(self.detection_image)
+            if self.cache is not None:
+                self.cache.put(self.detection_image, **self._cache_kw(kind='detection', band=band))
                         
     def get_lupton_rgb(self):
         '''
-        Download the Lupton RGB image.        
+        Create the Lupton RGB image of the I, R and G stamps (see 
+        :func:`scubes.utilities.images.lupton_rgb_image`), or download it
+        from the data source if the stamps are not available or with 
+        ``--download_images``.
         '''
         gal = self.galaxy
         ctrl = self.control
-        #conn = self.get_splusdata_conn()
         fname = join(ctrl.output_dir, f'{gal.name}_{ctrl.tile}_{ctrl.size}x{ctrl.size}.png')
         self.lupton_rgb_filename = fname
-        if not isfile(fname) or ctrl.force:
+        if isfile(fname) and not ctrl.force:
+            self.lupton_rgb = Image.open(fname)
+            return
+        stamps = self._bands_stamps(LUPTON_RGB_BANDS)
+        if stamps is not None:
+            print_level(f'{gal.name} @ {ctrl.tile} - creating RGB image from the stamps', 1, ctrl.verbose)
+            img = lupton_rgb_image([s.data for s in stamps])
+            img.save(fname, 'PNG')
+        elif not self._from_cache(fname, kind='lupton'):
             print_level(f'{gal.name} @ {ctrl.tile} - downloading RGB image')
             kw = dict(ra=gal.ra, dec=gal.dec, size=ctrl.size, field_name=ctrl.tile)
             kw['_data_relase'] = ctrl.data_release
-            img = get_lupton_rgb(self.conn, transpose=True, **kw)
+            save_img = self.cache is not None
+            with self.download_stats.request('lupton', galaxy=gal.name) as rec:
+                with self.limiter.request():
+                    img = get_lupton_rgb(self.conn, transpose=True, save_img=save_img, filename=fname, **kw)
+                rec['bytes'] = file_bytes(fname) if save_img else None
+            if save_img:
+                self.cache.put(fname, **self._cache_kw(kind='lupton'))
         else:
             img = Image.open(fname)
         self.lupton_rgb = img
@@ -414,8 +753,12 @@ class SCubes:
             zp correction image is based on a 9200 x 9200 image,
             the valid CCD area. When creating stamps, the stamp
             FITS header maps the x0, y0 position on the original
-            11000 x 11000 field image. This creates a huge problem
-            on correcting stamps. 
+            11000 x 11000 field image. The positions are converted 
+            to the correction grid frame by 
+            :func:`scubes.zeropoints.tile_to_zpcorr_grid`.
+
+        The splines are built only once per process (see 
+        :func:`scubes.zeropoints.get_zpcorr_spline`).
         '''
         ctrl = self.control
         zpcorr = {}
@@ -423,22 +766,12 @@ class SCubes:
         for h in self.headers__b:
             author = get_author(h)
             band = h.get(get_key('FILTER', author))
-            if '4' in ctrl.data_release:
-                self.zpcorr_dir = __dr4_zpcorr_path__
-                nbins = 32
-            elif '5' in ctrl.data_release:
-                self.zpcorr_dir = __dr5_zpcorr__[author]
-                nbins = 64
-            else:
-                print_level(f'{ctrl.data_release}: wrong data release')
+            try:
+                zpcorr[band] = get_zpcorr_spline(ctrl.data_release, band, author, verbose=ctrl.verbose)
+            except ValueError as e:
+                print_level(f'{e}')
                 self.remove_downloaded_data()
                 sys.exit(1)
-            x0, x1 = 0, 9200
-            xgrid = np.linspace(x0, x1, nbins + 1)
-            corrfile = join(self.zpcorr_dir, 'SPLUS_' + band + '_offsets_grid.npy')
-            print_level(f'Reading ZPs corr image: {corrfile}')
-            corr = np.load(corrfile)
-            zpcorr[band] = RectBivariateSpline(xgrid, xgrid, corr)
         self.zpcorr = zpcorr
 
     def get_zero_points(self):
@@ -451,17 +784,14 @@ class SCubes:
             self.zp_table = __dr4_zp_cat__
         elif '5' in ctrl.data_release:           
             self.zp_table = __dr5_zp_cat__
-        print_level(f'Reading ZPs table: {self.zp_table}')
-        zpt = pd.read_csv(self.zp_table)
-        cols = [col.replace('ZP_', '') if 'ZP_' in col else col for col in zpt.columns]
-        zpt.columns = cols
         # New class properties
-        self.zptab = zpt[zpt['Field'].replace('_', '-') == ctrl.tile.replace('_', '-')]
-        if self.zptab.size == 0:
+        self.zp_index = get_zero_points_index(self.zp_table, verbose=ctrl.verbose)
+        self.zptab = self.zp_index.lookup(ctrl.tile)
+        if self.zptab is None:
             print_level(f'{ctrl.tile}: not found in zero-points table')
             self.remove_downloaded_data()
             sys.exit(1)
-        if not _disable_zpcorr:
+        if ctrl.zpcorr:
             self.get_zero_points_correction()
 
     def add_magzp_headers(self):
@@ -471,36 +801,38 @@ class SCubes:
         ctrl = self.control
         self.get_zero_points()
         print_level('Calibrating stamps...')
-        headers = []
+        dzp__byx = []
         for img, h in zip(self.images, self.headers__b):
-            #h = fits.getheader(img, ext=1)
             h['TILE'] = ctrl.tile
             filtername = h['FILTER']
-            if ('4' in ctrl.data_release) and (filtername in FILTER_NAMES_DR4_ZP_TABLE.keys()):
-                k = FILTER_NAMES_DR4_ZP_TABLE[filtername]
-            elif filtername in self.zptab.keys():
-                k = filtername
-            else:
+            zp = self.zptab.get(FILTER_NAMES_FITS.get(filtername, filtername), None)
+            if zp is None:
                 print_level(f'{ctrl.tile}: {filtername}: missing zp correction data')
                 self.remove_downloaded_data()
                 sys.exit(1)
-            zp = float(self.zptab[k].item())
             x0 = h['X0TILE']
             y0 = h['Y0TILE']
-            if not _disable_zpcorr:
-                zp += round(self.zpcorr[filtername](x0, y0)[0][0], 5)
-            fits.setval(img, 'MAGZP', value=zp, comment='Magnitude zero point', ext=1)
-            headers.append(fits.getheader(img, ext=1))
+            if ctrl.zpcorr:
+                # per-pixel correction relative to the stamp center
+                zpcorr, dzp__yx = zpcorr_stamp(self.zpcorr[filtername], x0, y0, (h['NAXIS2'], h['NAXIS1']))
+                zp += zpcorr
+                dzp__byx.append(dzp__yx)
+            h.set('MAGZP', value=zp, comment='Magnitude zero point')
             print_level(f'add_magzp_headers: {img}: MAGZP={zp}', level=2, verbose=ctrl.verbose)
-        # updates the list of headers with the new values
-        self.headers__b = headers
+        self.dzp__byx = np.array(dzp__byx) if ctrl.zpcorr else None
          
     def calibrate_stamps(self):
         '''
-        Calibrate the downloaded stamps.
+        Calibrate the downloaded stamps. The stamps already calibrated
+        (``MAGZP`` header key, e.g. from the local tiles or saved with
+        ``--write_stamps``) keep their zero points, without the per-pixel
+        correction (``--zpcorr``).
         '''
         if not self.check_zero_points():
             self.add_magzp_headers()
+        elif self.control.zpcorr:
+            # the MAGZP of the stamps could already include the correction
+            print_level('--zpcorr: the stamps already have MAGZP, the per-pixel ZP correction is not applied')
 
     def stamp_WCS_to_cube_header(self, header):
         '''
@@ -516,9 +848,7 @@ class SCubes:
         :class:`~astropy.io.fits.Header`
             Cube header with updated WCS information.
         '''        
-        img = self.images[0]
         w = WCS(header)
-        w = WCS(fits.getheader(img, 1))
         nw = WCS(naxis=3)
         nw.wcs.cdelt[:2] = w.wcs.cdelt
         nw.wcs.crval[:2] = w.wcs.crval
@@ -548,10 +878,12 @@ class SCubes:
         tab = []
         names = []
         items = ['filter', 'central_wave', 'pivot_wave']        
+        bands = self.control.bands
+        i_b = [i for i, f in enumerate(__filters_table__['filter']) if FILTER_NAMES_FITS.get(str(f), str(f)) in bands]
         for k in items:
             if k in __filters_table__.colnames:
                 names.append(METADATA_NAMES[k])
-                v = __filters_table__[k]
+                v = __filters_table__[k][i_b]
                 tab.append(v)
 
         # PSFFWHM
@@ -566,10 +898,64 @@ class SCubes:
         tab.append(list_values)
         names.append('PSFFWHM')
 
+        # MAGZP (--store_zp)
+        if self._store_zp:
+            tab.append(self.m0__b)
+            names.append(METADATA_NAMES['magzp'])
+
         meta_tab = Table(tab, names=names)
+        if self._append is not None:
+            # --append_bands: with the bands of the existing cube
+            meta_tab = vstack([self._append['metadata'], meta_tab])
+            meta_tab = meta_tab[np.argsort(self._append['i_old'] + self._append['i_new'])]
         meta_hdu = fits.BinTableHDU(meta_tab)
         return meta_hdu
 
+    def _zpcorr_hdu(self):
+        '''
+        ``--store_zp``: the zero points used to calibrate the cube are 
+        stored at the MAGZP column of the METADATA (see 
+        :meth:`create_metadata_hdu`) and, with ``--zpcorr``, the per-pixel
+        ZP correction maps (relative to MAGZP) at the ZPCORR extension. 
+        Since the DATA and ERRORS are the counts times the f0 map, this is
+        enough to recalibrate the cube with other zero points without the
+        stamps (see :mod:`scubes.recalibrate`).
+
+        Returns
+        -------
+        :class:`~astropy.io.fits.ImageHDU` or None
+            ZPCORR extension or None if the cube has no per-pixel ZP 
+            correction.
+        '''
+        # --append_bands: with the maps of the existing cube
+        dzp__byx = self.dzp__byx if self._append is None else self._append['dzp__byx']
+        if dzp__byx is None:
+            return None
+        return zpcorr_hdu(dzp__byx)
+
+    def _f0_map(self, i=None):
+        '''
+        Flux of the magnitude zero point. If the stamps were calibrated with
+        the per-pixel ZP correction (``--zpcorr``), returns the f0 map of 
+        each band.
+
+        Parameters
+        ----------
+        i : int, optional
+            Band index. If None, returns all bands.
+
+        Returns
+        -------
+        :class:`numpy.ndarray` or float
+            Array with shape ``(n_bands, 1, 1)`` or ``(n_bands, ny, nx)``
+            (the band image or a scalar if `i` is set).
+        '''
+        f0 = self.f0__b[:, None, None] if i is None else self.f0__b[i]
+        if self.dzp__byx is not None:
+            dzp = self.dzp__byx if i is None else self.dzp__byx[i]
+            f0 = f0*np.power(10, -0.4*dzp)
+        return f0
+
     def spectra(self, flam_scale=None):
         '''
         Calculate the spectra arrays.
@@ -589,6 +975,8 @@ class SCubes:
             pixel of the galaxy. Since we have a zp correction for
             each pixel, we can create a m0 map, resulting in a f0 
             map.
+            
+            With --zpcorr the f0 map is used (see :meth:`_f0_map`).
         '''
         #Jy to to erg/s/cm/cm/Hz
         Jy2fnu = - 2.5*(np.log10(3631) - 23)  # 48.5999343777177...
@@ -599,7 +987,8 @@ class SCubes:
         
         # from e- counts to erg/s/cm/cm/A
         self.data__byx = self._get_data_spectra(self.images, 1)
-        self.fnu__byx = self.data__byx*self.f0__b[:, None, None]*self.fnu_unit
+        f0__byx = self._f0_map()
+        self.fnu__byx = self.data__byx*f0__byx*self.fnu_unit
         self.flam__byx = scale*(self.fnu__byx*_c/self.wl__b[:, None, None]**2).to(self.flam_unit).value
 
         if self._check_errors():
@@ -608,7 +997,7 @@ class SCubes:
             dataclip__byx = np.abs(self.data__byx)
             weidata__byx = np.abs(self._get_data_spectra(self.wimages, 1))
             dataerr__byx = np.sqrt(1/weidata__byx + dataclip__byx/gain__byx)
-            self.efnu__byx = dataerr__byx*self.f0__b[:, None, None]*self.fnu_unit
+            self.efnu__byx = dataerr__byx*f0__byx*self.fnu_unit
             self.eflam__byx = scale*(self.efnu__byx*_c/self.wl__b[:, None, None]**2).to(self.flam_unit).value
 
     def download_data(self):
@@ -619,6 +1008,17 @@ class SCubes:
         #    ctrl.det_img = True
         if ctrl.det_img:
             self.get_detection_image()
+        self.write_download_stats()
+
+    def write_download_stats(self):
+        '''
+        Export the data-source requests telemetry to ``--download_stats``
+        (a Prometheus textfile if it ends with ``.prom``, JSON otherwise).
+        '''
+        ctrl = self.control
+        if ctrl.download_stats is not None:
+            self.download_stats.write(ctrl.download_stats)
+            print_level(f'download statistics: {ctrl.download_stats}', 1, ctrl.verbose)
 
     def create_weights_mask_hdu(self):
         '''
@@ -632,10 +1032,24 @@ class SCubes:
         w__byx = self._get_data_spectra(self.wimages, 1)
         wmask__byx = np.where(w__byx < 0, 1, 0)
         wmask__yx = wmask__byx.sum(axis=0)
+        n_b = len(self.wimages)
+        if self._append is not None:
+            wmask__yx = wmask__yx + self._append['wmask__yx']
+            n_b += len(self._append['i_old'])
         wmask_hdu = fits.ImageHDU(wmask__yx)
-        wmask_hdu.header['EXTNAME'] = ('WEIMASK', 'Sum of negative weight pixels (from 1 to 12)')
+        wmask_hdu.header['EXTNAME'] = ('WEIMASK', f'Sum of negative weight pixels (from 1 to {n_b})')
         return wmask_hdu
     
+    def write_stamps(self):
+        '''
+        Write the in-memory stamps, with the header edits (OBJECT, TILE, 
+        WCS, MAGZP and AUTHOR), back to the stamp files.
+        '''
+        ctrl = self.control
+        for stamp in self.stamps__b:
+            print_level(f'writting stamp {stamp.filename}', 1, ctrl.verbose)
+            stamp.write()
+
     def remove_downloaded_data(self):
         '''
         Remove downloaded stamp, detection image, and Lupton RGB image files.
@@ -656,72 +1070,284 @@ class SCubes:
                 else:
                     print_level(f'file {f} do not exists', 1, ctrl.verbose)
 
-    def create_cube(self, flam_scale=None):
+    def _cube_path(self):
         '''
-        Create a data cube from S-PLUS galaxy stamps.
+        Path of the cube.
+        '''
+        ctrl = self.control
+        #cube_filename = f'{ctrl.prefix_filename}_cube.fits'
+        cube_ext = 'h5' if ctrl.cube_container == 'hdf5' else 'fits'
+        cube_filename = f'{self.galaxy.name}_cube.{cube_ext}'
+        return join(ctrl.output_dir, cube_filename)
 
-        Parameters
-        ----------
-        flam_scale : float, optional
-            Scaling factor for flux density, by default None.
+    def check_cube(self):
+        '''
+        Set the cube path and check if the cube already exists.
 
         Raises
         ------
         OSError
-            Raises an error if the cube already exists and redo is not specified.
-        '''        
-        flam_scale = 1e-19 if flam_scale is None else flam_scale
+            Raises an error if the cube already exists and redo is not 
+            specified. With ``--append_bands``, only if the cube already has
+            all the bands (see :meth:`_init_append_bands`).
+        '''
         ctrl = self.control
-
-        # CUBE CHECK
-        #cube_filename = f'{ctrl.prefix_filename}_cube.fits'
-        cube_filename = f'{self.galaxy.name}_cube.fits'
-        cube_path = join(ctrl.output_dir, cube_filename)
+        cube_path = self._cube_path()
         self.cube_path = cube_path
         if exists(cube_path) and not ctrl.redo:
+            if not ctrl.append_bands:
+                raise OSError('Cube exists!')
+            self._init_append_bands(cube_path)
+
+    def _init_append_bands(self, cube_path):
+        '''
+        ``--append_bands``: only the bands of ``--bands`` missing from the
+        existing cube are downloaded and calculated (``control.bands`` is
+        reduced to them). They are merged with the bands of the cube by
+        :meth:`_merge_cube_bands`.
+
+        Raises
+        ------
+        OSError
+            If the cube already has all the bands, or if its tile or size
+            differs.
+        '''
+        ctrl = self.control
+        if self._append_bands is None:
+            with open_scube(cube_path) as hdul:
+                h = hdul['PRIMARY'].header
+                if (h.get('TILE', None) != ctrl.tile) or (h.get('SIZE', None) != ctrl.size):
+                    raise OSError(f'{cube_path}: the cube tile or size differs, use --redo')
+                metadata = hdul['METADATA'].data
+                filters = [f.decode() if isinstance(f, bytes) else str(f) for f in metadata[METADATA_NAMES['filter']]]
+                self._append_cal = dict(
+                    zpsource=h.get('ZPSOURCE', None), zpcorr=h.get('ZPCORR', None),
+                    magzp=METADATA_NAMES['magzp'] in metadata.dtype.names,
+                )
+            self._append_bands = [FILTER_NAMES_FITS.get(f.strip(), f.strip()) for f in filters]
+        missing = [band for band in ctrl.bands if band not in self._append_bands]
+        if not missing:
+            print_level(f'{cube_path}: all the bands are already in the cube')
             raise OSError('Cube exists!')
-        
-        # DOWNLOAD AND CALIBRATE DATA
-        self.download_data()
-        self.calibrate_stamps()
-        
+        if missing != ctrl.bands:
+            print_level(f'{cube_path}: appending bands {" ".join(missing)}')
+            ctrl.bands = missing
+            self._init_spectra()
+
+    def _check_append_calibration(self, zp_source, zpcorr):
+        '''
+        ``--append_bands``: check that the new bands are calibrated as the
+        bands of the existing cube (same source of the zero points and 
+        per-pixel ZP correction).
+
+        Returns
+        -------
+        bool
+            False if the calibration of the cube is unknown (no ``ZPSOURCE``
+            key), so it is not checked.
+
+        Raises
+        ------
+        OSError
+            If the calibration of the cube differs.
+        '''
+        cal = self._append_cal
+        if cal['zpsource'] is None:
+            print_level(f'{self.cube_path}: unknown calibration of the cube bands, the appended bands are not checked')
+            return False
+        if (cal['zpsource'] != zp_source) or (bool(cal['zpcorr']) != zpcorr):
+            raise OSError(
+                f'{self.cube_path}: calibration of the cube (ZPSOURCE={cal["zpsource"]}, ZPCORR={cal["zpcorr"]}) '
+                f'differs from the new bands ({zp_source}, {zpcorr}), use --redo'
+            )
+        return True
+
+    def _merge_cube_bands(self, prim_hdu, flam_scale):
+        '''
+        ``--append_bands``: merge the calculated spectra (:attr:`flam__byx`
+        and :attr:`eflam__byx`) with the bands of the existing cube, in 
+        wavelength order. The WEIMASK, METADATA and ZPCORR of the cube are
+        kept to be merged by :meth:`create_weights_mask_hdu`, 
+        :meth:`create_metadata_hdu` and :meth:`_zpcorr_hdu`, and the 
+        primary header keys of the cube (e.g. the masterlist information)
+        are copied to `prim_hdu`.
+
+        Raises
+        ------
+        OSError
+            If the ERRORS extension or the per-pixel ZP correction maps
+            (of a cube with stored zero points) of the cube and of the new
+            bands mismatch.
+        '''
+        ctrl = self.control
+        errors = self._check_errors()
+        with open_scube(self.cube_path) as hdul:
+            try:
+                eflam_old__byx = np.array(hdul['ERRORS'].data)/flam_scale
+            except KeyError:
+                eflam_old__byx = None
+            if errors != (eflam_old__byx is not None):
+                raise OSError(f'{self.cube_path}: ERRORS extension mismatch with the new bands, use --redo')
+            dzp_old__byx = None
+            if self._store_zp:
+                try:
+                    dzp_old__byx = np.array(hdul['ZPCORR'].data, dtype='float64')
+                except KeyError:
+                    pass
+                if (dzp_old__byx is None) != (self.dzp__byx is None):
+                    raise OSError(f'{self.cube_path}: per-pixel ZP correction (--zpcorr) mismatch with the new bands, use --redo')
+            flam_old__byx = np.array(hdul['DATA'].data)/flam_scale
+            wmask__yx = np.array(hdul['WEIMASK'].data)
+            metadata = Table(np.array(hdul['METADATA'].data))
+            metadata.convert_bytestring_to_unicode()
+            for card in hdul['PRIMARY'].header.cards:
+                if card.keyword not in prim_hdu.header and card.keyword not in ['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND']:
+                    prim_hdu.header.append(card)
+        bands = [b for b in CENTRAL_WAVE.keys() if (b in self._append_bands) or (b in ctrl.bands)]
+        i_old = [bands.index(b) for b in self._append_bands]
+        i_new = [bands.index(b) for b in ctrl.bands]
+
+        def _merge(old__byx, new__byx):
+            merged__byx = np.empty((len(bands),) + new__byx.shape[1:], dtype=new__byx.dtype)
+            merged__byx[i_old] = old__byx
+            merged__byx[i_new] = new__byx
+            return merged__byx
+
+        self.flam__byx = _merge(flam_old__byx, self.flam__byx)
+        if errors:
+            self.eflam__byx = _merge(eflam_old__byx, self.eflam__byx)
+        dzp__byx = None if dzp_old__byx is None else _merge(dzp_old__byx, self.dzp__byx)
+        self._append = dict(i_old=i_old, i_new=i_new, wmask__yx=wmask__yx, metadata=metadata, dzp__byx=dzp__byx)
+
+    def _cube_image_header(self, cube_h, extname, flam_scale):
+        '''
+        Set the header keys of the DATA and ERRORS extensions.
+        '''
+        comment = 'Name of the extension'
+        cube_h['EXTNAME'] = (extname, comment)
+        cube_h['BSCALE'] = (flam_scale, 'Linear factor in scaling equation')
+        cube_h['BZERO'] = (0, 'Zero point in scaling equation') 
+        cube_h['BUNIT'] = (f'{self.flam_unit}', 'Physical units of the array values')       
+        return cube_h
+
+    def _cube_hdu(self, data__byx, cube_h, extname, flam_scale, step=None):
+        '''
+        Create the DATA or ERRORS extension in the format selected by
+        ``--cube_format``.
+
+        Parameters
+        ----------
+        data__byx : :class:`numpy.ndarray`
+            Cube scaled by `flam_scale`.
+
+        cube_h : :class:`~astropy.io.fits.Header`
+            Header of the extension.
+
+        extname : str
+            Name of the extension.
+
+        flam_scale : float
+            Scaling factor for flux density.
+
+        step : float, optional
+            Quantization step (in `flam_scale` units) of the ``int32`` and 
+            tile-compressed formats. If None, the ``int32`` format uses a 
+            step of 1 and the tile-compressed formats let CFITSIO estimate 
+            the noise of each band (one compression tile per band).
+
+        Returns
+        -------
+        :class:`~astropy.io.fits.ImageHDU` or :class:`~astropy.io.fits.CompImageHDU`
+            Cube extension.
+        '''
+        fmt = self.control.cube_format
+        if fmt == 'int32':
+            step = 1 if step is None else step
+            q__byx = np.round(data__byx/step)
+            bad__byx = ~np.isfinite(q__byx)
+            q__byx = np.clip(np.where(bad__byx, 0, q__byx), _INT32_BLANK + 1, 2**31 - 1).astype('int32')
+            q__byx[bad__byx] = _INT32_BLANK
+            hdu = fits.ImageHDU(q__byx, cube_h)
+            self._cube_image_header(hdu.header, extname, flam_scale)
+            # BSCALE/BLANK are set after the HDU creation, otherwise astropy 
+            # would rescale the integer array
+            hdu.header['BSCALE'] = (step*flam_scale, 'Linear factor in scaling equation')
+            hdu.header['BLANK'] = (_INT32_BLANK, 'Value of non-finite pixels')
+        elif fmt in _CUBE_COMPRESSION_TYPES:
+            quantize_level = 16 if step is None else -step
+            hdu = fits.CompImageHDU(
+                data=data__byx.astype('float32'), header=cube_h,
+                compression_type=_CUBE_COMPRESSION_TYPES[fmt],
+                tile_shape=(1,) + data__byx.shape[1:],
+                quantize_level=quantize_level,
+            )
+            self._cube_image_header(hdu.header, extname, flam_scale)
+        else:
+            hdu = fits.ImageHDU(data__byx.astype(fmt), cube_h)
+            self._cube_image_header(hdu.header, extname, flam_scale)
+        return hdu
+
+    def _quantization_step(self):
+        '''
+        Quantization step of the DATA and ERRORS extensions. With 
+        ``--noise_quantization Q`` the step of each band is its median error
+        divided by Q. A FITS image extension has a single scaling, so the 
+        smallest step of all bands is used.
+
+        Returns
+        -------
+        float or None
+            Quantization step in `flam_scale` units.
+        '''
+        ctrl = self.control
+        if ctrl.noise_quantization is None or ctrl.cube_format in ['float64', 'float32']:
+            return None
+        eflam__byx = self.eflam__byx if self._check_errors() else None
+        steps__b = _noise_quantization_steps(self.flam__byx, eflam__byx, q=ctrl.noise_quantization)
+        print_level(f'noise quantization steps: {steps__b}', 2, ctrl.verbose)
+        return steps__b.min()
+
+    def write_cube(self, cube_path, prim_hdu, cube_h, flam_scale=None):
+        '''
+        Calculate the spectra and write the cube. The whole cube is 
+        created in memory and written to a temporary file renamed to
+        `cube_path` at the end.
+
+        Parameters
+        ----------
+        cube_path : str
+            Path to the output cube.
+
+        prim_hdu : :class:`~astropy.io.fits.PrimaryHDU`
+            Primary HDU of the cube.
+
+        cube_h : :class:`~astropy.io.fits.Header`
+            Header of the DATA and ERRORS extensions.
+
+        flam_scale : float, optional
+            Scaling factor for flux density, by default None.
+        '''
+        flam_scale = 1e-19 if flam_scale is None else flam_scale
+        ctrl = self.control
+
+        timer = self.timer
+
         # CREATE SPECTRA
-        self.spectra(flam_scale=flam_scale)
-
-        # DELETE BOGUS INFO
-        cube_h = self.headers__b[0].copy()
-        for _k in ['FILTER', 'MAGZP', 'NCOMBINE', 'GAIN', 'PSFFWHM']:
-            k = get_key(_k, get_author(cube_h))
-            if cube_h.get(k, None) is not None:
-                print_level(f'create_cube: deleting header key {k}', 2, ctrl.verbose)
-                del cube_h[k]    
-        
-        # UPDATE WCS IN HEADER
-        cube_h.update(self.stamp_WCS_to_cube_header(cube_h))
-        
-        # CREATE CUBE
-        prim_hdu = fits.PrimaryHDU()
-        prim_hdu.header['TILE'] = ctrl.tile
-        prim_hdu.header['GALAXY'] = self.galaxy.name
-        prim_hdu.header['SIZE'] = (ctrl.size, 'Side of the stamp in pixels')
-        for _k in ['X0TILE', 'Y0TILE']:
-            prim_hdu.header[_k] = cube_h[_k]
-        prim_hdu.header['RA'] = ctrl.ra
-        prim_hdu.header['DEC'] = ctrl.dec
-        flam_hdu = fits.ImageHDU(self.flam__byx, cube_h)
-        flam_hdu.header['EXTNAME'] = ('DATA', 'Name of the extension')
-        hdu_list = [prim_hdu, flam_hdu]
-        if self._check_errors():
-            eflam_hdu = fits.ImageHDU(self.eflam__byx, cube_h)
-            eflam_hdu.header['EXTNAME'] = ('ERRORS', 'Name of the extension')
-            hdu_list.append(eflam_hdu)
-        for hdu in hdu_list[1:]:
-            hdu.header['BSCALE'] = (flam_scale, 'Linear factor in scaling equation')
-            hdu.header['BZERO'] = (0, 'Zero point in scaling equation') 
-            hdu.header['BUNIT'] = (f'{self.flam_unit}', 'Physical units of the array values')       
+        with timer.span('spectra'):
+            self.spectra(flam_scale=flam_scale)
+            if self._append_bands is not None:
+                self._merge_cube_bands(prim_hdu, flam_scale)
+
+            step = self._quantization_step()
+            flam_hdu = self._cube_hdu(self.flam__byx, cube_h, 'DATA', flam_scale, step=step)
+            hdu_list = [prim_hdu, flam_hdu]
+            if self._check_errors():
+                eflam_hdu = self._cube_hdu(self.eflam__byx, cube_h, 'ERRORS', flam_scale, step=step)
+                hdu_list.append(eflam_hdu)
 
         # MASK WEIGHTS
-        hdu_list.append(self.create_weights_mask_hdu())
+        with timer.span('weights_mask'):
+            hdu_list.append(self.create_weights_mask_hdu())
             
         # MASK STARS
         '''
@@ -739,13 +1365,259 @@ class SCubes:
         '''
         
         # METADATA
-        meta_hdu = self.create_metadata_hdu()  # BinTableHDU
-        meta_hdu.header['EXTNAME'] = 'METADATA'
-        hdu_list.append(meta_hdu)
+        with timer.span('metadata'):
+            meta_hdu = self.create_metadata_hdu()  # BinTableHDU
+            meta_hdu.header['EXTNAME'] = 'METADATA'
+            hdu_list.append(meta_hdu)
+            zpcorr_ext = self._zpcorr_hdu() if self._store_zp else None
+            if zpcorr_ext is not None:
+                hdu_list.append(zpcorr_ext)
+
+        with timer.span('write'):
+            # the cube only appears complete at cube_path
+            tmp_path = f'{cube_path}.{getpid()}.tmp'
+            if ctrl.cube_container == 'hdf5':
+                write_scube_hdf5(tmp_path, hdu_list, chunks=ctrl.hdf5_chunks, compression=ctrl.hdf5_compression)
+            else:
+                fits.HDUList(hdu_list).writeto(tmp_path, overwrite=True)
+            self._replace_cube(tmp_path, cube_path)
+
+    def _replace_cube(self, tmp_path, cube_path):
+        '''
+        Move the written cube to `cube_path`, unless the write guard (e.g.
+        the claim of the galaxy at the batch job queue, see
+        :class:`scubes.batch.scubesml_batch`) raises an exception.
+        '''
+        if self._write_guard is not None:
+            try:
+                self._write_guard()
+            except BaseException:
+                remove(tmp_path)
+                raise
+        replace(tmp_path, cube_path)
+
+    def _band_spectra(self, i, flam_scale=None, errors=True):
+        '''
+        Calculate the flux density (and its error) image of the i-th band.
+
+        Parameters
+        ----------
+        i : int
+            Band index.
+
+        flam_scale : float, optional
+            Scaling factor for flux density, by default None.
+
+        errors : bool, optional
+            Also calculates the errors, by default True.
+
+        Returns
+        -------
+        tuple of :class:`numpy.ndarray`
+            Flux density and error images (None if `errors` is False).
+        '''
+        flam_scale = 1e-19 if flam_scale is None else flam_scale
+        # from e- counts to erg/s/cm/cm/A
+        fnu2flam = (self.fnu_unit*const.c/self.wl__b[i]**2).to(self.flam_unit).value
+        f = self._f0_map(i)*fnu2flam/flam_scale
+        data__yx = self.stamps__b[i].data.astype('float64')
+        flam__yx = f*data__yx
+        eflam__yx = None
+        if errors:
+            weidata__yx = np.abs(self.wstamps__b[i].data)
+            eflam__yx = f*np.sqrt(1/weidata__yx + np.abs(data__yx)/self.gain__b[i])
+        return flam__yx, eflam__yx
+
+    def write_cube_streaming(self, cube_path, prim_hdu, cube_h, flam_scale=None):
+        '''
+        Calculate the spectra and write the cube one band at a time, in
+        order to keep the peak memory bounded by a few band images. The DATA
+        extension is streamed directly to the cube file while the ERRORS 
+        planes are kept in a temporary memory-mapped file until DATA is 
+        complete. Each stamp is released from memory after use. The
+        ``spectra`` stage timing includes the writing of the DATA planes.
+
+        Parameters
+        ----------
+        cube_path : str
+            Path to the output cube.
+
+        prim_hdu : :class:`~astropy.io.fits.PrimaryHDU`
+            Primary HDU of the cube.
+
+        cube_h : :class:`~astropy.io.fits.Header`
+            Header of the DATA and ERRORS extensions.
+
+        flam_scale : float, optional
+            Scaling factor for flux density, by default None.
+        '''
+        flam_scale = 1e-19 if flam_scale is None else flam_scale
+        ctrl = self.control
+
+        #Jy to to erg/s/cm/cm/Hz
+        Jy2fnu = - 2.5*(np.log10(3631) - 23)  # 48.5999343777177...
+        self.m0__b = self._m0()  # mAB
+        self.f0__b = np.power(10, -1/2.5*(Jy2fnu + self.m0__b))
+        errors = self._check_errors()
+        if errors:
+            self.gain__b = self._gain()
+
+        n_b = len(self.stamps__b)
+        h0 = self.stamps__b[0].header
+        shape = (n_b, h0['NAXIS2'], h0['NAXIS1'])
+
+        # DATA AND ERRORS HEADER
+        header = fits.Header()
+        header['XTENSION'] = 'IMAGE'
+        header['BITPIX'] = -32 if ctrl.cube_format == 'float32' else -64
+        header['NAXIS'] = 3
+        header['NAXIS1'] = shape[2]
+        header['NAXIS2'] = shape[1]
+        header['NAXIS3'] = shape[0]
+        header['PCOUNT'] = 0
+        header['GCOUNT'] = 1
+        for card in cube_h.cards:
+            if card.keyword not in header and card.keyword not in ['SIMPLE', 'EXTEND', 'XTENSION']:
+                header.append(card)
+
+        tmp_path = f'{cube_path}.{getpid()}.tmp'
+        err_path = f'{cube_path}.errors.{getpid()}.tmp'
+        prim_hdu.writeto(tmp_path, overwrite=True)
+        shdu = fits.StreamingHDU(tmp_path, self._cube_image_header(header.copy(), 'DATA', flam_scale))
+        eflam__byx = np.memmap(err_path, dtype='>f8', mode='w+', shape=shape) if errors else None
+        wmask__yx = np.zeros(shape[1:], dtype='int64')
+        timer = self.timer
+        with timer.span('spectra'):
+            for i in range(n_b):
+                print_level(f'write_cube_streaming: band {i + 1}/{n_b}', 2, ctrl.verbose)
+                flam__yx, eflam__yx = self._band_spectra(i, flam_scale=flam_scale, errors=errors)
+                shdu.write(flam__yx.astype(ctrl.cube_format))
+                if errors:
+                    eflam__byx[i] = eflam__yx
+                wmask__yx += (self.wstamps__b[i].data < 0)
+                self.stamps__b[i].release()
+                self.wstamps__b[i].release()
+            shdu.close()
+
+        # MASK WEIGHTS
+        with timer.span('weights_mask'):
+            wmask_hdu = fits.ImageHDU(wmask__yx)
+            wmask_hdu.header['EXTNAME'] = ('WEIMASK', f'Sum of negative weight pixels (from 1 to {n_b})')
+
+        # METADATA
+        with timer.span('metadata'):
+            meta_hdu = self.create_metadata_hdu()  # BinTableHDU
+            meta_hdu.header['EXTNAME'] = 'METADATA'
+            zpcorr_ext = self._zpcorr_hdu() if self._store_zp else None
+
+        with timer.span('write'):
+            if errors:
+                eflam__byx.flush()
+                shdu = fits.StreamingHDU(tmp_path, self._cube_image_header(header.copy(), 'ERRORS', flam_scale))
+                for i in range(n_b):
+                    shdu.write(np.asarray(eflam__byx[i]).astype(ctrl.cube_format))
+                shdu.close()
+                del eflam__byx
+                remove(err_path)
+            fits.append(tmp_path, wmask_hdu.data, wmask_hdu.header)
+            fits.append(tmp_path, meta_hdu.data, meta_hdu.header)
+            if zpcorr_ext is not None:
+                fits.append(tmp_path, zpcorr_ext.data, zpcorr_ext.header)
+            self._replace_cube(tmp_path, cube_path)
+
+    def create_cube(self, flam_scale=None, download=True):
+        '''
+        Create a data cube from S-PLUS galaxy stamps.
+
+        Parameters
+        ----------
+        flam_scale : float, optional
+            Scaling factor for flux density, by default None.
+
+        download : bool, optional
+            If False, skips :meth:`download_data` (i.e. the data was already 
+            downloaded), by default True.
+
+        Raises
+        ------
+        OSError
+            Raises an error if the cube already exists and redo is not specified.
+        '''        
+        flam_scale = 1e-19 if flam_scale is None else flam_scale
+        ctrl = self.control
+
+        # CUBE CHECK
+        self.check_cube()
+        cube_path = self.cube_path
+        
+        timer = self.timer
+
+        # DOWNLOAD AND CALIBRATE DATA
+        if download:
+            with timer.span('download'):
+                self.download_data()
+        with timer.span('calibration'):
+            self.calibrate_stamps()
+        
+        with timer.span('headers'):
+            # DELETE BOGUS INFO
+            cube_h = self.headers__b[0].copy()
+            for _k in ['FILTER', 'MAGZP', 'NCOMBINE', 'GAIN', 'PSFFWHM']:
+                k = get_key(_k, get_author(cube_h))
+                if cube_h.get(k, None) is not None:
+                    print_level(f'create_cube: deleting header key {k}', 2, ctrl.verbose)
+                    del cube_h[k]    
+            
+            # UPDATE WCS IN HEADER
+            cube_h.update(self.stamp_WCS_to_cube_header(cube_h))
+        
+        # CREATE CUBE
+        prim_hdu = fits.PrimaryHDU()
+        prim_hdu.header['TILE'] = ctrl.tile
+        prim_hdu.header['GALAXY'] = self.galaxy.name
+        prim_hdu.header['SIZE'] = (ctrl.size, 'Side of the stamp in pixels')
+        for _k in ['X0TILE', 'Y0TILE']:
+            prim_hdu.header[_k] = cube_h[_k]
+        prim_hdu.header['RA'] = ctrl.ra
+        prim_hdu.header['DEC'] = ctrl.dec
+        zp_source = 'STAMPS' if self.zp_table is None else basename(self.zp_table)
+        zpcorr = self.dzp__byx is not None
+        known_cal = True
+        self._store_zp = getattr(ctrl, 'store_zp', False)
+        if self._append_bands is not None:
+            known_cal = self._check_append_calibration(zp_source, zpcorr)
+            # the calibration of the appended bands is stored if the cube has it
+            if self._store_zp and not self._append_cal['magzp']:
+                print_level(f'--store_zp: {cube_path} has no stored zero points, rebuild it with --redo to store them')
+            elif self._append_cal['magzp'] and not self._store_zp:
+                print_level(f'{cube_path}: storing the zero points of the appended bands')
+            self._store_zp = self._append_cal['magzp']
+        if known_cal:
+            prim_hdu.header['ZPSOURCE'] = (zp_source, 'Source of the MAGZP of the cube')
+            prim_hdu.header['ZPCORR'] = (zpcorr, 'Per-pixel ZP correction applied')
 
         # SAVE CUBE
         print_level(f'writting cube {cube_path}', 1, ctrl.verbose)
-        fits.HDUList(hdu_list).writeto(cube_path, overwrite=True)
+        streaming = ctrl.streaming
+        if streaming and ctrl.cube_format not in ['float64', 'float32']:
+            print_level(f'--streaming: {ctrl.cube_format} cube format not supported, writting the cube in memory')
+            streaming = False
+        if streaming and ctrl.cube_container == 'hdf5':
+            print_level('--streaming: hdf5 cube not supported, writting the cube in memory')
+            streaming = False
+        if streaming and (self._append_bands is not None):
+            print_level('--streaming: --append_bands not supported, writting the cube in memory')
+            streaming = False
+        if ctrl.cube_container == 'hdf5' and ctrl.cube_format not in ['float64', 'float32', 'int32']:
+            print_level(f'hdf5 cube: {ctrl.cube_format} stored as float32 with the HDF5 chunk compression')
+        if streaming:
+            self.write_cube_streaming(cube_path, prim_hdu, cube_h, flam_scale=flam_scale)
+        else:
+            self.write_cube(cube_path, prim_hdu, cube_h, flam_scale=flam_scale)
         print_level(f'Cube successfully created!')
 
-        self.remove_downloaded_data() if ctrl.remove_downloaded_data else None
\ No newline at end of file
+        if ctrl.write_stamps and not ctrl.remove_downloaded_data:
+            self.write_stamps()
+
+        self.remove_downloaded_data() if ctrl.remove_downloaded_data else None
+        self.write_timings()
\ No newline at end of file
@@ -2,17 +2,14 @@ import sys
 from os import getcwd
 from shutil import which
 
-from . import __author__, __version__, __filters_table__  #, __zp_cat__, __zpcorr_path__
+from . import __author__, __version__  #, __zp_cat__, __zpcorr_path__
 
 from .constants import BANDS
 
 from .utilities.io import print_level
-from .utilities.args import create_parser
-
-SPLUS_MOTD_TOP = '┌─┐   ┌─┐┬ ┬┌┐ ┌─┐┌─┐ '
-SPLUS_MOTD_MID = '└─┐───│  │ │├┴┐├┤ └─┐ '
-SPLUS_MOTD_BOT = '└─┘   └─┘└─┘└─┘└─┘└─┘ '
-SPLUS_MOTD_SEP = '----------------------'
+from .utilities.ratelimit import RATE_LIMIT_FILE
+from .utilities.session import TOKEN_CACHE_FILE
+from .utilities.args import create_parser, SPLUS_MOTD_TOP, SPLUS_MOTD_MID, SPLUS_MOTD_BOT, SPLUS_MOTD_SEP
 
 SCUBES_PROG_DESC = f'''
 {SPLUS_MOTD_TOP} | Create S-PLUS galaxies data cubes, a.k.a. S-CUBES. 
@@ -37,6 +34,7 @@ Note that *10h37m2.5s* is a totally different angle from *10:37:2.5*
 SCUBES_ARGS = {
     # optional arguments
     'redo': ['r', dict(action='store_true', default=False, help='Enable redo mode to overwrite final cubes.')],
+    'append_bands': ['', dict(action='store_true', default=False, help='Add the bands of --bands missing from an existing cube, without downloading or recalculating the bands of the cube.')],
     'clean': ['c', dict(action='store_true', default=False, help='Clean intermediate files after processing.')],
     'force': ['f', dict(action='store_true', default=False, help='Force overwrite of existing files.')],
     'bands': ['b', dict(default=BANDS, nargs='+', help='List of S-PLUS bands (space separated).')],
@@ -47,9 +45,34 @@ SCUBES_ARGS = {
     'debug': ['D', dict(action='store_true', default=False, help='Enable debug mode.')],
     'username': ['U', dict(default=None, help='S-PLUS Cloud username.')],
     'password': ['P', dict(default=None, help='S-PLUS Cloud password.')],
-    'det_img': ['I', dict(action='store_true', default=False, help='Downloads detection image for the stamp. Needed if --mask_stars is active.')],
+    'token_cache': ['', dict(default=None, nargs='?', const=TOKEN_CACHE_FILE, metavar='FILE', help=f'Cache the S-PLUS Cloud token at FILE (readable only by the user, default FILE: {TOKEN_CACHE_FILE}), so the processes of a batch share a login.')],
+    'det_img': ['I', dict(action='store_true', default=False, help='Creates the G+R+I+Z detection image of the stamp. Needed if --mask_stars is active.')],
+    'download_images': ['', dict(action='store_true', default=False, help='Download the detection and Lupton RGB images from the data source instead of building them from the stamps.')],
     'remove_downloaded_data': ['R', dict(action='store_true', default=False, help='Remove the downloaded data from splusdata at the end of the run.')],
+    'write_stamps': ['', dict(action='store_true', default=False, help='Write the stamps header updates (e.g. MAGZP) back to the downloaded stamps.')],
+    'streaming': ['', dict(action='store_true', default=False, help='Low-memory mode: calculate and write the cube one band at a time.')],
+    'timings': ['', dict(action='store_true', default=False, help='Record the wall and CPU time, peak memory and I/O of each stage of the build in GALAXY_timings.jsonl (JSON lines) next to the cube.')],
+    'profile': ['', dict(default=None, nargs='+', metavar='STAGE', help='Dump a cProfile of these stages (download, calibration, headers, spectra, weights_mask, metadata, write or all) to GALAXY_STAGE.prof next to the cube. Implies --timings.')],
+    'zpcorr': ['', dict(action='store_true', default=False, help='Apply the per-pixel zero-point correction maps (experimental, waiting S-PLUS iDR6). Not applied to stamps which already have MAGZP.')],
+    'store_zp': ['', dict(action='store_true', default=False, help='Store the zero points (and the per-pixel correction maps of --zpcorr) used to calibrate the cube, so scubes_recalibrate can recalibrate it without downloading the stamps.')],
+    'cube_format': ['', dict(default='float64', choices=['float64', 'float32', 'int32', 'rice', 'hcompress', 'gzip'], help='Storage format of the DATA and ERRORS extensions: float64, float32, int32 (quantized with BSCALE) or a tile-compressed HDU (rice, hcompress or gzip).')],
+    'noise_quantization': ['', dict(default=None, type=float, metavar='Q', help='Noise-aware quantization: the quantization step is the median error of each band divided by Q. Used by the int32 and tile-compressed formats.')],
+    'cube_container': ['', dict(default='fits', choices=['fits', 'hdf5'], help='File format of the cube. hdf5 writes a chunked HDF5 cube (requires h5py) readable by read_scube.')],
+    'hdf5_chunks': ['', dict(default=[0, 32, 32], type=int, nargs=3, metavar=('B', 'Y', 'X'), help='Chunk shape (band, y, x) of the HDF5 cube. 0 means the whole axis.')],
+    'hdf5_compression': ['', dict(default='gzip', choices=['gzip', 'lzf', 'none'], help='Per-chunk compression of the HDF5 cube.')],
     'data_release': ['d', dict(default='dr4', type=str, help='Select S-PLUS Data Release')],
+    'download_workers': ['', dict(default=1, type=int, help='Maximum number of simultaneous stamp downloads of the process. The downloads start at this number and adapt to the latency and the failures of the requests. Unlike --rate_limit, it is not shared with the other scubes processes of the host.')],
+    'download_timeout': ['', dict(default=60, type=float, help='Timeout in seconds of each stamp download request.')],
+    'download_retries': ['', dict(default=2, type=int, help='Number of retries of a failed stamp download request (after an exponential backoff with jitter).')],
+    'rate_limit': ['', dict(default=None, type=float, help='Maximum data-source requests per second, shared by all the scubes processes of the host using the same --rate_limit_file. Unlimited by default.')],
+    'rate_burst': ['', dict(default=None, type=float, help='Maximum burst of requests of --rate_limit (default: the rate).')],
+    'rate_limit_file': ['', dict(default=RATE_LIMIT_FILE, help='State file of the --rate_limit budget shared by the processes of the host.')],
+    'download_stats': ['', dict(default=None, metavar='FILE', help='Export the statistics of the downloads (bytes, latency histograms, throughput, retries and failures) to FILE: a Prometheus textfile if FILE ends with .prom, JSON otherwise.')],
+    'cache_dir': ['', dict(default=None, help='Directory of the shared stamps cache. The cache is disabled if not set.')],
+    'cache_max_size': ['', dict(default=20, type=float, help='Disk budget of the stamps cache in GB.')],
+    'data_source': ['', dict(default='cloud', choices=['cloud', 'tiles', 'mock'], help='Backend used to retrieve the stamps.')],
+    'tiles_dir': ['', dict(default=None, help='Directory with the full-field S-PLUS tiles used by --data_source=tiles.')],
+    'mock_url': ['', dict(default=None, help='URL of the mock S-PLUS Cloud server used by --data_source=mock. If not set, a local server is started.')],
 
     #'zpcorr_dir': ['Z', dict(default=__zpcorr_path__, help='Zero-point correction directory.')],
     #'zp_table': ['z', dict(default=__zp_cat__, help='Zero-point table.')],
@@ -119,12 +142,13 @@ def scubes():
     -------
     None
     '''
-    from .core import SCubes
-
     parser = create_parser(args_dict=SCUBES_ARGS, program_description=SCUBES_PROG_DESC)
     # ADD VERSION OPTION
     parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
     args = scubes_argparse(parser.parse_args(args=sys.argv[1:]))
+
+    from .core import SCubes
+
     scubes = SCubes(args)
     scubes.create_cube(flam_scale=None)
 
@@ -140,19 +164,44 @@ SCUBESML_PROG_DESC = f'''
 SCUBESML_ARGS = {
     # optional arguments
     'redo': ['r', dict(action='store_true', default=False, help='Enable redo mode to overwrite final cubes.')],
+    'append_bands': ['', dict(action='store_true', default=False, help='Add the bands of --bands missing from an existing cube, without downloading or recalculating the bands of the cube.')],
     'clean': ['c', dict(action='store_true', default=False, help='Clean intermediate files after processing.')],
     'force': ['f', dict(action='store_true', default=False, help='Force overwrite of existing files.')],
     'bands': ['b', dict(default=BANDS, nargs='+', help='List of S-PLUS bands (space separated).')],
     'size_multiplicator': ['S', dict(default=10, type=float, help='Factor to multiply the SIZE__pix value of the masterlist to create the galaxy size. If size is a odd number, the program will choose the closest even integer.')],
     'min_size': ['m', dict(default=200, type=int, help='Minimal size of the cube in pixels. If size negative, uses the original value of size calculation.')],
     'data_release': ['d', dict(default='dr4', type=str, help='Select S-PLUS Data Release')],
+    'download_workers': ['', dict(default=1, type=int, help='Maximum number of simultaneous stamp downloads of the process. The downloads start at this number and adapt to the latency and the failures of the requests. Unlike --rate_limit, it is not shared with the other scubes processes of the host.')],
+    'download_timeout': ['', dict(default=60, type=float, help='Timeout in seconds of each stamp download request.')],
+    'download_retries': ['', dict(default=2, type=int, help='Number of retries of a failed stamp download request (after an exponential backoff with jitter).')],
+    'rate_limit': ['', dict(default=None, type=float, help='Maximum data-source requests per second, shared by all the scubes processes of the host using the same --rate_limit_file. Unlimited by default.')],
+    'rate_burst': ['', dict(default=None, type=float, help='Maximum burst of requests of --rate_limit (default: the rate).')],
+    'rate_limit_file': ['', dict(default=RATE_LIMIT_FILE, help='State file of the --rate_limit budget shared by the processes of the host.')],
+    'download_stats': ['', dict(default=None, metavar='FILE', help='Export the statistics of the downloads (bytes, latency histograms, throughput, retries and failures) to FILE: a Prometheus textfile if FILE ends with .prom, JSON otherwise.')],
+    'cache_dir': ['', dict(default=None, help='Directory of the shared stamps cache. The cache is disabled if not set.')],
+    'cache_max_size': ['', dict(default=20, type=float, help='Disk budget of the stamps cache in GB.')],
+    'data_source': ['', dict(default='cloud', choices=['cloud', 'tiles', 'mock'], help='Backend used to retrieve the stamps.')],
+    'tiles_dir': ['', dict(default=None, help='Directory with the full-field S-PLUS tiles used by --data_source=tiles.')],
+    'mock_url': ['', dict(default=None, help='URL of the mock S-PLUS Cloud server used by --data_source=mock. If not set, a local server is started.')],
     'work_dir': ['w', dict(default=getcwd(), help='Working directory.')],
     'output_dir': ['o', dict(default=getcwd(), help='Output directory.')],
     'verbose': ['v', dict(action='count', default=0, help='Verbosity level.')],
     'debug': ['D', dict(action='store_true', default=False, help='Enable debug mode.')],
     'username': ['U', dict(default=None, help='S-PLUS Cloud username.')],
     'password': ['P', dict(default=None, help='S-PLUS Cloud password.')],
+    'token_cache': ['', dict(default=None, nargs='?', const=TOKEN_CACHE_FILE, metavar='FILE', help=f'Cache the S-PLUS Cloud token at FILE (readable only by the user, default FILE: {TOKEN_CACHE_FILE}), so the processes of a batch share a login.')],
     'remove_downloaded_data': ['R', dict(action='store_true', default=False, help='Remove the downloaded data from splusdata at the end of the run.')],
+    'write_stamps': ['', dict(action='store_true', default=False, help='Write the stamps header updates (e.g. MAGZP) back to the downloaded stamps.')],
+    'streaming': ['', dict(action='store_true', default=False, help='Low-memory mode: calculate and write the cube one band at a time.')],
+    'timings': ['', dict(action='store_true', default=False, help='Record the wall and CPU time, peak memory and I/O of each stage of the build in GALAXY_timings.jsonl (JSON lines) next to the cube.')],
+    'profile': ['', dict(default=None, nargs='+', metavar='STAGE', help='Dump a cProfile of these stages (download, calibration, headers, spectra, weights_mask, metadata, write or all) to GALAXY_STAGE.prof next to the cube. Implies --timings.')],
+    'zpcorr': ['', dict(action='store_true', default=False, help='Apply the per-pixel zero-point correction maps (experimental, waiting S-PLUS iDR6). Not applied to stamps which already have MAGZP.')],
+    'store_zp': ['', dict(action='store_true', default=False, help='Store the zero points (and the per-pixel correction maps of --zpcorr) used to calibrate the cube, so scubes_recalibrate can recalibrate it without downloading the stamps.')],
+    'cube_format': ['', dict(default='float64', choices=['float64', 'float32', 'int32', 'rice', 'hcompress', 'gzip'], help='Storage format of the DATA and ERRORS extensions: float64, float32, int32 (quantized with BSCALE) or a tile-compressed HDU (rice, hcompress or gzip).')],
+    'noise_quantization': ['', dict(default=None, type=float, metavar='Q', help='Noise-aware quantization: the quantization step is the median error of each band divided by Q. Used by the int32 and tile-compressed formats.')],
+    'cube_container': ['', dict(default='fits', choices=['fits', 'hdf5'], help='File format of the cube. hdf5 writes a chunked HDF5 cube (requires h5py) readable by read_scube.')],
+    'hdf5_chunks': ['', dict(default=[0, 32, 32], type=int, nargs=3, metavar=('B', 'Y', 'X'), help='Chunk shape (band, y, x) of the HDF5 cube. 0 means the whole axis.')],
+    'hdf5_compression': ['', dict(default='gzip', choices=['gzip', 'lzf', 'none'], help='Per-chunk compression of the HDF5 cube.')],
 
     #'zpcorr_dir': ['Z', dict(default=__zpcorr_path__, help='Zero-point correction directory.')],
     #'zp_table': ['z', dict(default=__zp_cat__, help='Zero-point table.')],
@@ -184,6 +233,7 @@ def scubesml_argparse(args):
 
     args.mask_stars = False
     args.det_img = False
+    args.download_images = False
 
     try:
         args.ml = ascii.read(args.masterlist)
@@ -191,13 +241,43 @@ def scubesml_argparse(args):
         print_level(f'{args.masterlist}: unable to read file')
         sys.exit(1)
     
-    # Retrieve scubes positional arguments
-    mlcut = args.ml[args.ml['SNAME'] == args.galaxy]
+    return ml_galaxy_args(args, args.galaxy)
+
+def ml_galaxy_args(args, galaxy):
+    '''
+    Retrieve the `scubes` positional arguments (tile, ra, dec and size) of 
+    `galaxy` from the masterlist read at `args.ml`.
+
+    Parameters
+    ----------
+    args : :class:`argparse.Namespace`
+        Command-line arguments with the masterlist at `args.ml`.
+
+    galaxy : str
+        Galaxy's masterlist nickname (SNAME).
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        A copy of `args` with the galaxy's arguments.
+
+    Raises
+    ------
+    ValueError
+        If `galaxy` is not present at the masterlist.
+    '''
+    from copy import copy
+
+    mlcut = args.ml[args.ml['SNAME'] == galaxy]
+    if len(mlcut) == 0:
+        raise ValueError(f'masterlist: {galaxy}: missing SNAME information')
+    args = copy(args)
+    args.galaxy = galaxy
     args.tile = mlcut['FIELD'][0]
     args.ra = mlcut['RA__deg'][0]
     args.dec = mlcut['DEC__deg'][0]
     min_size = args.min_size
-    args.size = max(round(args.size_multiplicator*float(mlcut['SIZE__pix'])/2)*2, min_size)
+    args.size = max(round(args.size_multiplicator*float(mlcut['SIZE__pix'][0])/2)*2, min_size)
 
     return args
 
@@ -216,13 +296,14 @@ def scubesml():
     None
     '''
 
-    from .core import SCubes
-    from .utilities.utils import ml2header_updheader
-
     parser = create_parser(args_dict=SCUBESML_ARGS, program_description=SCUBESML_PROG_DESC)
     # ADD VERSION OPTION
     parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
     args = scubesml_argparse(parser.parse_args(args=sys.argv[1:]))
+
+    from .core import SCubes
+    from .utilities.utils import ml2header_updheader
+
     scubes = SCubes(args)
     scubes.create_cube(flam_scale=None)
 
@@ -265,4 +346,142 @@ def scubes_filters():
 
     __filters_table__.round(decimals=args.decimals)
 
-    __filters_table__.pprint_all()
\ No newline at end of file
+    __filters_table__.pprint_all()
+
+SCUBESML_BATCH_PROG_DESC = f'''
+{SPLUS_MOTD_TOP} | scubesml_batch entry-point script:
+{SPLUS_MOTD_MID} | Create S-PLUS galaxies data cubes, a.k.a. S-CUBES
+{SPLUS_MOTD_BOT} | of all (or a subset of) the masterlist galaxies
+{SPLUS_MOTD_SEP} + in a single process.
+
+ {__author__}
+'''
+
+SCUBESML_BATCH_ARGS = {k: v for k, v in SCUBESML_ARGS.items() if k not in ['galaxy', 'masterlist']}
+SCUBESML_BATCH_ARGS.update({
+    # optional arguments
+    'galaxies': ['g', dict(default=None, nargs='+', metavar='GALAXY_SNAME', help="Galaxies' masterlist nicknames to process. Defaults to all the masterlist.")],
+    'prefetch': ['', dict(default=2, type=int, help='Maximum number of downloaded galaxies waiting to be processed.')],
+    'download_galaxies': ['', dict(default=1, type=int, help='Number of galaxies downloaded simultaneously.')],
+    'report': ['', dict(default=None, help='CSV file to record the result of each galaxy.')],
+    'incremental': ['', dict(action='store_true', default=False, help='Only build the stale products of each galaxy: the fingerprints of the stamps, zero points, parameters and masterlist row used are recorded at GALAXY_build.json next to the cube.')],
+    'splots': ['', dict(action='store_true', default=False, help='Also create the splots images of each cube (next to the cube).')],
+    'mask_args': ['', dict(default=None, metavar='FILE', help='Also create the masked cube of each galaxy (next to the cube) with scube_mask @FILE --no_interact.')],
+    'manifest': ['', dict(default=None, metavar='FILE', help='Record the state of each stage of each galaxy at the durable job manifest FILE (JSON lines).')],
+    'resume': ['', dict(action='store_true', default=False, help='Continue the batch recorded at --manifest: only the galaxies not finished (or failed) are processed, from their first stale stage (implies --incremental).')],
+    'retry_failed': ['', dict(action='store_true', default=False, help='Only process the galaxies failed at --manifest (implies --incremental).')],
+    'queue_dir': ['', dict(default=None, metavar='DIR', help='Take the galaxies from the job queue at DIR (on a shared filesystem), shared by all the scubesml_batch workers of the same masterlist (implies --incremental).')],
+    'lease': ['', dict(default=600, type=float, metavar='SECONDS', help='Lease of a claim of the --queue_dir job queue. The claims of a worker not refreshed for SECONDS (e.g. crashed) are taken over by other workers.')],
+    'max_claims': ['', dict(default=None, type=int, metavar='N', help='Maximum number of galaxies of the --queue_dir job queue claimed by this worker at the same time.')],
+
+    # positional arguments
+    'masterlist': ['pos', dict(metavar='MASTERLIST', help='Path to masterlist file')]
+})
+
+def scubesml_batch():
+    '''
+    Entry-point function for creating S-PLUS galaxy data cubes (S-CUBES)
+    of a list of galaxies from the masterlist in a single process. See
+    :class:`scubes.batch.scubesml_batch`.
+
+    Raises
+    ------
+    SystemExit
+        If masterlist not found or if some galaxy failed.
+
+    Returns
+    -------
+    None
+    '''
+    parser = create_parser(args_dict=SCUBESML_BATCH_ARGS, program_description=SCUBESML_BATCH_PROG_DESC)
+    parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
+    args = parser.parse_args(args=sys.argv[1:])
+
+    from astropy.io import ascii
+
+    from .batch import scubesml_batch as _batch
+
+    args.mask_stars = False
+    args.det_img = False
+    args.download_images = False
+    try:
+        args.ml = ascii.read(args.masterlist)
+    except:
+        print_level(f'{args.masterlist}: unable to read file')
+        sys.exit(1)
+
+    if (args.resume or args.retry_failed) and (args.manifest is None):
+        print_level('--resume and --retry_failed require --manifest')
+        sys.exit(1)
+
+    batch = _batch(args, galaxies=args.galaxies, prefetch=args.prefetch, download_threads=args.download_galaxies)
+    results = batch.run()
+    count = batch.summary()
+
+    if args.report is not None:
+        import csv
+
+        with open(args.report, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(['SNAME', 'status', 'cube_path', 'download_time', 'build_time', 'error'])
+            for r in results:
+                w.writerow([r.galaxy, r.status, r.cube_path, r.times.get('download'), r.times.get('build'), r.error])
+
+    if count['failed']:
+        sys.exit(1)
+
+SCUBES_RECALIBRATE_PROG_DESC = f'''
+{SPLUS_MOTD_TOP} | scubes_recalibrate entry-point script:
+{SPLUS_MOTD_MID} | Recalibrates, in place, the DATA and ERRORS of
+{SPLUS_MOTD_BOT} | cubes created with --store_zp with a new zero-points
+{SPLUS_MOTD_SEP} + table, without downloading the stamps.
+
+ {__author__}
+'''
+
+SCUBES_RECALIBRATE_ARGS = {
+    # optional arguments
+    'data_release': ['d', dict(default='dr4', type=str, help='Select S-PLUS Data Release')],
+    'zp_table': ['z', dict(default=None, help='Zero-points table (CSV with the Field and ZP_<band> columns). Defaults to the table of --data_release.')],
+    'zpcorr': ['', dict(action='store_true', default=False, help='Apply the per-pixel zero-point correction maps. Without it, the per-pixel correction of the cubes is removed.')],
+    'zpcorr_dir': ['', dict(default=None, help='Directory with the per-pixel zero-point correction grids (SPLUS_<band>_offsets_grid.npy). Defaults to the grids of --data_release.')],
+    'verbose': ['v', dict(action='count', default=0, help='Verbosity level.')],
+
+    # positional arguments
+    'cubes': ['pos', dict(metavar='CUBE', nargs='+', help='Cubes created with --store_zp.')],
+}
+
+def scubes_recalibrate():
+    '''
+    Entry-point function to recalibrate S-PLUS galaxy data cubes (S-CUBES)
+    created with ``--store_zp``. See :func:`scubes.recalibrate.recalibrate_scube`.
+
+    Raises
+    ------
+    SystemExit
+        If some cube failed.
+
+    Returns
+    -------
+    None
+    '''
+    parser = create_parser(args_dict=SCUBES_RECALIBRATE_ARGS, program_description=SCUBES_RECALIBRATE_PROG_DESC)
+    parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
+    args = parser.parse_args(args=sys.argv[1:])
+
+    from .recalibrate import recalibrate_scube
+
+    failed = 0
+    for cube in args.cubes:
+        try:
+            recalibrate_scube(
+                cube, zp_table=args.zp_table, data_release=args.data_release, 
+                zpcorr=args.zpcorr, zpcorr_dir=args.zpcorr_dir, verbose=args.verbose,
+            )
+            print_level(f'{cube}: recalibrated')
+        except (OSError, KeyError, ValueError) as e:
+            print_level(f'{cube}: {e}')
+            failed += 1
+    if failed:
+        print_level(f'{failed} of {len(args.cubes)} cubes failed')
+        sys.exit(1)
@@ -5,13 +5,11 @@ from astropy.io import fits
 from .control import control
 from os.path import join, isfile
 from copy import deepcopy as copy
-from matplotlib import pyplot as plt
 
 from .headers import get_key, get_author
 from .constants import SPLUS_DEFAULT_SEXTRACTOR_CONFIG, SPLUS_DEFAULT_SEXTRACTOR_PARAMS
 
 from .utilities.io import print_level
-from .utilities.plots import plot_mask
 from .utilities.stats import robustStat
 from .utilities.daofinder import DAOregions
 from .utilities.sextractor import unmask_sewregions,SEWregions, run_sex
@@ -129,6 +127,8 @@ class maskStars:
         
         masked_ddata, resulting_mask = unmask_sewregions(data=data, sewregions=sewregions, size=ctrl.size, unmask_stars=unmask_stars, verbose=ctrl.verbose)
 
+        from .utilities.plots import plot_mask
+
         self.fig = plot_mask(
             detection_image=self.detection_image,
             lupton_rgb=self.lupton_rgb, 
@@ -159,6 +159,8 @@ class maskStars:
         resulting_mask : ndarray
             Resulting mask.
         '''        
+        from matplotlib import pyplot as plt
+
         ctrl = self.control
 
         resulting_mask = self.calc_masks(input_config=input_config, output_parameters=output_parameters, unmask_stars=None, run_DAOfinder=False, save_fig=True)
@@ -0,0 +1,220 @@
+import numpy as np
+from astropy.io import fits
+from os.path import basename
+
+from . import __dr4_zp_cat__, __dr5_zp_cat__
+
+from .headers import get_author
+from .constants import FILTER_NAMES_FITS, METADATA_NAMES
+from .zeropoints import get_zero_points_index, get_zpcorr_spline, zpcorr_stamp
+
+from .utilities.io import print_level
+from .utilities.h5scube import is_hdf5_scube, open_scube, scube_hdf5
+
+def zpcorr_hdu(dzp__byx):
+    '''
+    ZPCORR extension of a cube: the per-pixel ZP correction maps relative
+    to the MAGZP of each band (see ``--store_zp``).
+
+    Parameters
+    ----------
+    dzp__byx : :class:`numpy.ndarray`
+        Per-pixel ZP correction maps in magnitudes.
+
+    Returns
+    -------
+    :class:`~astropy.io.fits.ImageHDU`
+        ZPCORR extension.
+    '''
+    hdu = fits.ImageHDU(np.asarray(dzp__byx, dtype='float32'))
+    hdu.header['EXTNAME'] = ('ZPCORR', 'Per-pixel ZP correction relative to MAGZP')
+    hdu.header['BUNIT'] = ('mag', 'Physical units of the array values')
+    return hdu
+
+def read_calibration(filename):
+    '''
+    Read the calibration stored in a cube created with ``--store_zp``.
+    Only the headers, the METADATA and the ZPCORR extension are read.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the cube (FITS or HDF5).
+
+    Returns
+    -------
+    dict
+        ``tile``, ``x0tile``, ``y0tile``, ``author``, ``shape`` (of the
+        band images), ``bands`` (FITS names), ``m0__b`` (MAGZP of each
+        band) and ``dzp__byx`` (per-pixel ZP correction maps or None).
+
+    Raises
+    ------
+    ValueError
+        If the cube has no stored zero points (or they are missing for some
+        band), if its per-pixel ZP correction maps are missing or if its
+        DATA is tile-compressed.
+    '''
+    with open_scube(filename) as hdul:
+        h = hdul['PRIMARY'].header
+        data_hdu = hdul['DATA']
+        if isinstance(data_hdu, fits.CompImageHDU):
+            raise ValueError('tile-compressed cube: recalibration not supported, rebuild it with --redo')
+        metadata = hdul['METADATA'].data
+        if METADATA_NAMES['magzp'] not in metadata.dtype.names:
+            raise ValueError('missing stored zero points, rebuild the cube with --store_zp')
+        filters = [f.decode() if isinstance(f, bytes) else str(f) for f in metadata[METADATA_NAMES['filter']]]
+        m0__b = np.array(metadata[METADATA_NAMES['magzp']], dtype='float64')
+        if not np.all(np.isfinite(m0__b)):
+            bands = [f for f, m0 in zip(filters, m0__b) if not np.isfinite(m0)]
+            raise ValueError(f'missing stored zero points of {" ".join(bands)}, rebuild the cube with --store_zp')
+        try:
+            dzp__byx = np.array(hdul['ZPCORR'].data, dtype='float64')
+        except KeyError:
+            dzp__byx = None
+        if h.get('ZPCORR', False) and (dzp__byx is None):
+            raise ValueError('ZPCORR = T but missing ZPCORR extension, rebuild the cube with --store_zp')
+        cal = dict(
+            tile=h['TILE'], x0tile=h['X0TILE'], y0tile=h['Y0TILE'],
+            author=get_author(data_hdu.header), shape=tuple(data_hdu.shape[1:]),
+            bands=[FILTER_NAMES_FITS.get(f.strip(), f.strip()) for f in filters],
+            m0__b=m0__b,
+            dzp__byx=dzp__byx,
+        )
+    return cal
+
+def _rescale(raw, f, blank=None):
+    '''
+    Multiply the stored (raw) values of a band by the flux factor `f`.
+    Integer (quantized) values are rounded back to integers, keeping the
+    ``BLANK`` pixels.
+    '''
+    if raw.dtype.kind not in 'iu':
+        return (raw*f).astype(raw.dtype)
+    info = np.iinfo(raw.dtype)
+    bad = (raw == blank) if blank is not None else np.zeros(raw.shape, dtype='bool')
+    q = np.round(np.where(bad, 0, raw)*f)
+    q = np.clip(q, info.min + 1, info.max).astype(raw.dtype)
+    if blank is not None:
+        q[bad] = blank
+    return q
+
+def recalibrate_scube(filename, zp_table=None, data_release='dr4', zpcorr=False, zpcorr_dir=None, verbose=0):
+    '''
+    Recalibrate, in place, the DATA and ERRORS of a cube created with
+    ``--store_zp`` with the zero points of `zp_table` (and the per-pixel
+    ZP correction maps if `zpcorr` is True), without the stamps.
+
+    The DATA and ERRORS of each band are the counts times the flux of the
+    magnitude zero point, so the recalibration multiplies each band by
+    ``10**(-0.4*(m0_new + dzp_new - m0_old - dzp_old))``. The cube is
+    read and written one band at a time and the stored calibration
+    (MAGZP, ZPCORR, ``ZPSOURCE`` and ``ZPCORR`` keys) is updated.
+    Quantized (``int32``) cubes are requantized with the same step.
+    Tile-compressed cubes are not supported.
+
+    The update is not atomic: an interrupted recalibration leaves the cube
+    inconsistent with its stored calibration.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the cube (FITS or HDF5).
+
+    zp_table : str, optional
+        Zero-points table (see :class:`scubes.zeropoints.zero_points_index`).
+        Defaults to the table of `data_release`.
+
+    data_release : str, optional
+        S-PLUS data release, by default ``dr4``.
+
+    zpcorr : bool, optional
+        Apply the per-pixel ZP correction maps, by default False (the
+        per-pixel correction of the cube is removed).
+
+    zpcorr_dir : str, optional
+        Directory with the ZP correction grids (see
+        :func:`scubes.zeropoints.get_zpcorr_spline`).
+
+    verbose : int, optional
+        Verbosity level, by default 0.
+
+    Raises
+    ------
+    ValueError
+        If the cube can not be recalibrated or the zero points of the
+        cube tile are missing.
+    '''
+    zp_table = (__dr5_zp_cat__ if '5' in data_release else __dr4_zp_cat__) if zp_table is None else zp_table
+    cal = read_calibration(filename)
+    tile = cal['tile']
+    zps = get_zero_points_index(zp_table, verbose=verbose).lookup(tile)
+    if zps is None:
+        raise ValueError(f'{tile}: not found in zero-points table')
+    m0__b = []
+    dzp__byx = [] if zpcorr else None
+    for band in cal['bands']:
+        zp = zps.get(band, None)
+        if (zp is None) or not np.isfinite(zp):
+            raise ValueError(f'{tile}: {band}: missing zero point')
+        if zpcorr:
+            spline = get_zpcorr_spline(data_release, band, cal['author'], zpcorr_dir=zpcorr_dir, verbose=verbose)
+            zpc, dzp__yx = zpcorr_stamp(spline, cal['x0tile'], cal['y0tile'], cal['shape'])
+            zp += zpc
+            dzp__byx.append(dzp__yx)
+        m0__b.append(zp)
+    m0__b = np.array(m0__b)
+    dzp__byx = np.array(dzp__byx) if zpcorr else None
+    print_level(f'{filename}: MAGZP {cal["m0__b"]} -> {m0__b}', 1, verbose)
+
+    def _factor(i):
+        dm = m0__b[i] - cal['m0__b'][i]
+        if dzp__byx is not None:
+            dm = dm + dzp__byx[i]
+        if cal['dzp__byx'] is not None:
+            dm = dm - cal['dzp__byx'][i]
+        return np.power(10, -0.4*dm)
+
+    n_b = len(m0__b)
+    new_dzp__byx = np.zeros((n_b,) + cal['shape']) if dzp__byx is None else dzp__byx
+    if is_hdf5_scube(filename):
+        hdul = scube_hdf5(filename, mode='update')
+    else:
+        hdul = fits.open(filename, mode='update', memmap=True, do_not_scale_image_data=True)
+    with hdul:
+        for ext in ['DATA', 'ERRORS']:
+            try:
+                hdu = hdul[ext]
+            except KeyError:
+                continue
+            # raw (stored) values
+            data = hdu._dataset if isinstance(hdul, scube_hdf5) else hdu.data
+            blank = hdu.header.get('BLANK', None)
+            for i in range(n_b):
+                print_level(f'{filename}: {ext}: band {i + 1}/{n_b}', 2, verbose)
+                data[i] = _rescale(np.asarray(data[i]), _factor(i), blank)
+        if isinstance(hdul, scube_hdf5):
+            meta = hdul['METADATA']._dataset
+            tab = meta[()]
+            tab[METADATA_NAMES['magzp']] = m0__b
+            meta[...] = tab
+        else:
+            hdul['METADATA'].data[METADATA_NAMES['magzp']][:] = m0__b
+        append_zpcorr = False
+        try:
+            zpcorr_data = hdul['ZPCORR']
+            if isinstance(hdul, scube_hdf5):
+                zpcorr_data._dataset[...] = new_dzp__byx.astype('float32')
+            else:
+                zpcorr_data.data[:] = new_dzp__byx
+        except KeyError:
+            append_zpcorr = dzp__byx is not None
+        if append_zpcorr and isinstance(hdul, scube_hdf5):
+            hdul.append(zpcorr_hdu(dzp__byx))
+        h = hdul['PRIMARY'].header
+        h['ZPSOURCE'] = (basename(zp_table), 'Source of the MAGZP of the cube')
+        h['ZPCORR'] = (zpcorr, 'Per-pixel ZP correction applied')
+        h.add_history(f'scubes_recalibrate: {basename(zp_table)} zpcorr={zpcorr}')
+    if append_zpcorr and not isinstance(hdul, scube_hdf5):
+        hdu = zpcorr_hdu(dzp__byx)
+        fits.append(filename, hdu.data, hdu.header)
@@ -1,5 +1,10 @@
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
+SPLUS_MOTD_TOP = '┌─┐   ┌─┐┬ ┬┌┐ ┌─┐┌─┐ '
+SPLUS_MOTD_MID = '└─┐───│  │ │├┴┐├┤ └─┐ '
+SPLUS_MOTD_BOT = '└─┘   └─┘└─┘└─┘└─┘└─┘ '
+SPLUS_MOTD_SEP = '----------------------'
+
 class readFileArgumentParser(ArgumentParser):
     '''
     A class that extends :class:`argparse.ArgumentParser` to read arguments from file.
@@ -0,0 +1,238 @@
+import json
+import hashlib
+from time import time
+from os import replace, stat, getpid
+from os.path import isfile, basename
+
+from .io import print_level
+
+def _sha1_file(filename, blocksize=2**20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _sha1_json(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+class _stage:
+    def __init__(self, name, func, params, inputs, deps, outputs):
+        self.name = name
+        self.func = func
+        self.params = {} if params is None else params
+        self.inputs = list(inputs)
+        self.deps = list(deps)
+        self.outputs = list(outputs)
+
+class build_graph:
+    '''
+    Incremental build graph of the products of a galaxy (e.g. cube,
+    masterlist header, plots and masked cube).
+
+    Each stage records, in the JSON `state_file`, a fingerprint (SHA-1) of
+    its parameters, of the content of its input files and of the
+    fingerprints of the stages it depends on. A stage is stale (and
+    rebuilt by :meth:`run`) if it was never recorded, if its fingerprint
+    changed, if any of its outputs is missing or if any of its dependencies
+    was rebuilt in this run.
+
+    The content hash of each input file is kept in the state with its
+    modification time and size, so the files are only read again if they
+    were touched. A missing input keeps its recorded hash (e.g. the stamps
+    removed after the cube build with ``--remove_downloaded_data``).
+
+    Parameters
+    ----------
+    state_file : str
+        JSON file of the recorded fingerprints.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Attributes
+    ----------
+    rebuilt : list of str
+        Stages recorded (built) in this run.
+
+    Methods
+    -------
+    add(name, func=None, params=None, inputs=(), deps=(), outputs=())
+        Add a stage.
+
+    stale(name)
+        Check if a stage needs to be rebuilt.
+
+    record(name)
+        Record the fingerprint of a built stage.
+
+    run(names=None, force=False, callback=None)
+        Build the stale stages.
+    '''
+    def __init__(self, state_file, verbose=0):
+        self.state_file = state_file
+        self.verbose = verbose
+        self.rebuilt = []
+        self._stages = {}
+        self._state = self._read_state()
+
+    def _read_state(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        state.setdefault('stages', {})
+        state.setdefault('files', {})
+        return state
+
+    def _write_state(self):
+        tmp = f'{self.state_file}.{getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._state, f, indent=1, sort_keys=True)
+        replace(tmp, self.state_file)
+
+    def add(self, name, func=None, params=None, inputs=(), deps=(), outputs=()):
+        '''
+        Add a stage to the graph.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+
+        func : callable, optional
+            Called without arguments to build the stage. A stage without
+            `func` is built outside the graph (see :meth:`record`).
+
+        params : dict, optional
+            Parameters of the stage (JSON serializable, or converted by
+            ``str``).
+
+        inputs : list of str, optional
+            Input files.
+
+        deps : list of str, optional
+            Stages this stage depends on. They must be added first.
+
+        outputs : list of str, optional
+            Output files.
+
+        Raises
+        ------
+        ValueError
+            If the stage already exists or a dependency is unknown.
+        '''
+        if name in self._stages:
+            raise ValueError(f'{name}: stage already exists')
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f'{name}: unknown dependency {dep}')
+        self._stages[name] = _stage(name, func, params, inputs, deps, outputs)
+
+    def file_hash(self, filename):
+        '''
+        Content hash (SHA-1) of `filename`, only recomputed if its
+        modification time or size changed. None if the file is missing
+        and was never hashed.
+        '''
+        rec = self._state['files'].get(filename, None)
+        try:
+            st = stat(filename)
+        except FileNotFoundError:
+            return None if rec is None else rec['sha1']
+        if (rec is None) or (rec['mtime_ns'] != st.st_mtime_ns) or (rec['size'] != st.st_size):
+            rec = dict(mtime_ns=st.st_mtime_ns, size=st.st_size, sha1=_sha1_file(filename))
+            self._state['files'][filename] = rec
+        return rec['sha1']
+
+    def fingerprint(self, name):
+        '''
+        Current fingerprint of a stage.
+        '''
+        s = self._stages[name]
+        return _sha1_json(dict(
+            params=s.params,
+            inputs={basename(f): self.file_hash(f) for f in s.inputs},
+            deps={d: self.fingerprint(d) for d in s.deps},
+        ))
+
+    def stale(self, name):
+        '''
+        Check if a stage needs to be rebuilt.
+
+        Returns
+        -------
+        bool
+            True if the stage is stale.
+        '''
+        s = self._stages[name]
+        rec = self._state['stages'].get(name, None)
+        if rec is None:
+            reason = 'never built'
+        elif any(d in self.rebuilt for d in s.deps):
+            reason = 'dependency rebuilt'
+        elif not all(isfile(f) for f in s.outputs):
+            reason = 'missing outputs'
+        elif rec['fingerprint'] != self.fingerprint(name):
+            reason = 'inputs changed'
+        else:
+            return False
+        print_level(f'{self.state_file}: {name}: stale ({reason})', 1, self.verbose)
+        return True
+
+    def record(self, name):
+        '''
+        Record the fingerprint of a built stage.
+        '''
+        self._state['stages'][name] = dict(fingerprint=self.fingerprint(name), time=time())
+        if name not in self.rebuilt:
+            self.rebuilt.append(name)
+        self._write_state()
+
+    def run(self, names=None, force=False, callback=None):
+        '''
+        Build the stale stages of `names` (in the order the stages were
+        added). An exception raised by a stage stops the run; the stages
+        already built are recorded.
+
+        Parameters
+        ----------
+        names : list of str, optional
+            Stages to be built. Defaults to all the stages with `func`.
+
+        force : bool, optional
+            Build the stages even if they are not stale. Default is False.
+
+        callback : callable, optional
+            Called as ``callback(name, status, error)`` when a stage is
+            ``started``, ``skipped``, ``done`` or ``failed``.
+
+        Returns
+        -------
+        dict
+            ``done`` or ``skipped`` for each stage of `names`.
+        '''
+        names = [n for n, s in self._stages.items() if s.func is not None] if names is None else names
+        callback = (lambda *a: None) if callback is None else callback
+        status = {}
+        for name, s in self._stages.items():
+            if name not in names:
+                continue
+            if not (force or self.stale(name)):
+                status[name] = 'skipped'
+                callback(name, 'skipped', None)
+                continue
+            print_level(f'{self.state_file}: building {name}', 1, self.verbose)
+            callback(name, 'started', None)
+            try:
+                s.func()
+            except (Exception, SystemExit) as e:
+                callback(name, 'failed', f'{type(e).__name__}: {e}')
+                raise
+            self.record(name)
+            status[name] = 'done'
+            callback(name, 'done', None)
+        # keep the input hashes updated by the staleness checks
+        self._write_state()
+        return status
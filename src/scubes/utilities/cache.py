@@ -0,0 +1,250 @@
+import json
+import hashlib
+from time import time
+from shutil import copyfile
+from contextlib import contextmanager
+from os import makedirs, remove, replace, getpid
+from os.path import join, isfile, getsize, expanduser
+
+from .io import print_level
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+_POS_DECIMALS = 6  # ~4 mas, much smaller than the S-PLUS pixel (0.55 arcsec)
+
+def _fmt_pos(value):
+    return f'{float(value):.{_POS_DECIMALS}f}'
+
+class stamp_cache:
+    '''
+    Content-addressed on-disk cache of S-PLUS Cloud products (stamps, weight
+    stamps, detection images and Lupton RGB images) shared between runs and
+    galaxies.
+
+    Each entry is keyed by ``(kind, data_release, tile, ra, dec, size, band,
+    weight)``. The least recently used entries are evicted when the total
+    size of the cache exceeds `max_bytes`. A cached FITS stamp centred at the
+    same position but with a larger size can serve a smaller request by
+    cropping it.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache. It is created if it does not exist.
+
+    max_bytes : int, optional
+        Disk budget of the cache in bytes. If None, the cache grows without
+        limit. Default is None.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Methods
+    -------
+    key(**kw)
+        Returns the content address of a product.
+
+    get(filename, **kw)
+        Retrieve a product from the cache to `filename`.
+
+    put(filename, **kw)
+        Store `filename` in the cache.
+    '''
+    _index_filename = 'index.json'
+    _lock_filename = '.lock'
+
+    def __init__(self, cache_dir, max_bytes=None, verbose=0):
+        self.cache_dir = expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def index_path(self):
+        return join(self.cache_dir, self._index_filename)
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Exclusive lock of the cache index, shared between processes.
+        '''
+        with open(join(self.cache_dir, self._lock_filename), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = {}
+        # forget entries removed by hand
+        return {k: v for k, v in index.items() if isfile(self._path(k, v['ext']))}
+
+    def _write_index(self, index):
+        tmp = f'{self.index_path}.{getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        replace(tmp, self.index_path)
+
+    def _path(self, key, ext):
+        return join(self.cache_dir, f'{key}{ext}')
+
+    @staticmethod
+    def _entry(kind, data_release, tile, ra, dec, size, band, weight):
+        return dict(
+            kind=kind, data_release=str(data_release).lower(), tile=str(tile),
+            ra=_fmt_pos(ra), dec=_fmt_pos(dec), size=int(size), band=str(band),
+            weight=bool(weight),
+        )
+
+    @classmethod
+    def key(cls, kind='stamp', data_release='dr4', tile=None, ra=0, dec=0, size=0, band=None, weight=False):
+        '''
+        Return the content address (SHA-1) of a product.
+
+        Parameters
+        ----------
+        kind : str, optional
+            Kind of product: ``stamp``, ``detection`` or ``lupton``.
+
+        data_release, tile, ra, dec, size, band, weight :
+            Parameters of the product request.
+
+        Returns
+        -------
+        str
+            The key of the product.
+        '''
+        entry = cls._entry(kind, data_release, tile, ra, dec, size, band, weight)
+        return hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+
+    def _find(self, index, entry):
+        '''
+        Search the smallest cached product that can serve `entry`. Only FITS
+        stamps can be cropped.
+        '''
+        k = self.key(**entry)
+        if k in index:
+            return k, False
+        if entry['kind'] != 'stamp':
+            return None, False
+        best, best_size = None, None
+        for ck, cv in index.items():
+            m = cv['meta']
+            same = all(m[_] == entry[_] for _ in ['kind', 'data_release', 'tile', 'ra', 'dec', 'band', 'weight'])
+            if same and (m['size'] > entry['size']) and ((best_size is None) or (m['size'] < best_size)):
+                best, best_size = ck, m['size']
+        return best, best is not None
+
+    def get(self, filename, kind='stamp', data_release='dr4', tile=None, ra=0, dec=0, size=0, band=None, weight=False):
+        '''
+        Retrieve a product from the cache and write it to `filename`.
+
+        Parameters
+        ----------
+        filename : str
+            Output filename.
+
+        kind, data_release, tile, ra, dec, size, band, weight :
+            Parameters of the product request. See :meth:`key`.
+
+        Returns
+        -------
+        bool
+            True if the product was found on the cache, False otherwise.
+        '''
+        entry = self._entry(kind, data_release, tile, ra, dec, size, band, weight)
+        with self._locked():
+            index = self._read_index()
+            k, crop = self._find(index, entry)
+            if k is None:
+                return False
+            src = self._path(k, index[k]['ext'])
+            index[k]['atime'] = time()
+            self._write_index(index)
+            if crop:
+                print_level(f'stamp_cache: {filename}: cropping cached {index[k]["meta"]["size"]} px stamp', 2, self.verbose)
+                _crop_stamp(src, filename, float(entry['ra']), float(entry['dec']), entry['size'])
+            else:
+                print_level(f'stamp_cache: {filename}: cache hit', 2, self.verbose)
+                copyfile(src, filename)
+        return True
+
+    def put(self, filename, kind='stamp', data_release='dr4', tile=None, ra=0, dec=0, size=0, band=None, weight=False):
+        '''
+        Store a copy of `filename` in the cache and evict the least recently
+        used entries if the disk budget is exceeded.
+
+        Parameters
+        ----------
+        filename : str
+            File to be stored.
+
+        kind, data_release, tile, ra, dec, size, band, weight :
+            Parameters of the product request. See :meth:`key`.
+        '''
+        if not isfile(filename):
+            return
+        entry = self._entry(kind, data_release, tile, ra, dec, size, band, weight)
+        k = self.key(**entry)
+        ext = '.png' if filename.endswith('.png') else ('.fits.fz' if filename.endswith('.fz') else '.fits')
+        dst = self._path(k, ext)
+        tmp = f'{dst}.{getpid()}.tmp'
+        copyfile(filename, tmp)
+        replace(tmp, dst)
+        with self._locked():
+            index = self._read_index()
+            index[k] = dict(ext=ext, nbytes=getsize(dst), atime=time(), meta=entry)
+            self._evict(index)
+            self._write_index(index)
+        print_level(f'stamp_cache: {filename}: stored as {k}', 2, self.verbose)
+
+    def _evict(self, index):
+        '''
+        LRU eviction under the disk budget.
+        '''
+        if self.max_bytes is None:
+            return
+        total = sum(v['nbytes'] for v in index.values())
+        for k in sorted(index, key=lambda _: index[_]['atime']):
+            if total <= self.max_bytes:
+                break
+            v = index.pop(k)
+            total -= v['nbytes']
+            print_level(f'stamp_cache: evicting {k}', 2, self.verbose)
+            try:
+                remove(self._path(k, v['ext']))
+            except FileNotFoundError:
+                pass
+
+def _crop_stamp(src, dst, ra, dec, size):
+    '''
+    Crop a S-PLUS stamp centred at ``(ra, dec)`` to ``size x size`` pixels
+    keeping the original header information and updating the WCS.
+    '''
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from astropy.nddata.utils import Cutout2D
+    from astropy.coordinates import SkyCoord
+
+    with fits.open(src) as hdul:
+        hdu = hdul[1]
+        header = hdu.header.copy()
+        pos = SkyCoord(ra, dec, unit='deg', frame='icrs')
+        cutout = Cutout2D(hdu.data, position=pos, size=(size, size), wcs=WCS(header), mode='partial', copy=True)
+    header.update(cutout.wcs.to_header())
+    if dst.endswith('.fz'):
+        # lossless: the stamp values were already quantized by its compression
+        chdu = fits.CompImageHDU(data=cutout.data, header=header, compression_type='GZIP_2', quantize_level=0)
+    else:
+        chdu = fits.ImageHDU(data=cutout.data, header=header)
+    fits.HDUList([fits.PrimaryHDU(), chdu]).writeto(dst, overwrite=True)
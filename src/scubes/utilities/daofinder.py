@@ -1,6 +1,4 @@
 import numpy as np
-from photutils import DAOStarFinder
-from regions import PixCoord, CirclePixelRegion
 
 from .io import print_level
 
@@ -27,6 +25,8 @@ def DAOfinder(data, mean=0, median=0, std=0.5):
     Table
         A table containing the found sources and their properties.
     '''    
+    from photutils import DAOStarFinder
+
     # DETECT TOO MUCH HII REGIONS
     print_level(('mean', 'median', 'std'))
     print_level((mean, median, std))
@@ -49,6 +49,8 @@ def DAOregions(data):
     list
         List of CirclePixelRegion objects representing the regions around the detected sources.
     '''    
+    from regions import PixCoord, CirclePixelRegion
+
     daocat = DAOfinder(data=data)
     daopos = np.transpose((daocat['xcentroid'], daocat['ycentroid']))
     daorad = 4*(abs(daocat['sharpness']) + abs(daocat['roundness1']) + abs(daocat['roundness2']))
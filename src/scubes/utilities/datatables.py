@@ -0,0 +1,74 @@
+import hashlib
+import numpy as np
+from os import makedirs, replace, getpid
+from os.path import join, basename, expanduser
+
+from .io import print_level
+
+DATA_TABLES_CACHE_DIR = join('~', '.cache', 'scubes', 'tables')
+
+def _file_sha1(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def read_data_table(filename, cache_dir=DATA_TABLES_CACHE_DIR, as_array=False, verbose=0):
+    '''
+    Read an ASCII data table (e.g. the package filters tables) with a
+    binary cache.
+
+    The first read parses the table with :func:`astropy.io.ascii.read`
+    and stores it as a ``.npz`` file at `cache_dir` named after the SHA-1
+    of the table contents. The next reads load the binary copy, so a
+    changed table is parsed again.
+
+    Parameters
+    ----------
+    filename : str
+        ASCII table.
+
+    cache_dir : str, optional
+        Directory of the binary cache. If None, the table is always
+        parsed. Default is :data:`DATA_TABLES_CACHE_DIR`.
+
+    as_array : bool, optional
+        Return a numpy structured array instead of a
+        :class:`astropy.table.Table`, which avoids importing
+        :mod:`astropy.table` when the table is cached. Default is False.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Returns
+    -------
+    :class:`astropy.table.Table` or :class:`numpy.ndarray`
+        The table.
+    '''
+    def _output(arr):
+        if as_array:
+            return arr
+        from astropy.table import Table
+        return Table(arr)
+
+    if cache_dir is None:
+        from astropy.io import ascii
+        tab = ascii.read(filename)
+        return tab.as_array() if as_array else tab
+    cache_dir = expanduser(cache_dir)
+    cache_path = join(cache_dir, f'{basename(filename)}.{_file_sha1(filename)}.npz')
+    try:
+        with np.load(cache_path, allow_pickle=False) as npz:
+            return _output(npz['table'])
+    except (OSError, KeyError, ValueError):
+        pass
+    from astropy.io import ascii
+
+    tab = ascii.read(filename)
+    try:
+        makedirs(cache_dir, exist_ok=True)
+        tmp = f'{cache_path}.{getpid()}.tmp.npz'
+        np.savez(tmp, table=tab.as_array())
+        replace(tmp, cache_path)
+        print_level(f'{filename}: cached at {cache_path}', 2, verbose)
+    except OSError as e:
+        print_level(f'{cache_path}: unable to cache table: {e}', 1, verbose)
+    return tab.as_array() if as_array else tab
@@ -0,0 +1,255 @@
+import numpy as np
+from astropy.io import fits
+
+H5_EXTENSIONS = ('.h5', '.hdf5')
+H5_SCUBE_VERSION = 1
+
+def is_hdf5_scube(filename):
+    '''
+    Check if `filename` is a HDF5 S-CUBES file (by its extension).
+    '''
+    return str(filename).lower().endswith(H5_EXTENSIONS)
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('HDF5 cubes require h5py (pip install h5py)')
+    return h5py
+
+def _scale(raw, header):
+    '''
+    Apply the FITS ``BSCALE``, ``BZERO`` and ``BLANK`` keywords to the raw
+    (stored) values, the same way :mod:`astropy.io.fits` does.
+    '''
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    blank = header.get('BLANK', None) if raw.dtype.kind in 'iu' else None
+    if (bscale == 1) and (bzero == 0) and (blank is None):
+        return raw
+    data = raw.astype('float64' if raw.dtype.kind in 'iu' else raw.dtype)
+    data *= bscale
+    data += bzero
+    if blank is not None:
+        data[raw == blank] = np.nan
+    return data
+
+class _h5_section:
+    def __init__(self, hdu):
+        self._hdu = hdu
+
+    def __getitem__(self, key):
+        return _scale(np.asarray(self._hdu._dataset[key]), self._hdu.header)
+
+class _h5_hdu:
+    '''
+    A FITS HDU-like view of a HDU stored in a HDF5 S-CUBES file. The
+    header is kept in memory and the data is only read at the first
+    access to :attr:`data`. :attr:`section` reads only the HDF5 chunks
+    covered by the requested slice.
+    '''
+    def __init__(self, name, obj):
+        self.name = name
+        self._obj = obj
+        self._data = None
+        self.header = fits.Header.fromstring(obj.attrs['header'])
+
+    @property
+    def _dataset(self):
+        return self._obj
+
+    @property
+    def is_table(self):
+        return self.header.get('XTENSION', None) == 'BINTABLE'
+
+    @property
+    def shape(self):
+        return getattr(self._obj, 'shape', None)
+
+    @property
+    def section(self):
+        return _h5_section(self)
+
+    @property
+    def data(self):
+        if self._data is None:
+            if not hasattr(self._obj, 'shape'):
+                return None
+            raw = self._obj[()]
+            if self.is_table:
+                from astropy.table import Table
+
+                tab = Table(raw)
+                tab.convert_bytestring_to_unicode()
+                self._data = tab.as_array()
+            else:
+                self._data = _scale(raw, self.header)
+        return self._data
+
+class scube_hdf5:
+    '''
+    HDF5 S-CUBES file with an interface similar to the subset of
+    :class:`astropy.io.fits.HDUList` used by S-CUBES (indexing by EXTNAME
+    or position, ``close()`` and the context manager protocol).
+
+    Each HDU is stored under its EXTNAME: the PRIMARY HDU as an empty group
+    and the image (``DATA``, ``ERRORS``, ``WEIMASK``) and table (``METADATA``)
+    extensions as datasets. The FITS header of each HDU is kept in the
+    ``header`` attribute and the raw (scaled) values are stored, so
+    ``BSCALE``, ``BZERO`` and ``BLANK`` are applied when reading.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 cube.
+
+    mode : str, optional
+        ``readonly`` (default) or ``update``. In ``update`` mode the headers
+        are written back to the file on :meth:`close`.
+    '''
+    def __init__(self, filename, mode='readonly'):
+        h5py = _import_h5py()
+        self.filename = filename
+        self.mode = mode
+        self._file = h5py.File(filename, 'r+' if mode == 'update' else 'r')
+        names = [str(_) for _ in self._file.attrs.get('HDUS', list(self._file.keys()))]
+        self._hdus = [_h5_hdu(n, self._file[n]) for n in names]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._hdus)
+
+    def __iter__(self):
+        return iter(self._hdus)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            for hdu in self._hdus:
+                if hdu.name.upper() == key.upper():
+                    return hdu
+            raise KeyError(f'{self.filename}: extension {key} not found')
+        return self._hdus[key]
+
+    def append(self, hdu):
+        '''
+        Append an image HDU (``update`` mode only), stored under its
+        EXTNAME.
+
+        Parameters
+        ----------
+        hdu : :class:`astropy.io.fits.ImageHDU`
+            HDU to be appended.
+        '''
+        name = _hdu_name(hdu, len(self._hdus))
+        data = np.asarray(hdu.data)
+        obj = self._file.create_dataset(name, data=data, chunks=_chunks(None, data.shape))
+        header = hdu.header.copy()
+        header['BITPIX'] = fits.DTYPE2BITPIX[data.dtype.name]
+        obj.attrs['header'] = header.tostring()
+        self._hdus.append(_h5_hdu(name, obj))
+        self._file.attrs['HDUS'] = [hdu.name for hdu in self._hdus]
+
+    def flush(self):
+        '''
+        Write the in-memory headers to the file (``update`` mode only).
+        '''
+        if self.mode == 'update':
+            for hdu in self._hdus:
+                hdu._obj.attrs['header'] = hdu.header.tostring()
+            self._file.flush()
+
+    def close(self):
+        if self._file.id.valid:
+            self.flush()
+            self._file.close()
+
+def _hdu_name(hdu, i):
+    if i == 0:
+        return 'PRIMARY'
+    return hdu.header.get('EXTNAME', f'HDU{i}')
+
+def _chunks(chunks, shape):
+    '''
+    Clip the chunk shape to the dataset shape. A 0 (or None) chunk side
+    means the whole axis. Only 3D datasets use the `chunks` shape, the
+    others use the whole dataset as a single chunk.
+    '''
+    if (chunks is None) or (len(shape) != len(chunks)):
+        return None if len(shape) != 3 else tuple(shape)
+    return tuple(min(c, s) if c else s for c, s in zip(chunks, shape))
+
+def write_scube_hdf5(filename, hdul, chunks=(0, 32, 32), compression='gzip', compression_opts=None):
+    '''
+    Write a S-CUBES HDUList to a chunked HDF5 file. See :class:`scube_hdf5`
+    for the layout.
+
+    Parameters
+    ----------
+    filename : str
+        Output filename.
+
+    hdul : :class:`astropy.io.fits.HDUList` or list of HDUs
+        Cube HDUs (PRIMARY, DATA, ERRORS, WEIMASK and METADATA).
+
+    chunks : tuple of int, optional
+        Chunk shape ``(band, y, x)`` of the 3D extensions. A 0 side means
+        the whole axis. The default ``(0, 32, 32)`` keeps all the bands of
+        a 32x32 pixels region in a single chunk, so one pixel spectrum is
+        read from one chunk.
+
+    compression : str, optional
+        Per-chunk compression filter: ``gzip``, ``lzf`` or None. Default is
+        ``gzip``.
+
+    compression_opts : int, optional
+        Compression level of the ``gzip`` filter.
+    '''
+    h5py = _import_h5py()
+    compression = None if compression in [None, 'none'] else compression
+    names = []
+    with h5py.File(filename, 'w') as f:
+        f.attrs['SCUBES_HDF5'] = H5_SCUBE_VERSION
+        for i, hdu in enumerate(hdul):
+            name = _hdu_name(hdu, i)
+            names.append(name)
+            header = hdu.header.copy()
+            if hdu.data is None:
+                obj = f.create_group(name)
+            elif isinstance(hdu, fits.BinTableHDU):
+                obj = f.create_dataset(name, data=np.asarray(hdu.data).view(np.ndarray))
+            else:
+                data = np.asarray(hdu.data)
+                kw = {}
+                if compression is not None:
+                    kw = dict(compression=compression, compression_opts=compression_opts, shuffle=True)
+                obj = f.create_dataset(name, data=data, chunks=_chunks(chunks, data.shape), **kw)
+                header['BITPIX'] = fits.DTYPE2BITPIX[data.dtype.name]
+            obj.attrs['header'] = header.tostring()
+        f.attrs['HDUS'] = names
+
+def open_scube(filename, mode='readonly'):
+    '''
+    Open a S-CUBES cube stored as FITS or HDF5 (chosen by the extension,
+    see :data:`H5_EXTENSIONS`).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the cube.
+
+    mode : str, optional
+        ``readonly`` (default) or ``update``.
+
+    Returns
+    -------
+    :class:`astropy.io.fits.HDUList` or :class:`scube_hdf5`
+        Opened cube.
+    '''
+    if is_hdf5_scube(filename):
+        return scube_hdf5(filename, mode=mode)
+    return fits.open(filename, mode)
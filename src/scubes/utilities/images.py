@@ -0,0 +1,202 @@
+import numpy as np
+from os.path import join, isfile
+from astropy.io import fits
+
+# bands of the S-PLUS detection image
+DETECTION_BANDS = ['G', 'R', 'I', 'Z']
+# bands of the R, G and B channels and parameters of the S-PLUS Cloud Lupton RGB images
+LUPTON_RGB_BANDS = ['I', 'R', 'G']
+LUPTON_Q = 8
+LUPTON_STRETCH = 3
+# AB zero point of the detection images built from a cube
+DETECTION_MAGZP = 25.0
+
+def stamps_filenames(output_dir, galaxy, tile, size, bands):
+    '''
+    Filenames of the ``swp`` stamps of `bands` written by
+    :meth:`scubes.core.SCubes.get_stamps`.
+
+    Returns
+    -------
+    list of str or None
+        The filenames, or None if any of them is missing.
+    '''
+    filenames = [join(output_dir, f'{galaxy}_{tile}_{band}_{size}x{size}_swp.fits.fz') for band in bands]
+    return filenames if all(isfile(f) for f in filenames) else None
+
+def _read_stamps(filenames):
+    data__b, headers__b = [], []
+    for filename in filenames:
+        with fits.open(filename) as hdul:
+            data__b.append(hdul[1].data)
+            headers__b.append(hdul[1].header.copy())
+    return data__b, headers__b
+
+def detection_image_hdul(data__b, headers__b, bands=DETECTION_BANDS):
+    '''
+    Detection image as the sum of the stamps of `bands`, as built by
+    :meth:`splusdata.Core.stamp_detection`.
+
+    The header is the header of the first stamp with its WCS rewritten by
+    :class:`astropy.wcs.WCS`, without the band keys (``FILTER`` and
+    ``MAGZP``) and with the mean PSF FWHM of the stamps.
+
+    Parameters
+    ----------
+    data__b : list of array-like
+        Images of the stamps.
+
+    headers__b : list of :class:`astropy.io.fits.Header`
+        Headers of the stamps.
+
+    bands : list of str, optional
+        Bands of the stamps, recorded at the ``BANDS`` key. Default is
+        :data:`DETECTION_BANDS`.
+
+    Returns
+    -------
+    :class:`astropy.io.fits.HDUList`
+        Detection image HDUList (PrimaryHDU and ImageHDU).
+    '''
+    from astropy.wcs import WCS
+    from ..headers import get_key, get_author
+
+    header = headers__b[0].copy()
+    header.update(WCS(header, naxis=2).to_header())
+    for k in ['FILTER', 'MAGZP']:
+        header.remove(k, ignore_missing=True)
+    key = get_key('PSFFWHM', get_author(header))
+    psffwhm = [h.get(get_key('PSFFWHM', get_author(h)), None) for h in headers__b]
+    if all(v is not None for v in psffwhm):
+        header[key] = float(np.mean(psffwhm))
+    header['BANDS'] = (','.join(bands), 'Bands of the detection image')
+    data = np.sum([np.asarray(d, dtype='float32') for d in data__b], axis=0)
+    return fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data=data, header=header, name='IMAGE')])
+
+def lupton_rgb_image(data__b, Q=LUPTON_Q, stretch=LUPTON_STRETCH, pminmax=None, flip=False):
+    '''
+    Lupton RGB image (see :func:`scubes.utilities.readscube.make_RGB_tom`)
+    of three images. With the default parameters it is the same image of
+    :meth:`splusdata.Core.lupton_rgb`.
+
+    Parameters
+    ----------
+    data__b : list of array-like
+        Images of the R, G and B channels.
+
+    Q, stretch : float, optional
+        Parameters of :func:`astropy.visualization.make_lupton_rgb`.
+
+    pminmax : tuple of float, optional
+        Percentiles used to rescale the channels to 0-255. If None, the
+        channels are not rescaled.
+
+    flip : bool, optional
+        If True, flip the image to the S-PLUS Cloud orientation (origin at
+        the top). Default is False (origin at the bottom).
+
+    Returns
+    -------
+    :class:`PIL.Image.Image`
+        RGB image.
+    '''
+    from PIL import Image
+    from .readscube import make_RGB_tom
+
+    flux__lyx = np.nan_to_num(np.asarray(data__b, dtype='float64'))
+    img = Image.fromarray(make_RGB_tom(flux__lyx, rgb=(0, 1, 2), pminmax=pminmax, Q=Q, stretch=stretch))
+    return img.transpose(Image.FLIP_TOP_BOTTOM) if flip else img
+
+def stamps_detection_image(filenames, bands=DETECTION_BANDS):
+    '''
+    Detection image (see :func:`detection_image_hdul`) of the stamps
+    files `filenames` of `bands`.
+    '''
+    return detection_image_hdul(*_read_stamps(filenames), bands=bands)
+
+def stamps_lupton_rgb(filenames, **kwargs):
+    '''
+    Lupton RGB image (see :func:`lupton_rgb_image`) of the stamps files
+    `filenames` of the R, G and B channels.
+    '''
+    return lupton_rgb_image(_read_stamps(filenames)[0], **kwargs)
+
+def _cube_bands_i(cube, bands):
+    from ..constants import FILTER_NAMES_FITS
+
+    filters = [FILTER_NAMES_FITS.get(f, f) for f in cube.filters]
+    return [filters.index(band) for band in bands]
+
+def cube_detection_image(cube, bands=DETECTION_BANDS, magzp=DETECTION_MAGZP):
+    '''
+    Detection image of a S-CUBES cube: the sum of the fluxes of `bands`,
+    in counts of an AB zero point `magzp` (the zero points of the stamps
+    are not stored in the cube).
+
+    The header has the celestial WCS of the cube and the mean PSF FWHM of
+    `bands`. The gain is not known, so ``GAIN`` is 0 (i.e. the Poisson
+    noise of the sources is ignored by SExtractor).
+
+    Parameters
+    ----------
+    cube : str or :class:`scubes.utilities.readscube.read_scube`
+        The cube.
+
+    bands : list of str, optional
+        Bands of the detection image. Default is :data:`DETECTION_BANDS`.
+
+    magzp : float, optional
+        Zero point of the image. Default is :data:`DETECTION_MAGZP`.
+
+    Returns
+    -------
+    :class:`astropy.io.fits.HDUList`
+        Detection image HDUList (PrimaryHDU and ImageHDU).
+    '''
+    from astropy.wcs import WCS
+    from ..headers import get_key
+    from .readscube import read_scube
+
+    cube = read_scube(cube) if isinstance(cube, str) else cube
+    i_b = _cube_bands_i(cube, bands)
+    # flam -> fnu -> counts
+    _c = 2.99792458e18  # AA/s
+    f0 = 10**(-0.4*(magzp + 48.6))
+    wl__b = cube.pivot_wave[i_b]
+    data = np.sum([cube.flux__lyx[i]*wl**2/_c/f0 for i, wl in zip(i_b, wl__b)], axis=0)
+    h = cube.data_header
+    header = WCS(h, naxis=2).to_header()
+    for k in ['OBJECT', 'EXPTIME', 'PIXSCALE', 'X0TILE', 'Y0TILE', 'TILE']:
+        if k in h:
+            header[k] = (h[k], h.comments[k])
+    header['AUTHOR'] = ('MAR', 'Who ran the software')
+    header['GAIN'] = (0.0, 'Unknown gain')
+    header[get_key('PSFFWHM', 'mar')] = float(np.mean(np.asarray(cube.psf_fwhm)[i_b]))
+    header['MAGZP'] = (magzp, 'Magnitude zero point')
+    header['BANDS'] = (','.join(bands), 'Bands of the detection image')
+    return fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data=data.astype('float32'), header=header, name='IMAGE')])
+
+def cube_lupton_rgb(cube, bands=LUPTON_RGB_BANDS, Q=0, stretch=10, pminmax=(5, 95)):
+    '''
+    Lupton RGB image (see :func:`lupton_rgb_image`) of a S-CUBES cube.
+    The defaults are the ones of
+    :meth:`scubes.utilities.readscube.read_scube.lRGB_image`.
+
+    Parameters
+    ----------
+    cube : str or :class:`scubes.utilities.readscube.read_scube`
+        The cube.
+
+    bands : list of str, optional
+        Bands of the R, G and B channels. Default is
+        :data:`LUPTON_RGB_BANDS`.
+
+    Returns
+    -------
+    :class:`PIL.Image.Image`
+        RGB image.
+    '''
+    from .readscube import read_scube
+
+    cube = read_scube(cube) if isinstance(cube, str) else cube
+    return lupton_rgb_image([cube.flux__lyx[i] for i in _cube_bands_i(cube, bands)], Q=Q, stretch=stretch, pminmax=pminmax)
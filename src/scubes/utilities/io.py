@@ -1,8 +1,6 @@
 import re
-import pandas as pd
 from os.path import basename
 from datetime import datetime
-from astropy.coordinates import SkyCoord
 
 def print_level(msg, level=0, verbose=0):
     '''
@@ -20,14 +18,15 @@ def print_level(msg, level=0, verbose=0):
         The overall verbosity level. Messages with verbosity levels less than or equal to
         this value will be printed. Defaults to 0.
     '''    
+    # filtered messages cost only this comparison
+    if verbose < level:
+        return
     import __main__ as main
     try:
         __script_name__ = basename(main.__file__)
     except AttributeError:
         __script_name__ = ''
-
-    if verbose >= level:
-        print(f'[{datetime.now().isoformat()}] - {__script_name__}: {msg}')
+    print(f'[{datetime.now().isoformat()}] - {__script_name__}: {msg}')
 
 def check_units(ra, dec):
     '''
@@ -92,6 +91,8 @@ def convert_coord_to_degrees(ra, dec, frame='icrs'):
     tuple
         Tuple containing the right ascension and declination converted to degrees.
     '''
+    from astropy.coordinates import SkyCoord
+
     ra, dec = check_units(ra, dec)
 
     # Create a SkyCoord object
@@ -0,0 +1,345 @@
+import json
+from socket import gethostname
+from time import time, sleep
+from threading import Lock, BoundedSemaphore, Thread, Event
+from os import makedirs, remove, replace, rename, link, utime, stat, getpid, fsync
+from os.path import join
+
+from .io import print_level
+
+class job_queue:
+    '''
+    Job queue of the galaxies of a masterlist shared by independent worker
+    processes (e.g. ``scubesml_batch --queue_dir``) on several nodes
+    through a shared filesystem, without a message broker.
+
+    The state of the queue is kept at `queue_dir`:
+
+    - ``claims/GALAXY.claim``: the galaxy is being built by the worker
+      recorded in the file. The claim is created atomically by a hard link
+      of a complete temporary file, so only one worker gets it (hard links
+      are atomic also on NFS, unlike ``flock``).
+    - ``done/GALAXY.json`` and ``failed/GALAXY.json``: result of a
+      finished galaxy. Finished galaxies are not claimed again.
+
+    A claim is a lease: its modification time is refreshed by
+    :meth:`heartbeat` (see :meth:`start_heartbeat`) and a claim not
+    refreshed for `lease` seconds (e.g. its worker crashed) is taken over
+    by the next worker. The lease must be much longer than the heartbeat
+    interval and than the clock differences between the nodes. A worker
+    whose claim was taken over must stop building the galaxy (see
+    :meth:`check`).
+
+    Parameters
+    ----------
+    queue_dir : str
+        Directory of the queue on the shared filesystem. It is created if
+        it does not exist.
+
+    worker : str, optional
+        Worker identifier. Defaults to ``host:pid``.
+
+    lease : float, optional
+        Lease of a claim in seconds. Default is 600.
+
+    max_claims : int, optional
+        Maximum number of galaxies claimed by the worker at the same time.
+        If None, there is no limit. Default is None.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Methods
+    -------
+    claim(galaxy)
+        Try to claim a galaxy.
+
+    next(galaxies)
+        Claim the next available galaxy.
+
+    heartbeat()
+        Refresh the claims of the worker.
+
+    check(galaxy)
+        Check that the worker still holds the claim of a galaxy.
+
+    release(galaxy, status, error=None)
+        Record the result of a galaxy and remove its claim.
+
+    status(galaxies)
+        Number of galaxies by state.
+    '''
+    def __init__(self, queue_dir, worker=None, lease=600, max_claims=None, verbose=0):
+        self.queue_dir = queue_dir
+        self.worker = f'{gethostname()}:{getpid()}' if worker is None else worker
+        self.lease = lease
+        self.verbose = verbose
+        self.claimed = []
+        self.lost = []
+        self._lock = Lock()
+        self._slots = None if max_claims is None else BoundedSemaphore(max(max_claims, 1))
+        self._stop = Event()
+        self._heartbeat_thread = None
+        for d in ['claims', 'done', 'failed']:
+            makedirs(join(queue_dir, d), exist_ok=True)
+
+    def _path(self, kind, galaxy):
+        if kind == 'claims':
+            return join(self.queue_dir, kind, f'{galaxy}.claim')
+        return join(self.queue_dir, kind, f'{galaxy}.json')
+
+    def _tmp(self, filename):
+        return f'{filename}.{self.worker.replace(":", "_")}.tmp'
+
+    def _write(self, filename, rec):
+        with open(filename, 'w') as f:
+            json.dump(rec, f)
+            f.flush()
+            fsync(f.fileno())
+
+    def _owner(self, galaxy):
+        try:
+            with open(self._path('claims', galaxy)) as f:
+                return json.load(f).get('worker', None)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _expired(self, filename):
+        try:
+            return (time() - stat(filename).st_mtime) > self.lease
+        except FileNotFoundError:
+            return False
+
+    def finished(self, galaxy):
+        '''
+        Check if the galaxy is done (or failed).
+        '''
+        try:
+            stat(self._path('done', galaxy))
+            return True
+        except FileNotFoundError:
+            pass
+        try:
+            stat(self._path('failed', galaxy))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _take_over(self, galaxy):
+        '''
+        Remove an expired claim. Only one worker succeeds to rename it; a
+        claim renewed meanwhile is put back.
+        '''
+        claim = self._path('claims', galaxy)
+        stale = f'{claim}.{self.worker.replace(":", "_")}.stale'
+        try:
+            rename(claim, stale)
+        except FileNotFoundError:
+            return
+        if not self._expired(stale):
+            # another worker claimed it between the check and the rename
+            try:
+                link(stale, claim)
+            except FileExistsError:
+                pass
+        else:
+            print_level(f'{self.queue_dir}: {galaxy}: lease of the claim expired', 1, self.verbose)
+        remove(stale)
+
+    def claim(self, galaxy):
+        '''
+        Try to claim a galaxy.
+
+        Returns
+        -------
+        bool
+            True if the galaxy was claimed by this worker, False if it is
+            finished or claimed by another worker.
+        '''
+        if self.finished(galaxy):
+            return False
+        claim = self._path('claims', galaxy)
+        if self._expired(claim):
+            self._take_over(galaxy)
+        tmp = self._tmp(claim)
+        self._write(tmp, dict(worker=self.worker, host=gethostname(), pid=getpid(), time=time()))
+        try:
+            link(tmp, claim)
+        except FileExistsError:
+            return False
+        finally:
+            remove(tmp)
+        # the galaxy could be finished between the check and the claim
+        if self.finished(galaxy):
+            remove(claim)
+            return False
+        with self._lock:
+            self.claimed.append(galaxy)
+        print_level(f'{self.queue_dir}: {galaxy}: claimed by {self.worker}', 1, self.verbose)
+        return True
+
+    def next(self, galaxies, poll=None):
+        '''
+        Claim the next available galaxy of `galaxies`. If the worker
+        already holds `max_claims` galaxies, wait for a :meth:`release`. If
+        the galaxies not finished are claimed by other workers, wait (and
+        poll every `poll` seconds) for them to finish or for their leases
+        to expire.
+
+        Parameters
+        ----------
+        galaxies : list of str
+            Galaxies of the queue, claimed in this order.
+
+        poll : float, optional
+            Polling interval in seconds. Defaults to a quarter of the lease
+            (at most 30 s).
+
+        Returns
+        -------
+        str or None
+            The claimed galaxy or None if all the galaxies are finished.
+        '''
+        poll = min(self.lease/4, 30) if poll is None else poll
+        if self._slots is not None:
+            self._slots.acquire()
+        claimed = None
+        try:
+            while claimed is None:
+                pending = False
+                for galaxy in galaxies:
+                    with self._lock:
+                        if galaxy in self.claimed:
+                            continue
+                    if self.finished(galaxy):
+                        continue
+                    if self.claim(galaxy):
+                        claimed = galaxy
+                        break
+                    pending = True
+                if (claimed is None) and (not pending or self._stop.is_set()):
+                    break
+                if claimed is None:
+                    sleep(poll)
+        finally:
+            # the slot is kept by the claimed galaxy until its release
+            if (claimed is None) and (self._slots is not None):
+                self._slots.release()
+        return claimed
+
+    def heartbeat(self):
+        '''
+        Refresh the modification time of the claims of the worker.
+
+        Returns
+        -------
+        list of str
+            Galaxies whose claim was lost (taken over by another worker).
+        '''
+        lost = []
+        with self._lock:
+            claimed = [g for g in self.claimed if g not in self.lost]
+        for galaxy in claimed:
+            if self._owner(galaxy) == self.worker:
+                try:
+                    utime(self._path('claims', galaxy))
+                    continue
+                except FileNotFoundError:
+                    pass
+            lost.append(galaxy)
+            print_level(f'{self.queue_dir}: {galaxy}: claim lost by {self.worker}')
+        with self._lock:
+            self.lost += lost
+        return lost
+
+    def owns(self, galaxy):
+        '''
+        Check if the worker still holds the claim of `galaxy`.
+        '''
+        with self._lock:
+            if (galaxy not in self.claimed) or (galaxy in self.lost):
+                return False
+        return self._owner(galaxy) == self.worker
+
+    def check(self, galaxy):
+        '''
+        Check that the worker still holds the claim of `galaxy`, before
+        building (or writing) any of its products.
+
+        Raises
+        ------
+        RuntimeError
+            If the claim was lost (taken over by another worker).
+        '''
+        if not self.owns(galaxy):
+            raise RuntimeError(f'{self.queue_dir}: {galaxy}: claim lost by {self.worker}')
+
+    def _heartbeat_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.heartbeat()
+
+    def start_heartbeat(self, interval=None):
+        '''
+        Refresh the claims every `interval` seconds (by default a third of
+        the lease) in a background thread, until :meth:`stop`.
+        '''
+        interval = self.lease/3 if interval is None else interval
+        self._heartbeat_thread = Thread(target=self._heartbeat_loop, args=(interval,), daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop(self):
+        '''
+        Stop the heartbeat thread and the waits of :meth:`next`.
+        '''
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def release(self, galaxy, status, error=None):
+        '''
+        Record the result of a claimed galaxy (``done`` and ``skipped`` at
+        ``done/``, ``failed`` at ``failed/``) and remove its claim. The
+        result of a galaxy whose claim was lost is not recorded.
+        '''
+        with self._lock:
+            if galaxy not in self.claimed:
+                return
+            self.claimed.remove(galaxy)
+            if galaxy in self.lost:
+                self.lost.remove(galaxy)
+        if self._slots is not None:
+            self._slots.release()
+        claim = self._path('claims', galaxy)
+        if self._owner(galaxy) != self.worker:
+            print_level(f'{self.queue_dir}: {galaxy}: claim lost by {self.worker}, result not recorded')
+            return
+        kind = 'failed' if status == 'failed' else 'done'
+        filename = self._path(kind, galaxy)
+        tmp = self._tmp(filename)
+        self._write(tmp, dict(status=status, error=error, worker=self.worker, time=time()))
+        replace(tmp, filename)
+        remove(claim)
+
+    def status(self, galaxies):
+        '''
+        Number of galaxies of `galaxies` by state.
+
+        Returns
+        -------
+        dict
+            Number of ``done``, ``failed``, ``claimed`` and ``todo``
+            galaxies.
+        '''
+        count = {'done': 0, 'failed': 0, 'claimed': 0, 'todo': 0}
+        for galaxy in galaxies:
+            for kind in ['done', 'failed', 'claims']:
+                try:
+                    stat(self._path(kind, galaxy))
+                    count['claimed' if kind == 'claims' else kind] += 1
+                    break
+                except FileNotFoundError:
+                    continue
+            else:
+                count['todo'] += 1
+        return count
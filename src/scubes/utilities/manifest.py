@@ -0,0 +1,127 @@
+import json
+from time import time
+from socket import gethostname
+from contextlib import contextmanager
+from os import fsync, getpid
+
+from .io import print_level
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+class job_manifest:
+    '''
+    Durable append-only manifest (JSON lines) of the state of each galaxy
+    and stage of a batch run.
+
+    Each record is a line with the ``galaxy``, the ``stage`` (e.g.
+    ``download``, ``cube``, ``ml2header``, ``splots``, ``mask`` or
+    ``galaxy`` for the whole galaxy), its ``status`` (``started``,
+    ``done``, ``skipped`` or ``failed``), the ``error``, the ``time``, the
+    ``host`` and the ``pid``. Each line is written with an exclusive lock
+    and synced to disk before the stage goes on, so the manifest survives
+    a crash of the batch (a partially written last line is ignored).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the manifest. It is created if it does not exist.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Methods
+    -------
+    record(galaxy, stage, status, error=None)
+        Append a record.
+
+    states()
+        Last status of each stage of each galaxy.
+
+    galaxy_status(galaxy)
+        Status of a galaxy.
+    '''
+    def __init__(self, filename, verbose=0):
+        self.filename = filename
+        self.verbose = verbose
+        self._host = gethostname()
+
+    @contextmanager
+    def _locked(self, f):
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def record(self, galaxy, stage, status, error=None):
+        '''
+        Append a record to the manifest, after a newline if the last line
+        is a partial record (interrupted write).
+        '''
+        rec = dict(galaxy=galaxy, stage=stage, status=status, error=error, time=time(), host=self._host, pid=getpid())
+        line = (json.dumps(rec) + '\n').encode()
+        with open(self.filename, 'ab+') as f:
+            with self._locked(f):
+                # a crash could leave a partial last line, the record starts at a new line
+                if f.seek(0, 2) > 0:
+                    f.seek(-1, 2)
+                    if f.read(1) != b'\n':
+                        line = b'\n' + line
+                f.write(line)
+                f.flush()
+                fsync(f.fileno())
+        print_level(f'{self.filename}: {galaxy}: {stage}: {status}', 2, self.verbose)
+
+    def records(self):
+        '''
+        Read the records of the manifest.
+
+        Returns
+        -------
+        list of dict
+            Records in the order they were written.
+        '''
+        recs = []
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        recs.append(json.loads(line))
+                    except ValueError:
+                        # interrupted write
+                        continue
+        except FileNotFoundError:
+            pass
+        return recs
+
+    def states(self):
+        '''
+        Last status of each stage of each galaxy.
+
+        Returns
+        -------
+        dict
+            ``{galaxy: {stage: status}}``.
+        '''
+        states = {}
+        for rec in self.records():
+            states.setdefault(rec['galaxy'], {})[rec['stage']] = rec['status']
+        return states
+
+    def galaxy_status(self, galaxy, states=None):
+        '''
+        Status of a galaxy: ``done`` (or ``skipped``) and ``failed`` if the
+        galaxy finished, ``running`` if it was started and not finished
+        (e.g. the batch crashed) and None if it was never started.
+        '''
+        states = self.states() if states is None else states
+        stages = states.get(galaxy, None)
+        if not stages:
+            return None
+        status = stages.get('galaxy', None)
+        return 'running' if status in [None, 'started'] else status
@@ -1,27 +1,24 @@
 import sys
 import numpy as np
+from os.path import join, dirname
 from astropy.io import fits
 from astropy.wcs import WCS
 from scipy.ndimage import median_filter
 from astropy.nddata.utils import Cutout2D
 from astropy.stats import sigma_clipped_stats
-from regions import PixCoord, CirclePixelRegion 
-from photutils.aperture import CircularAperture
-from photutils.detection import DAOStarFinder, StarFinder
-from photutils.segmentation import make_2dgaussian_kernel, \
-    detect_sources, deblend_sources
 
 from .io import print_level
 from .psf import calc_PSF_scube
-from .plots import plot_masks_psf, plot_extra_sources, plot_scube_RGB_mask_sky, \
-        plot_violin_reescaled_error_spectrum, plot_masks_final_plot
+from .timings import stage_timer
 
 def _star_fwhm_calc_apertures(data, centers, star_peak, individual=False, star_threshold=50, worst_psf=3, star_size_calc='sky', med_sqrt=False, save_plot=None):
+    from regions import PixCoord, CirclePixelRegion
+
     mean, _, std = sigma_clipped_stats(data)
+    norm = 2*np.sqrt(2*np.log(2))
     if individual:
         psf__bsxy = calc_PSF_scube(data, centers_xy=centers, med_sqrt=med_sqrt, save_plot=save_plot)
         psf = np.ma.median(np.ma.sqrt(psf__bsxy[:, :, 1]**2 + psf__bsxy[:, :, 0]**2), axis=0)
-        norm = 2*np.sqrt(2*np.log(2))
         sig = np.where(psf.mask, worst_psf/norm, psf/norm)
         if star_size_calc == 'sky':
             ratios = np.sqrt(-2*sig**2*np.log(mean/(star_peak)))
@@ -76,9 +73,23 @@ class masks_builder:
         self.scube = scube        
         self.args = args   
         self._init_vars()
+        self._init_timer()
+
+    def _init_timer(self):
+        # the stages records and profiles are written next to the cube
+        args = self.args
+        scube = self.scube
+        profile = getattr(args, 'profile', None)
+        self.timings_path = join(dirname(scube.filename), f'{scube.galaxy}_timings.jsonl')
+        self.timer = stage_timer(
+            enabled=getattr(args, 'timings', False) or bool(profile), profile=profile,
+            profile_dir=dirname(scube.filename), prefix=f'{scube.galaxy}_',
+            context=dict(galaxy=scube.galaxy, task='scube_mask'),
+            verbose=getattr(args, 'verbose', 0),
+        )
     
     def _init_vars(self):
-        self.mask_has_inf_err__yx = np.isinf(self.scube.eflux__lyx).sum(axis=0) > 0
+        self.mask_has_inf_err__yx = (~np.isfinite(self.scube.eflux__lyx)).sum(axis=0) > 0
         self.mask_stars__yx = None
         self.mask_stars_pos__xy = None
         self.iso_mask__yx = None
@@ -191,6 +202,12 @@ class masks_builder:
         Update Eduardo@RV 17/02/2025 - convert to :class:`scubes.readscube.read_scube` usage.
         """     
         import matplotlib.pyplot as plt
+        from photutils.aperture import CircularAperture
+        from photutils.detection import DAOStarFinder, StarFinder
+        from photutils.segmentation import make_2dgaussian_kernel, \
+            detect_sources, deblend_sources
+        from .plots import plot_masks_psf, plot_extra_sources
+
         plt.ion()
 
         if detection not in ['DAOStarFinde', 'StarFinder']:
@@ -419,46 +436,62 @@ class masks_builder:
 
     def mask_procedure(self):
         from matplotlib import pyplot as plt
+        from .plots import plot_scube_RGB_mask_sky, plot_violin_reescaled_error_spectrum, \
+            plot_masks_final_plot
         
         scube = self.scube
         args = self.args
-
-        self.build_star_mask(
-            star_threshold=args.mask_stars_threshold, 
-            bands=args.mask_stars_bands, 
-            worst_psf=(scube.psf_fwhm/scube.pixscale).max(), 
-            xsource_std_f=args.xsource_std_f, 
-            star_size_calc=args.star_size_calc,
-            save_fig=f'{scube.galaxy}_build_stars_mask.png',
-            star_fwhm_individual_calc=args.star_fwhm_individual_calc,
-            no_interact=args.no_interact,
-        )
-        self.isophot_mask(
-            band=7, 
-            isophotal_limit=args.mask_isophotal_limit, 
-            isophotal_medsize=args.mask_isophotal_medsize, 
-            stars_mask=self.mask_stars__yx, 
-            clean_polygons=True
-        )
-        tmask__yx = self.tot_mask()
-        if tmask__yx is not None:
-            fmask__yx = self.final_mask()
-        if fmask__yx is not None:
-            self.mask_sky(
-                ref_mag_filt=7,
-                isophotal_limit=args.sky_isophotal_limit, 
-                isophotal_medsize=args.sky_isophotal_medsize, 
-                stars_mask=(self.final_mask__yx != 2), 
-                n_sigma=args.sky_n_sigma, 
-                n_iter=args.sky_n_iter, 
-                clip_neg=args.sky_clip_neg
+        timer = self.timer
+
+        with timer.span('stars_mask'):
+            self.build_star_mask(
+                star_threshold=args.mask_stars_threshold, 
+                bands=args.mask_stars_bands, 
+                worst_psf=(scube.psf_fwhm/scube.pixscale).max(), 
+                xsource_std_f=args.xsource_std_f, 
+                star_size_calc=args.star_size_calc,
+                save_fig=f'{scube.galaxy}_build_stars_mask.png',
+                star_fwhm_individual_calc=args.star_fwhm_individual_calc,
+                no_interact=args.no_interact,
+            )
+        with timer.span('isophotal_mask'):
+            self.isophot_mask(
+                band=7, 
+                isophotal_limit=args.mask_isophotal_limit, 
+                isophotal_medsize=args.mask_isophotal_medsize, 
+                stars_mask=self.mask_stars__yx, 
+                clean_polygons=True
             )
+        with timer.span('final_mask'):
+            tmask__yx = self.tot_mask()
+            if tmask__yx is not None:
+                fmask__yx = self.final_mask()
+        if fmask__yx is not None:
+            with timer.span('sky_mask'):
+                self.mask_sky(
+                    ref_mag_filt=7,
+                    isophotal_limit=args.sky_isophotal_limit, 
+                    isophotal_medsize=args.sky_isophotal_medsize, 
+                    stars_mask=(self.final_mask__yx != 2), 
+                    n_sigma=args.sky_n_sigma, 
+                    n_iter=args.sky_n_iter, 
+                    clip_neg=args.sky_clip_neg
+                )
         if self.sky is not None:
-            plot_scube_RGB_mask_sky(scube, self)
-            self.rescaled_error_spectrum()               
-            plot_violin_reescaled_error_spectrum(scube, self)
-            self.build_final_hdul()
-            plot_masks_final_plot(scube, self)
+            with timer.span('plots'):
+                plot_scube_RGB_mask_sky(scube, self)
+            with timer.span('error_spectrum'):
+                self.rescaled_error_spectrum()               
+            with timer.span('plots'):
+                plot_violin_reescaled_error_spectrum(scube, self)
+            with timer.span('write'):
+                self.build_final_hdul()
+            with timer.span('plots'):
+                plot_masks_final_plot(scube, self)
+
+        if self.timer.records:
+            self.timer.write(self.timings_path)
+            print_level(f'stages timings: {self.timings_path}', 1, getattr(args, 'verbose', 0))
 
         if not args.no_interact:
             input('...press any key to close the plots...')
@@ -0,0 +1,239 @@
+import io
+import json
+import numpy as np
+from time import sleep
+from threading import Thread, Lock
+from urllib.request import urlopen
+from urllib.parse import urlencode, urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .io import print_level
+from .synthetic import synthetic_stamp
+
+class _mock_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        print_level(f'mock_cloud: {format % args}', 3, self.server.verbose)
+
+    def _params(self):
+        q = parse_qs(urlparse(self.path).query)
+        return {k: v[0] for k, v in q.items()}
+
+    def do_GET(self):
+        srv = self.server
+        route = urlparse(self.path).path.strip('/')
+        p = self._params()
+        srv.count(route)
+        if srv.latency:
+            sleep(srv.latency + srv.uniform(0, srv.latency_jitter))
+        if srv.fail():
+            self.send_error(503, 'mock_cloud: injected failure')
+            return
+        try:
+            if route == 'stamp':
+                body, ctype = srv.stamp_bytes(p), 'application/fits'
+            elif route == 'detection':
+                body, ctype = srv.detection_bytes(p), 'application/fits'
+            elif route == 'lupton':
+                body, ctype = srv.lupton_bytes(p), 'image/png'
+            elif route == 'stats':
+                body, ctype = json.dumps(srv.stats).encode(), 'application/json'
+            else:
+                self.send_error(404, f'{route}: unknown route')
+                return
+        except (FileNotFoundError, ValueError) as e:
+            self.send_error(404, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self._write_throttled(body)
+
+    def _write_throttled(self, body):
+        bw = self.server.bandwidth
+        if not bw:
+            self.wfile.write(body)
+            return
+        chunk = max(int(bw/20), 1024)
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            sleep(len(body[i:i + chunk])/bw)
+
+class mock_cloud_server(ThreadingHTTPServer):
+    '''
+    A local stand-in for the S-PLUS Cloud stamps service, used for offline
+    benchmarking and testing. It serves synthetic stamps (see 
+    :class:`scubes.utilities.synthetic.synthetic_field`) or stamps cut from
+    `fixtures_dir` tiles (see :class:`scubes.utilities.tiles.local_tiles`),
+    with S-PLUS-like headers.
+
+    Routes: ``/stamp``, ``/detection``, ``/lupton`` and ``/stats``. The
+    parameters are passed as query strings with the same names of the
+    :class:`splusdata.Core` methods.
+
+    Parameters
+    ----------
+    host : str, optional
+        Address to bind. Default is ``127.0.0.1``.
+
+    port : int, optional
+        Port to bind. Default is 0 (an ephemeral port).
+
+    fixtures_dir : str, optional
+        Directory with full-field tiles. If None, synthetic stamps are served.
+
+    latency : float, optional
+        Latency in seconds added to each request. Default is 0.
+
+    latency_jitter : float, optional
+        Maximum random latency in seconds added to `latency`. Default is 0.
+
+    bandwidth : float, optional
+        Bandwidth cap in bytes per second of each response. Default is None
+        (no cap).
+
+    failure_rate : float, optional
+        Probability of a request to fail with HTTP 503. Default is 0.
+
+    seed : int, optional
+        Seed of the random number generator of the latency jitter and of
+        the failure injection.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+    '''
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, fixtures_dir=None,
+                 latency=0, latency_jitter=0, bandwidth=None, failure_rate=0,
+                 seed=None, verbose=0):
+        super().__init__((host, port), _mock_handler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.verbose = verbose
+        self.stats = {}
+        self._rng = np.random.default_rng(seed)
+        self._lock = Lock()
+        self._thread = None
+        self._tiles = None
+        if fixtures_dir is not None:
+            from .tiles import local_tiles
+            self._tiles = local_tiles(fixtures_dir, verbose=verbose)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, route):
+        with self._lock:
+            self.stats[route] = self.stats.get(route, 0) + 1
+
+    def uniform(self, a, b):
+        with self._lock:
+            return self._rng.uniform(a, b)
+
+    def fail(self):
+        if not self.failure_rate:
+            return False
+        with self._lock:
+            failed = self._rng.uniform() < self.failure_rate
+            if failed:
+                self.stats['failures'] = self.stats.get('failures', 0) + 1
+        return failed
+
+    def _stamp_hdul(self, p, band=None, weight=None):
+        band = p['band'] if band is None else band
+        weight = (p.get('weight', 'False') == 'True') if weight is None else weight
+        ra, dec, size = float(p['ra']), float(p['dec']), int(p['size'])
+        tile = p.get('field_name', 'SPLUS-mock')
+        if self._tiles is not None:
+            return self._tiles.stamp(ra, dec, size, band, weight=weight, field_name=tile)
+        return synthetic_stamp(ra, dec, size, band, weight=weight, tile=tile)
+
+    def stamp_bytes(self, p):
+        buf = io.BytesIO()
+        self._stamp_hdul(p).writeto(buf)
+        return buf.getvalue()
+
+    def detection_bytes(self, p):
+        from .images import detection_image_hdul
+
+        bands = p.get('bands', 'G,R,I,Z').split(',')
+        hduls = [self._stamp_hdul(p, band=b, weight=False) for b in bands]
+        buf = io.BytesIO()
+        detection_image_hdul([h[1].data for h in hduls], [h[1].header for h in hduls], bands=bands).writeto(buf)
+        return buf.getvalue()
+
+    def lupton_bytes(self, p):
+        from .images import lupton_rgb_image
+
+        rgb = [self._stamp_hdul(p, band=p.get(c, d), weight=False)[1].data for c, d in zip('RGB', 'IRG')]
+        img = lupton_rgb_image(rgb, Q=float(p.get('Q', 8)), stretch=float(p.get('stretch', 3)), flip=True)
+        buf = io.BytesIO()
+        img.save(buf, 'PNG')
+        return buf.getvalue()
+
+    def start(self):
+        '''
+        Serve in a background (daemon) thread.
+        '''
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        print_level(f'mock_cloud: serving at {self.url}', 1, self.verbose)
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class mock_cloud_client:
+    '''
+    Client shim of :class:`mock_cloud_server` with the same interface of
+    the :class:`splusdata.Core` methods used by S-CUBES.
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the server (e.g. ``http://127.0.0.1:8000``).
+
+    timeout : float, optional
+        Default timeout of the requests in seconds. Default is 60.
+    '''
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, route, timeout=None, **params):
+        params = {k: v for k, v in params.items() if v is not None}
+        timeout = self.timeout if timeout is None else timeout
+        with urlopen(f'{self.url}/{route}?{urlencode(params)}', timeout=timeout) as r:
+            return r.read()
+
+    def stamp(self, ra, dec, size, band, weight=False, field_name=None, outfile=None, data_release='dr4', timeout=None, **kwargs):
+        from astropy.io import fits
+
+        body = self._get('stamp', timeout=timeout, ra=ra, dec=dec, size=size, band=band, weight=bool(weight), field_name=field_name, data_release=data_release)
+        if outfile is not None:
+            with open(outfile, 'wb') as f:
+                f.write(body)
+        return fits.open(io.BytesIO(body))
+
+    def stamp_detection(self, ra, dec, size, bands='G,R,I,Z', option=None, timeout=None, **kwargs):
+        from astropy.io import fits
+
+        body = self._get('detection', timeout=timeout, ra=ra, dec=dec, size=size, bands=bands, field_name=option)
+        return fits.open(io.BytesIO(body))
+
+    def lupton_rgb(self, ra, dec, size, R='I', G='R', B='G', Q=8, stretch=3, field_name=None, timeout=None, **kwargs):
+        from PIL import Image
+
+        body = self._get('lupton', timeout=timeout, ra=ra, dec=dec, size=size, R=R, G=G, B=B, Q=Q, stretch=stretch, field_name=field_name)
+        return Image.open(io.BytesIO(body))
+
+    def server_stats(self):
+        return json.loads(self._get('stats'))
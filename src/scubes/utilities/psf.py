@@ -1,8 +1,6 @@
 import numpy as np
 from scipy.optimize import curve_fit
 
-from .plots import plot_psf
-
 _delta_x2 = lambda x, x0: (x - x0)**2
 
 class PSFFitter:
@@ -79,6 +77,8 @@ def calc_PSF_scube(flux__lyx, centers_xy, sqr_cut=25, psf_function='gaussian', m
     psf__bsxy = np.ma.masked_where(psf__bsxy >= 7, psf__bsxy)
 
     if save_plot is not None:
+        from .plots import plot_psf
+
         plot_psf(psf__bsxy, filename=save_plot)
 
     if med_sqrt:
@@ -0,0 +1,295 @@
+import json
+import random
+import threading
+from time import time, sleep, perf_counter
+from contextlib import contextmanager
+from os import makedirs, replace, getpid
+from os.path import dirname, expanduser
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+from .io import print_level
+
+RATE_LIMIT_FILE = '~/.cache/scubes/ratelimit.json'
+
+def backoff_delay(attempt, base=0.5, max_delay=30, rng=random):
+    '''
+    Exponential backoff with full jitter: a random delay between 0 and
+    ``min(max_delay, base*2**attempt)`` seconds.
+
+    Parameters
+    ----------
+    attempt : int
+        Number of the failed attempt (from 0).
+
+    base : float, optional
+        Delay scale in seconds. Default is 0.5.
+
+    max_delay : float, optional
+        Maximum delay in seconds. Default is 30.
+
+    Returns
+    -------
+    float
+        Delay in seconds.
+    '''
+    return rng.uniform(0, min(max_delay, base*2**attempt))
+
+class token_bucket:
+    '''
+    Token bucket limiting the rate of requests. The bucket can be shared
+    by all the processes of a host through a state file (locked with
+    :func:`fcntl.flock`), so several batch workers share the same budget.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens (requests) per second.
+
+    burst : float, optional
+        Size of the bucket (maximum burst of requests). Default is `rate`
+        (at least 1).
+
+    state_file : str, optional
+        JSON file with the state of the bucket shared between processes.
+        If None, the bucket is local to the process.
+    '''
+    def __init__(self, rate, burst=None, state_file=None):
+        self.rate = float(rate)
+        self.burst = max(1.0, self.rate if burst is None else float(burst))
+        self.state_file = None if state_file is None else expanduser(state_file)
+        self._lock = threading.Lock()
+        self._state = dict(tokens=self.burst, t=time())
+        if self.state_file is not None:
+            makedirs(dirname(self.state_file) or '.', exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self.state_file is None:
+                yield
+                return
+            with open(f'{self.state_file}.lock', 'a') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self):
+        if self.state_file is None:
+            return self._state
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            return dict(tokens=float(state['tokens']), t=float(state['t']))
+        except (OSError, ValueError, KeyError, TypeError):
+            return dict(tokens=self.burst, t=time())
+
+    def _write(self, state):
+        if self.state_file is None:
+            self._state = state
+            return
+        tmp = f'{self.state_file}.{getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        replace(tmp, self.state_file)
+
+    def _take(self):
+        with self._locked():
+            state = self._read()
+            now = time()
+            tokens = min(self.burst, state['tokens'] + max(0, now - state['t'])*self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens)/self.rate
+            self._write(dict(tokens=tokens, t=now))
+        return wait
+
+    def acquire(self):
+        '''
+        Take a token, waiting for it if the bucket is empty.
+        '''
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            sleep(wait)
+
+class adaptive_limiter:
+    '''
+    Adaptive limiter of the data-source requests: a concurrency limit
+    adjusted by AIMD (additive increase, multiplicative decrease) and an
+    optional :class:`token_bucket` rate limit.
+
+    The concurrency limit starts at `max_concurrency`, so the stamps of a
+    cube are requested at once, and is halved on failures. It increases
+    again by one request per round trip (i.e. ``1/limit`` per successful
+    request) up to `max_concurrency`. It is also reduced when the smoothed latency grows
+    above `latency_factor` times the best smoothed latency observed, a
+    sign of a saturated link or server. The decreases happen at most once
+    per smoothed latency, so a burst of failures of the requests in flight
+    counts once. The failed requests are retried after
+    :func:`backoff_delay`.
+
+    The concurrency limit is local to the process (several processes of
+    the host can run up to `max_concurrency` requests each), only the rate
+    limit can be shared between processes.
+
+    Parameters
+    ----------
+    max_concurrency : int, optional
+        Maximum number of simultaneous requests. Default is 1.
+
+    min_concurrency : int, optional
+        Minimum number of simultaneous requests. Default is 1.
+
+    initial_concurrency : int, optional
+        Initial limit. Default is `max_concurrency`.
+
+    rate : float, optional
+        Maximum requests per second. If None, the rate is not limited.
+
+    burst : float, optional
+        Maximum burst of requests of the rate limit. Default is `rate`.
+
+    state_file : str, optional
+        Rate limit state shared by the processes of the host (see
+        :class:`token_bucket`). If None, the rate limit is local.
+
+    latency_factor : float, optional
+        Latency degradation triggering a decrease. Default is 2.
+
+    backoff_base, backoff_max : float, optional
+        Parameters of :func:`backoff_delay`. Defaults are 0.5 and 30 s.
+
+    verbose : int, optional
+        Verbosity level. The limit changes are printed at level 2.
+
+    Attributes
+    ----------
+    limit : float
+        Current concurrency limit.
+    '''
+    _ewma_alpha = 0.2
+    _min_samples = 5
+
+    def __init__(self, max_concurrency=1, min_concurrency=1, initial_concurrency=None, rate=None, burst=None,
+                 state_file=None, latency_factor=2.0, backoff_base=0.5, backoff_max=30, verbose=0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = max(1, min(int(min_concurrency), self.max_concurrency))
+        if initial_concurrency is None:
+            initial_concurrency = self.max_concurrency
+        self.limit = float(min(max(initial_concurrency, self.min_concurrency), self.max_concurrency))
+        self.bucket = None if rate is None else token_bucket(rate, burst=burst, state_file=state_file)
+        self.latency_factor = latency_factor
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.verbose = verbose
+        self.in_flight = 0
+        self.latency = None
+        self.best_latency = None
+        self._n_samples = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        '''
+        Context manager waiting for a free slot of the concurrency limit
+        and for a token of the rate limit.
+        '''
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def request(self):
+        '''
+        Context manager running a request in a :meth:`slot` and updating
+        the limit with its outcome (:meth:`success` or :meth:`failure`).
+        '''
+        with self.slot():
+            t0 = perf_counter()
+            try:
+                yield
+            except Exception:
+                self.failure()
+                raise
+            self.success(perf_counter() - t0)
+
+    def _decrease(self, factor, reason):
+        now = time()
+        if now - self._last_decrease < (self.latency or 0):
+            return
+        self._last_decrease = now
+        old = self.limit
+        self.limit = max(self.min_concurrency, self.limit*factor)
+        print_level(f'adaptive_limiter: {reason}: concurrency {old:.1f} -> {self.limit:.1f}', 2, self.verbose)
+
+    def success(self, latency):
+        '''
+        Update the limit after a successful request of `latency` seconds.
+        '''
+        with self._cond:
+            self._n_samples += 1
+            a = self._ewma_alpha
+            self.latency = latency if self.latency is None else (1 - a)*self.latency + a*latency
+            if self._n_samples >= self._min_samples:
+                if (self.best_latency is None) or (self.latency < self.best_latency):
+                    self.best_latency = self.latency
+            if (self.best_latency is not None) and (self.latency > self.latency_factor*self.best_latency):
+                self._decrease(0.7, f'latency {self.latency:.2f} s')
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1/self.limit)
+            self._cond.notify_all()
+
+    def failure(self):
+        '''
+        Update the limit after a failed request.
+        '''
+        with self._cond:
+            self._decrease(0.5, 'failure')
+
+    def backoff(self, attempt):
+        '''
+        Sleep before retrying a request failed `attempt` + 1 times.
+        '''
+        sleep(backoff_delay(attempt, base=self.backoff_base, max_delay=self.backoff_max))
+
+def limiter_from_args(args):
+    '''
+    :class:`adaptive_limiter` configured by the ``scubes`` arguments
+    (``download_workers``, ``rate_limit``, ``rate_burst`` and
+    ``rate_limit_file``).
+
+    Parameters
+    ----------
+    args : :class:`argparse.Namespace` or :class:`scubes.control.control`
+        The arguments.
+
+    Returns
+    -------
+    :class:`adaptive_limiter`
+        The limiter.
+    '''
+    return adaptive_limiter(
+        max_concurrency=args.download_workers, rate=args.rate_limit, burst=args.rate_burst,
+        state_file=args.rate_limit_file, verbose=args.verbose,
+    )
@@ -1,8 +1,7 @@
 import sys
 import numpy as np
+from functools import cached_property
 import astropy.units as u
-from os.path import isfile
-from astropy.io import fits
 from astropy.wcs import WCS
 from argparse import Namespace
 from copy import deepcopy as copy
@@ -12,7 +11,8 @@ from astropy.visualization import make_lupton_rgb
 
 from .io import print_level
 from .sky import get_iso_sky
-from ..constants import METADATA_NAMES, BANDS
+from .h5scube import open_scube
+from ..constants import METADATA_NAMES
 
 class tupperware_none(Namespace):
     def __init__(self):
@@ -95,7 +95,6 @@ def make_RGB_tom(flux__lyx,
         # astropy.visualization.make_lupton_rgb() input vars
         minimum=(0, 0, 0), Q=0, stretch=10):
     # get filters index(es)
-    pmin, pmax = pminmax
     RGB = []
     for f_tup in rgb:
         # get fluxes list
@@ -108,7 +107,12 @@ def make_RGB_tom(flux__lyx,
         else:
             i_f.append(f_tup)
         C = copy(flux__lyx[i_f, :, :]).sum(axis=0)
+        if pminmax is None:
+            # no rescale
+            RGB.append(C)
+            continue
         # percentiles
+        pmin, pmax = pminmax
         Cmin, Cmax = np.nanpercentile(C, pmin), np.nanpercentile(C, pmax)
         # calc color intensities
         RGB.append(im_max*(C - Cmin)/(Cmax - Cmin))
@@ -277,7 +281,9 @@ class read_scube:
     Parameters
     ----------
     filename : str
-        The path to the FITS file to be read and processed.
+        The path to the FITS file to be read and processed. Files ending 
+        with ``.h5`` or ``.hdf5`` are read as HDF5 cubes (see 
+        :class:`scubes.utilities.h5scube.scube_hdf5`).
 
     Attributes
     ----------
@@ -300,10 +306,12 @@ class read_scube:
         Integer pixel coordinates of the central sky position.
     
     mag_arcsec2__lyx : np.ndarray
-        The magnitude per square arcsecond for each layer in the data cube.
+        The magnitude per square arcsecond for each layer in the data cube
+        (computed, and the cube read, at the first access).
     
     emag_arcsec2__lyx : np.ndarray
-        The error in the magnitude per square arcsecond.
+        The error in the magnitude per square arcsecond (computed at the
+        first access).
     
     pa, ba : float
         Position angle (pa) and axis ratio (ba) for pixel distance calculations.
@@ -334,11 +342,8 @@ class read_scube:
     _init_centre()
         Calculates the central coordinates of the object in pixel space.
     
-    _mag_values()
-        Computes magnitude values and their errors for each layer in the data cube.
-    
     _init()
-        Initializes WCS, central coordinates, and magnitude values.
+        Initializes WCS and central coordinates.
     
     lRGB_image(rgb, rgb_f, pminmax, im_max, minimum, Q, stretch)
         Creates an RGB image from the data cube using specified filters.
@@ -351,6 +356,9 @@ class read_scube:
     
     mask_optimal()
         Generates a mask for optimal data handling based on flux and error values.
+
+    pixel_spectrum(x, y)
+        Reads the flux and error spectra of a single pixel.
     '''
     def __init__(self, filename):
         '''
@@ -377,7 +385,7 @@ class read_scube:
             If the specified file does not exist.
         '''              
         try:
-            self._hdulist = fits.open(self.filename)
+            self._hdulist = open_scube(self.filename)
         except FileNotFoundError:
             print_level(f'{self.filename} - file not found')
             sys.exit()
@@ -397,28 +405,15 @@ class read_scube:
         self.i_x0 = int(self.x0)
         self.i_y0 = int(self.y0)
 
-    def _mag_values(self):
-        '''
-        Computes the magnitude per square arcsecond and corresponding errors from the flux values.
-        '''
-        _c = const.c.to(u.AA/u.s)  # speed of light in AA/s
-        ABmag_ZP = 3631*u.Jy
-        a = 1/(_c*ABmag_ZP.to(self.fnu_unit)*self.pixscale**2)
-        #a = 1/(2.997925e18*3631.0e-23*self.pixscale**2)
-        x = a.value*(self.flux__lyx*self.pivot_wave[:, np.newaxis, np.newaxis]**2)
-        self.mag_arcsec2__lyx = -2.5*np.log10(x)
-        self.emag_arcsec2__lyx = (2.5*np.log10(np.exp(1)))*self.eflux__lyx/self.flux__lyx
-
     def _init(self):
         '''
-        Initializes the class by setting WCS, central coordinates, and magnitude values.
+        Initializes the class by setting WCS and central coordinates.
         Also calculates the pixel distance from the central coordinates.
         '''        
         self._init_wcs()
         self._init_centre()
-        self._mag_values()
         self.pa, self.ba = 0, 1
-        self.pixel_distance__yx = get_image_distance(self.weimask__yx.shape, x0=self.x0, y0=self.y0, pa=self.pa, ba=self.ba)
+        self.pixel_distance__yx = get_image_distance((self.n_y, self.n_x), x0=self.x0, y0=self.y0, pa=self.pa, ba=self.ba)
 
     def lRGB_image(
         self, rgb=(7, 5, 9), rgb_f=(1, 1, 1), 
@@ -486,7 +481,7 @@ class read_scube:
                          sextractor, username, password, 
                          class_star=0.25, satur_level=1600, back_size=64, 
                          detect_thresh=1.1, estimate_fwhm=False,
-                         force=False, verbose=0):
+                         force=False, download_images=False, verbose=0):
         '''
         Runs source extraction on the data cube using SExtractor.
 
@@ -518,14 +513,17 @@ class read_scube:
         
         force : bool, optional
             If True, force re-running source extraction (default is False).
+
+        download_images : bool, optional
+            If True, download the detection and RGB images from the S-PLUS
+            Cloud instead of building them from the stamps next to the
+            cube or from the cube (default is False).
         
         verbose : int, optional
             Verbosity level of the source extraction process (default is 0).
         '''        
-        from ..headers import get_author
         from ..mask_stars import maskStars
-        from .splusdata import connect_splus_cloud, detection_image_hdul
-        from .utils import _get_lupton_RGB, sex_mask_stars_cube_argsparse
+        from .utils import _sex_mask_stars_images, scube_sex_mask_stars_argsparse
 
         args = tupperware_none()
         args.sextractor = sextractor
@@ -539,29 +537,12 @@ class read_scube:
         args.no_interact = True
         args.username = username
         args.password = password
+        args.download_images = download_images
         args.cube_path = self.filename
-        args = sex_mask_stars_cube_argsparse(args)
-
-        conn = connect_splus_cloud(username, password)
-        detection_image = f'{self.galaxy}_detection.fits'
-
-        if not isfile(detection_image) or force:
-            print_level(f'{self.galaxy} @ {self.tile} - downloading detection image')
-            kw = dict(ra=self.ra, dec=self.dec, size=self.size, bands=BANDS, option=self.tile)
-            hdul = detection_image_hdul(conn, **kw)
-
-            author = get_author(hdul[1].header)
-
-            # ADD AUTHOR TO HEADER IF AUTHOR IS UNKNOWN
-            if author == 'unknown':
-                author = 'scubes'
-                hdul[1].header.set('AUTHOR', value=author, comment='Who ran the software')
-            # SAVE DETECTION FITS
-            hdul.writeto(detection_image, overwrite=force)
-        else:
-            print_level('Detection file exists.')
+        args = scube_sex_mask_stars_argsparse(args)
 
-        _ = maskStars(args=args, detection_image=detection_image, lupton_rgb=_get_lupton_RGB(conn, args, save_img=False), output_dir='.')
+        detection_image, lupton_rgb = _sex_mask_stars_images(args)
+        _ = maskStars(args=args, detection_image=detection_image, lupton_rgb=lupton_rgb, output_dir='.')
         self.mask_stars_filename = _.filename
         self.detection_image_filename = _.detection_image
         self.mask_stars_hdul = _.hdul
@@ -672,6 +653,36 @@ class read_scube:
         mb.mask_procedure()
         self.mask_builder = mb
 
+    def pixel_spectrum(self, x, y):
+        '''
+        Read the flux and error spectra of a single pixel. Only the image 
+        region (or the HDF5 chunks) containing the pixel is read.
+
+        Parameters
+        ----------
+        x, y : int
+            Pixel coordinates.
+
+        Returns
+        -------
+        tuple of np.ndarray
+            Flux and error spectra.
+        '''
+        f__l = self._pixel_section('DATA', x, y)
+        ef__l = self._pixel_section('ERRORS', x, y)
+        return f__l, ef__l
+
+    def _pixel_section(self, extname, x, y):
+        '''
+        Spectrum of a pixel of the `extname` extension. The already loaded
+        data is indexed instead (astropy fails to apply ``BSCALE`` and
+        ``BLANK`` to the section of a loaded scaled integer HDU).
+        '''
+        hdu = self._hdulist[extname]
+        if getattr(hdu, '_data_loaded', False):
+            return hdu.data[:, y, x]
+        return hdu.section[:, y, x]
+
     def get_filter_i(self, filt):
         return self.filters.index(filt)
     
@@ -767,6 +778,25 @@ class read_scube:
     def SN__lyx(self):
         return self.flux__lyx/self.eflux__lyx
 
+    @cached_property
+    def mag_arcsec2__lyx(self):
+        '''
+        Magnitude per square arcsecond of each layer of the data cube.
+        '''
+        _c = const.c.to(u.AA/u.s)  # speed of light in AA/s
+        ABmag_ZP = 3631*u.Jy
+        a = 1/(_c*ABmag_ZP.to(self.fnu_unit)*self.pixscale**2)
+        #a = 1/(2.997925e18*3631.0e-23*self.pixscale**2)
+        x = a.value*(self.flux__lyx*self.pivot_wave[:, np.newaxis, np.newaxis]**2)
+        return -2.5*np.log10(x)
+
+    @cached_property
+    def emag_arcsec2__lyx(self):
+        '''
+        Error of the magnitude per square arcsecond.
+        '''
+        return (2.5*np.log10(np.exp(1)))*self.eflux__lyx/self.flux__lyx
+
     @property
     def mag__lyx(self):
         return self.mag_arcsec2__lyx
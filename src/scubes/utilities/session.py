@@ -0,0 +1,418 @@
+import json
+import base64
+import threading
+from time import time, sleep, perf_counter
+from contextlib import contextmanager, nullcontext
+from os import makedirs, replace, getpid, open as os_open, fdopen, O_WRONLY, O_CREAT, O_TRUNC
+from os.path import dirname, expanduser
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+from .io import print_level
+from .telemetry import _error_reason
+from .ratelimit import backoff_delay
+
+SPLUS_CLOUD_URL = 'https://splus.cloud'
+TOKEN_CACHE_FILE = '~/.cache/scubes/splus_token.json'
+
+# a token expiring in less than this (seconds) is refreshed before the requests
+_TOKEN_EXPIRY_MARGIN = 60
+
+# versions (major, minor) whose private internals (``Auth._client``, the
+# ``Auth.download_bytes`` helper and the attributes set by ``Core.__init__``)
+# are used by splus_session
+_ADSS_VERSIONS = ((1, 34), (1, 45))
+_SPLUSDATA_VERSIONS = ((5, 39), (5, 56))
+
+def _version(package):
+    import re
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        return tuple(int(_) for _ in re.findall(r'\d+', version(package))[:2])
+    except (PackageNotFoundError, ValueError):
+        return None
+
+def internals_supported():
+    '''
+    Check if the installed adss and splusdata versions have the private
+    internals used by :class:`splus_session` (keep-alive connections and 
+    transparent token refresh).
+    '''
+    for package, (vmin, vmax) in [('adss', _ADSS_VERSIONS), ('splusdata', _SPLUSDATA_VERSIONS)]:
+        v = _version(package)
+        if (v is None) or not (vmin <= v <= vmax):
+            return False
+    return True
+
+def token_expiry(token):
+    '''
+    Expiration time (``exp`` claim, unix time) of a JSON Web Token.
+
+    Returns
+    -------
+    float or None
+        The expiration time (None if `token` is not a JWT or has no
+        ``exp`` claim).
+    '''
+    try:
+        payload = token.split('.')[1]
+        payload += '='*(-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (AttributeError, IndexError, ValueError, KeyError, TypeError):
+        return None
+
+class token_cache:
+    '''
+    On-disk cache of the S-PLUS Cloud tokens, readable only by the user
+    (mode 0600), so the processes of a batch share a login. The logins are
+    serialized by a lock file, so concurrent workers log in only once.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Cache file. Default is :data:`TOKEN_CACHE_FILE`.
+    '''
+    def __init__(self, filename=TOKEN_CACHE_FILE):
+        self.filename = expanduser(filename)
+        makedirs(dirname(self.filename) or '.', mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def _key(server, username):
+        return f'{username}@{server}'
+
+    @contextmanager
+    def locked(self):
+        '''
+        Exclusive lock of the cache, shared between processes.
+        '''
+        with open(f'{self.filename}.lock', 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, server, username):
+        '''
+        Cached token of `username` at `server` (None if missing or
+        expired).
+        '''
+        token = self._read().get(self._key(server, username), None)
+        exp = token_expiry(token)
+        if (exp is not None) and (exp - time() < _TOKEN_EXPIRY_MARGIN):
+            return None
+        return token
+
+    def put(self, server, username, token):
+        '''
+        Store the token of `username` at `server`.
+        '''
+        tokens = self._read()
+        tokens[self._key(server, username)] = token
+        tmp = f'{self.filename}.{getpid()}.tmp'
+        with fdopen(os_open(tmp, O_WRONLY | O_CREAT | O_TRUNC, 0o600), 'w') as f:
+            json.dump(tokens, f)
+        replace(tmp, self.filename)
+
+class splus_session:
+    '''
+    Process-wide authenticated S-PLUS Cloud session.
+
+    :meth:`get` returns the same session (and :class:`splusdata.Core`
+    connection, :attr:`conn`) to every caller of the process with the same
+    server and username, so the galaxies of a batch, the masks and the RGB
+    images downloads log in once. The HTTP connections are kept alive and
+    reused (up to `max_connections`). An expired token (``exp`` claim or a
+    401 response) is refreshed transparently with a new login, for the 
+    queries and for the stamp downloads, and the token can be cached on 
+    disk (see :class:`token_cache`) to share a login between processes.
+
+    The keep-alive connections and the token refresh use private internals
+    of adss and splusdata, only for the versions where they were checked 
+    (see :func:`internals_supported`). With other versions a plain 
+    :class:`splusdata.Core` connection is used.
+
+    Parameters
+    ----------
+    username : str, optional
+        S-PLUS Cloud username. Asked interactively if needed.
+
+    password : str, optional
+        S-PLUS Cloud password. Asked interactively if needed.
+
+    server : str, optional
+        S-PLUS Cloud URL. Default is :data:`SPLUS_CLOUD_URL`.
+
+    token_file : str, optional
+        Token cache file (see :class:`token_cache`). If None, the token is
+        not cached.
+
+    max_connections : int, optional
+        Size of the keep-alive connections pool. Default is 16.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+    '''
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(self, username=None, password=None, server=SPLUS_CLOUD_URL, token_file=None, max_connections=16, verbose=0):
+        self.username = username
+        self.password = password
+        self.server = server
+        self.cache = None if token_file is None else token_cache(token_file)
+        self.max_connections = max_connections
+        self.verbose = verbose
+        self.conn = None
+        self.n_logins = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def get(cls, username=None, password=None, server=SPLUS_CLOUD_URL, token_file=None, max_connections=16, stats=None, verbose=0):
+        '''
+        Connected session of the process for `username` at `server`,
+        created (and logged in) at the first call.
+
+        Parameters
+        ----------
+        stats : :class:`scubes.utilities.telemetry.download_stats`, optional
+            Records the logins.
+
+        See :class:`splus_session` for the other parameters.
+
+        Returns
+        -------
+        :class:`splus_session`
+            The session.
+        '''
+        with cls._sessions_lock:
+            session = cls._sessions.get((server, username), None)
+            if session is None:
+                session = cls(username, password, server, token_file, max_connections, verbose)
+                cls._sessions[(server, username)] = session
+        session.connect(stats=stats)
+        return session
+
+    @classmethod
+    def close_all(cls):
+        '''
+        Close the connections of all the sessions of the process.
+        '''
+        with cls._sessions_lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions = {}
+
+    def _credentials(self):
+        if not self.username:
+            self.username = input('splus.cloud username: ')
+        if not self.password:
+            import getpass
+            self.password = getpass.getpass('splus.cloud password: ')
+
+    def _client(self):
+        from adss import ADSSClient
+
+        class _client(ADSSClient):
+            # the login is done (or the cached token is set) by the session
+            def login(self, username, password, **kwargs):
+                return None
+
+        client = _client(self.server, username='-', password='-')
+        self._keep_alive(client.auth)
+        self._refresh_on_401(client.auth)
+        return client
+
+    def _keep_alive(self, auth):
+        # adss opens a new connection per request (no keep-alive)
+        try:
+            import httpx
+            from adss import auth as adss_auth
+
+            old = auth._client
+            auth._client = httpx.Client(
+                trust_env=getattr(adss_auth, '_TRUST_ENV', True), verify=auth.verify_ssl,
+                limits=httpx.Limits(max_keepalive_connections=self.max_connections, max_connections=self.max_connections),
+            )
+            old.close()
+        except (ImportError, AttributeError) as e:
+            print_level(f'splus_session: keep-alive connections not available: {e}', 1, self.verbose)
+
+    def _refresh_on_401(self, auth):
+        '''
+        Wrap the requests of `auth`: ``request`` (queries) and the streaming
+        ``download`` and ``download_bytes`` (stamps and images), which build
+        their headers from ``auth.token`` or get them from the caller. Each 
+        request uses a fresh token and, if the server answers 401 (returned
+        by ``request``, raised by the downloads), is repeated once after a 
+        new login.
+        '''
+        from adss.exceptions import ADSSClientError
+
+        session = self
+
+        def _with_token(headers, token):
+            if headers and ('Authorization' in headers):
+                headers = {**headers, 'Authorization': f'Bearer {token}'}
+            return headers
+
+        def _refreshing(func):
+            def _call(method, url, headers=None, auth_required=False, **kwargs):
+                if not (auth_required or (headers and 'Authorization' in headers)):
+                    # e.g. the login itself
+                    return func(method, url, headers=headers, auth_required=auth_required, **kwargs)
+                token = session.fresh_token()
+                try:
+                    resp = func(method, url, headers=_with_token(headers, token), auth_required=auth_required, **dict(kwargs))
+                    refused = getattr(resp, 'status_code', None) == 401
+                except ADSSClientError as e:
+                    refused = getattr(getattr(e, 'response', None), 'status_code', None) == 401
+                    if not refused:
+                        raise
+                if refused:
+                    print_level(f'splus_session: {session.username}: token refused, logging in again', 1, session.verbose)
+                    token = session.refresh(token)
+                    resp = func(method, url, headers=_with_token(headers, token), auth_required=auth_required, **dict(kwargs))
+                return resp
+            return _call
+
+        auth.request = _refreshing(auth.request)
+        auth.download = _refreshing(auth.download)
+        auth.download_bytes = _refreshing(auth.download_bytes)
+
+    def connect(self, stats=None):
+        '''
+        Create the connection (:attr:`conn`), using the cached token if
+        available or logging in. Thread-safe.
+
+        Returns
+        -------
+        :class:`splusdata.Core`
+            The connection.
+        '''
+        with self._lock:
+            if self.conn is not None:
+                return self.conn
+            from splusdata import Core
+
+            if not self.username:
+                self._credentials()
+            if not internals_supported():
+                print_level('splus_session: untested adss/splusdata versions: no keep-alive connections nor token refresh', 1, self.verbose)
+                self._credentials()
+                self.conn = Core(username=self.username, password=self.password, SERVER_IP=self.server)
+                self.n_logins += 1
+                if self.cache is not None:
+                    self.cache.put(self.server, self.username, self.conn.client.auth.token)
+                return self.conn
+            client = self._client()
+            token = None if self.cache is None else self.cache.get(self.server, self.username)
+            if token is not None:
+                print_level(f'splus_session: {self.username}: using cached token', 1, self.verbose)
+                client.auth.token = token
+            # Core.__init__ would log in with a new client without keep-alive
+            conn = Core.__new__(Core)
+            conn.client = client
+            conn.collections = []
+            conn.verbose = 0
+            self.conn = conn
+            if token is None:
+                try:
+                    self.login(stats=stats)
+                except Exception:
+                    self.close()
+                    raise
+            return self.conn
+
+    def login(self, n_tries=3, stats=None, refused=None):
+        '''
+        Log in (up to `n_tries` attempts separated by an exponential
+        backoff with jitter) and cache the token. A token cached by another
+        process meanwhile is used instead, unless it is the `refused` one.
+
+        Raises
+        ------
+        Exception
+            The error of the last attempt.
+        '''
+        with self._lock, (nullcontext() if self.cache is None else self.cache.locked()):
+            auth = self.conn.client.auth
+            # another process may have logged in while waiting for the lock
+            token = None if self.cache is None else self.cache.get(self.server, self.username)
+            if (token is not None) and (token != refused):
+                auth.token = token
+                return token
+            self._credentials()
+            from adss import ADSSClient
+
+            start = time()
+            t0 = perf_counter()
+            for i in range(n_tries):
+                if i:
+                    sleep(backoff_delay(i - 1, base=1))
+                try:
+                    ADSSClient.login(self.conn.client, self.username, self.password)
+                    break
+                except Exception as e:
+                    error = _error_reason(e)
+                    print_level(f'S-PLUS Cloud login attempt {i + 1}: {error}', 1, self.verbose)
+                    if i == n_tries - 1:
+                        if stats is not None:
+                            stats.add('login', latency=perf_counter() - t0, retries=i, error=error, start=start)
+                        raise
+            if stats is not None:
+                stats.add('login', latency=perf_counter() - t0, retries=i, start=start)
+            self.n_logins += 1
+            if self.cache is not None:
+                self.cache.put(self.server, self.username, auth.token)
+            return auth.token
+
+    def refresh(self, old_token=None):
+        '''
+        Log in again, unless the token was already replaced by another
+        thread (i.e. it differs from `old_token`).
+
+        Returns
+        -------
+        str
+            The new token.
+        '''
+        with self._lock:
+            auth = self.conn.client.auth
+            if (old_token is not None) and (auth.token != old_token):
+                return auth.token
+            return self.login(refused=old_token)
+
+    def fresh_token(self):
+        '''
+        Current token, refreshed first if it expires soon.
+        '''
+        token = self.conn.client.auth.token
+        exp = token_expiry(token)
+        if (exp is not None) and (exp - time() < _TOKEN_EXPIRY_MARGIN):
+            token = self.refresh(token)
+        return token
+
+    def close(self):
+        '''
+        Close the keep-alive connections.
+        '''
+        if self.conn is not None:
+            try:
+                self.conn.client.auth._client.close()
+            except AttributeError:
+                pass
+            self.conn = None
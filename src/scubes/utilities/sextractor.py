@@ -1,5 +1,4 @@
 import numpy as np
-from regions import PixCoord, CirclePixelRegion
 
 from .data import sex
 
@@ -11,8 +10,6 @@ SEX_TOPHAT_FILTER = os.path.join(__data_files__, 'tophat_3.0_3x3.conv')
 SEX_DEFAULT_FILTER = os.path.join(__data_files__, 'default.conv') 
 SEX_DEFAULT_STARNNW = os.path.join(__data_files__, 'default.nnw') 
 
-from sewpy import SEW
-
 from .io import print_level
 
 def run_sex(sex_path, detection_fits, input_config, output_params, work_dir=None, output_file=None, overwrite=True, verbose=0):    
@@ -50,6 +47,8 @@ def run_sex(sex_path, detection_fits, input_config, output_params, work_dir=None
     sewpy.output.SExtractor
         SExtractor catalog result.
     '''    
+    from sewpy import SEW
+
     print_level('Running SExtractor for config:', 2, verbose)
     print_level(input_config, 2, verbose)
 
@@ -84,6 +83,8 @@ def SEWregions(sewcat, shape, class_star, verbose=0):
     list of regions.CirclePixelRegion
         List of circular regions.
     '''    
+    from regions import PixCoord, CirclePixelRegion
+
     print_level(f'Using CLASS_STAR > {class_star:.2f} star/galaxy separator...', 1, verbose)
     sewpos = np.transpose((sewcat['table']['X_IMAGE'], sewcat['table']['Y_IMAGE']))
     radius = 3.0 * (sewcat['table']['FWHM_IMAGE'] / 0.55)
@@ -1,10 +1,22 @@
+from time import time, perf_counter, sleep
+from contextlib import nullcontext
 from astropy.io import fits
-from splusdata import Core
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def connect_splus_cloud(username=None, password=None):
+from .io import print_level
+from .telemetry import file_bytes, _error_reason
+from .ratelimit import adaptive_limiter, backoff_delay
+
+def connect_splus_cloud(username=None, password=None, stats=None, token_cache=None, max_connections=16, verbose=0):
     '''
     Connect to the S-PLUS Cloud service.
 
+    The connection is shared by the whole process (see
+    :class:`scubes.utilities.session.splus_session`): the first call logs
+    in and the next calls with the same username reuse the session, its
+    keep-alive HTTP connections and its token, which is refreshed when it
+    expires.
+
     Parameters
     ----------
     username : str, optional
@@ -13,20 +25,215 @@ def connect_splus_cloud(username=None, password=None):
     password : str, optional
         The password for S-PLUS Cloud authentication.
 
+    stats : :class:`scubes.utilities.telemetry.download_stats`, optional
+        Records the login (``login`` kind) with its retries and failure
+        reason.
+
+    token_cache : str, optional
+        File caching the token between processes, readable only by the
+        user. If None, the token is not cached.
+
+    max_connections : int, optional
+        Size of the keep-alive connections pool. Default is 16.
+
+    verbose : int, optional
+        Verbosity level. The failed attempts are printed at level 1.
+
     Returns
     -------
     splusdata.Core or None
         An instance of the S-PLUS Cloud connection (`splusdata.Core`) or
-        `None` if the authentication fails after three attempts.
+        `None` if the authentication fails after three attempts. The 
+        attempts are separated by an exponential backoff with jitter (see
+        :func:`scubes.utilities.ratelimit.backoff_delay`).
     '''    
+    from .session import splus_session
+
+    try:
+        session = splus_session.get(
+            username, password, token_file=token_cache, max_connections=max_connections, 
+            stats=stats, verbose=verbose,
+        )
+    except Exception as e:
+        print_level(f'S-PLUS Cloud: unable to log in: {_error_reason(e)}')
+        return None
+    return session.conn
+
+DATA_SOURCES = ['cloud', 'tiles', 'mock']
+
+def connect_data_source(data_source='cloud', username=None, password=None, tiles_dir=None, mock_url=None, stats=None, token_cache=None, max_connections=16, verbose=0):
+    '''
+    Connect to the data-source backend used to retrieve the stamps.
+
+    Parameters
+    ----------
+    data_source : str, optional
+        One of :data:`DATA_SOURCES`:
+
+            * ``'cloud'``: S-PLUS Cloud service (default).
+            * ``'tiles'``: full-field tiles stored at `tiles_dir`. See 
+              :class:`scubes.utilities.tiles.local_tiles`.
+            * ``'mock'``: mock S-PLUS Cloud server at `mock_url`. See
+              :class:`scubes.utilities.mockcloud.mock_cloud_server`.
+
+    username : str, optional
+        The username for S-PLUS Cloud authentication.
+
+    password : str, optional
+        The password for S-PLUS Cloud authentication.
+
+    tiles_dir : str, optional
+        Directory of the local tiles.
+
+    mock_url : str, optional
+        URL of the mock S-PLUS Cloud server. If None, a server with
+        synthetic stamps is started in a background thread.
+
+    stats : :class:`scubes.utilities.telemetry.download_stats`, optional
+        Records the S-PLUS Cloud login.
+
+    token_cache, max_connections : optional
+        S-PLUS Cloud session options. See :func:`connect_splus_cloud`.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Returns
+    -------
+    object
+        The backend with the same interface of :class:`splusdata.Core`.
+    '''
+    if data_source == 'cloud':
+        return connect_splus_cloud(
+            username, password, stats=stats, token_cache=token_cache, 
+            max_connections=max_connections, verbose=verbose,
+        )
+    if data_source == 'tiles':
+        from .tiles import local_tiles
+
+        if tiles_dir is None:
+            raise ValueError('tiles data source: missing tiles directory')
+        return local_tiles(tiles_dir, verbose=verbose)
+    if data_source == 'mock':
+        from .mockcloud import mock_cloud_server, mock_cloud_client
+
+        if mock_url is None:
+            mock_url = mock_cloud_server(verbose=verbose).start().url
+        return mock_cloud_client(mock_url)
+    raise ValueError(f'{data_source}: unknown data source')
+
+def _kind(kw):
+    return 'weight' if kw.get('weight', False) else 'stamp'
+
+def download_stamp(conn, kw, retries=0, stats=None, galaxy=None, limiter=None):
+    '''
+    Download a stamp, retrying the failed requests after an exponential
+    backoff with jitter.
+
+    Parameters
+    ----------
+    conn : :class:`splusdata.Core`
+        An instance of the S-PLUS Cloud connection.
+
+    kw : dict
+        Keyword arguments passed to :meth:`conn.stamp`.
+
+    retries : int, optional
+        Maximum number of retries of a failed request. Default is 0.
+
+    stats : :class:`scubes.utilities.telemetry.download_stats`, optional
+        Records the request (``stamp`` or ``weight`` kind) with the bytes
+        written to ``kw['outfile']``, the latency, the retries and the
+        failure reason.
+
+    galaxy : str, optional
+        Galaxy name of the record.
+
+    limiter : :class:`scubes.utilities.ratelimit.adaptive_limiter`, optional
+        Limiter of the requests. It also sets the backoff of the retries.
+
+    Returns
+    -------
+    object
+        The result of :meth:`conn.stamp`.
+    '''
     n_tries = 0
-    conn = None
-    while (n_tries < 3) and (conn is None):
+    start = time()
+    t0 = perf_counter()
+    while True:
         try:
-            conn = Core(username=username, password=password)
-        except:
+            with (nullcontext() if limiter is None else limiter.request()):
+                result = conn.stamp(**kw)
+            break
+        except Exception as e:
+            if n_tries >= retries:
+                if stats is not None:
+                    stats.add(_kind(kw), galaxy, kw.get('band'), None, perf_counter() - t0, n_tries, _error_reason(e), start)
+                raise
+            if limiter is None:
+                sleep(backoff_delay(n_tries))
+            else:
+                limiter.backoff(n_tries)
             n_tries += 1
-    return conn
+    if stats is not None:
+        stats.add(_kind(kw), galaxy, kw.get('band'), file_bytes(kw.get('outfile')), perf_counter() - t0, n_tries, None, start)
+    return result
+
+def download_stamps(conn, stamps_kw, workers=1, desc=None, retries=0, stats=None, galaxy=None, limiter=None):
+    '''
+    Download a list of stamps from the S-PLUS Cloud service, optionally
+    using a pool of concurrent workers with an adaptive concurrency limit
+    (see :class:`scubes.utilities.ratelimit.adaptive_limiter`).
+
+    Parameters
+    ----------
+    conn : :class:`splusdata.Core`
+        An instance of the S-PLUS Cloud connection.
+
+    stamps_kw : list of dict
+        List with the keyword arguments passed to :meth:`conn.stamp` for
+        each stamp. The ``timeout`` key, if present, sets the per-request
+        timeout in seconds.
+
+    workers : int, optional
+        Maximum number of simultaneous requests. If ``workers <= 1`` the
+        stamps are downloaded sequentially. Default is 1. Ignored if
+        `limiter` is given.
+
+    desc : str, optional
+        Description used in the progress bar.
+
+    retries, stats, galaxy : optional
+        Retries of each request and its telemetry. See
+        :func:`download_stamp`.
+
+    limiter : :class:`scubes.utilities.ratelimit.adaptive_limiter`, optional
+        Limiter shared with other downloads (e.g. by the galaxies of a 
+        batch). If None, a limiter of up to `workers` requests is used.
+
+    Returns
+    -------
+    list
+        The results of :meth:`conn.stamp` in the same order of `stamps_kw`.
+    '''
+    from tqdm import tqdm
+
+    results = [None]*len(stamps_kw)
+    if len(stamps_kw) == 0:
+        return results
+    if limiter is None:
+        limiter = adaptive_limiter(max_concurrency=workers)
+    kw_dl = dict(retries=retries, stats=stats, galaxy=galaxy, limiter=limiter)
+    if limiter.max_concurrency <= 1:
+        for i, kw in enumerate(tqdm(stamps_kw, desc=desc, leave=True, position=0)):
+            results[i] = download_stamp(conn, kw, **kw_dl)
+        return results
+    with ThreadPoolExecutor(max_workers=min(limiter.max_concurrency, len(stamps_kw))) as executor:
+        futures = {executor.submit(download_stamp, conn, kw, **kw_dl): i for i, kw in enumerate(stamps_kw)}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc=desc, leave=True, position=0):
+            # gather back in the input (band) order
+            results[futures[fut]] = fut.result()
+    return results
 
 #### DEAD on splusdata v5.0+
 def detection_image_hdul(conn, wcs=False, **kwargs):
@@ -0,0 +1,468 @@
+import numpy as np
+from os import makedirs
+from os.path import join, isfile
+
+from .io import print_level
+
+SYNTHETIC_PIXSCALE = 0.55  # arcsec
+SYNTHETIC_TILE_SIZE = 11000  # pixels
+SYNTHETIC_CCD_GAIN = 0.95  # e-/ADU
+SYNTHETIC_READ_NOISE = 3.4  # e-
+SYNTHETIC_NCOMBINE = 3
+
+# Approximate S-PLUS values of each band: zero points of the (per second)
+# images, sky surface brightness (mag/arcsec2) and PSF FWHM (arcsec)
+SYNTHETIC_MAGZP = {
+    'U': 20.9, 'F378': 20.4, 'F395': 19.9, 'F410': 20.9, 'F430': 21.0, 'G': 23.2,
+    'F515': 21.1, 'R': 23.3, 'F660': 21.3, 'I': 23.0, 'F861': 20.6, 'Z': 22.2,
+}
+SYNTHETIC_SKY_MAG = {
+    'U': 22.0, 'F378': 21.9, 'F395': 21.8, 'F410': 21.5, 'F430': 21.4, 'G': 21.5,
+    'F515': 21.2, 'R': 20.8, 'F660': 20.7, 'I': 20.3, 'F861': 19.7, 'Z': 19.6,
+}
+SYNTHETIC_PSFFWHM = {
+    'U': 1.55, 'F378': 1.50, 'F395': 1.45, 'F410': 1.40, 'F430': 1.35, 'G': 1.30,
+    'F515': 1.28, 'R': 1.20, 'F660': 1.18, 'I': 1.15, 'F861': 1.12, 'Z': 1.10,
+}
+
+# magnitude - r magnitude of the galaxies and of the reddest stars
+_GALAXY_COLORS = {
+    'U': 1.6, 'F378': 1.5, 'F395': 1.3, 'F410': 1.0, 'F430': 0.9, 'G': 0.6,
+    'F515': 0.4, 'R': 0.0, 'F660': -0.1, 'I': -0.3, 'F861': -0.4, 'Z': -0.45,
+}
+_RED_STAR_COLORS = {
+    'U': 2.6, 'F378': 2.4, 'F395': 2.2, 'F410': 1.8, 'F430': 1.6, 'G': 1.0,
+    'F515': 0.7, 'R': 0.0, 'F660': -0.2, 'I': -0.5, 'F861': -0.7, 'Z': -0.8,
+}
+
+def _sersic_b(n):
+    # Ciotti & Bertin (1999) asymptotic expansion
+    return 2*n - 1/3 + 4/(405*n) + 46/(25515*n**2)
+
+def sersic_image(shape, x0, y0, mag, r_e, n, ba=1.0, pa=0.0, magzp=25.0):
+    '''
+    Image of a Sérsic profile sampled at the pixel centers.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Image shape ``(ny, nx)``.
+
+    x0, y0 : float
+        Center (0-based pixel coordinates).
+
+    mag : float
+        Total magnitude.
+
+    r_e : float
+        Effective (half-light) semi-major axis in pixels.
+
+    n : float
+        Sérsic index.
+
+    ba : float, optional
+        Axis ratio (:math:`b/a`). Default is 1.
+
+    pa : float, optional
+        Position angle in radians, counter-clockwise relative to the
+        positive X axis. Default is 0.
+
+    magzp : float, optional
+        Magnitude zero point of the image. Default is 25.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Image in counts.
+    '''
+    from scipy.special import gamma
+
+    b_n = _sersic_b(n)
+    flux = 10**(-0.4*(mag - magzp))
+    I_e = flux/(2*np.pi*n*ba*r_e**2*np.exp(b_n)*b_n**(-2*n)*gamma(2*n))
+    y, x = np.indices(shape, dtype='float64')
+    x -= x0
+    y -= y0
+    xr = x*np.cos(pa) + y*np.sin(pa)
+    yr = (-x*np.sin(pa) + y*np.cos(pa))/ba
+    r = np.hypot(xr, yr)
+    return I_e*np.exp(-b_n*((r/r_e)**(1/n) - 1))
+
+def add_gaussian_sources(image, xs, ys, fluxes, fwhm):
+    '''
+    Add point sources with a gaussian PSF to `image` (in place). Each
+    source is normalized to its total flux inside a box of 5 sigma.
+
+    Parameters
+    ----------
+    image : :class:`numpy.ndarray`
+        2D image.
+
+    xs, ys : array-like
+        Positions (0-based pixel coordinates).
+
+    fluxes : array-like
+        Fluxes in counts.
+
+    fwhm : float
+        FWHM of the PSF in pixels.
+    '''
+    sig = fwhm/(2*np.sqrt(2*np.log(2)))
+    r = int(np.ceil(5*sig))
+    ny, nx = image.shape
+    for xc, yc, f in zip(xs, ys, fluxes):
+        i0, i1 = max(int(yc) - r, 0), min(int(yc) + r + 1, ny)
+        j0, j1 = max(int(xc) - r, 0), min(int(xc) + r + 1, nx)
+        if (i0 >= i1) or (j0 >= j1):
+            continue
+        yy, xx = np.mgrid[i0:i1, j0:j1]
+        psf = np.exp(-0.5*((xx - xc)**2 + (yy - yc)**2)/sig**2)
+        image[i0:i1, j0:j1] += f*psf/psf.sum()
+    return image
+
+def stamp_filename(output_dir, galaxy, tile, band, size, weight=False):
+    '''
+    Filename used by :meth:`scubes.core.SCubes.get_stamps` for a stamp.
+    '''
+    suffix = 'swpweight' if weight else 'swp'
+    return join(output_dir, f'{galaxy}_{tile}_{band}_{size}x{size}_{suffix}.fits.fz')
+
+class synthetic_field:
+    '''
+    A synthetic S-PLUS stamp field: a Sérsic galaxy at the center and
+    field stars, observed in the 12 S-PLUS bands.
+
+    The stamps (see :meth:`stamp_hdul`) are sky-subtracted images
+    normalized per second, as the S-PLUS coadded images, with:
+
+        * the galaxy and the stars convolved with a gaussian PSF of the
+          band ``PSFFWHM``;
+        * sky and source (poisson) noise given by the band zero point,
+          sky surface brightness, ``GAIN`` (:data:`SYNTHETIC_CCD_GAIN` times
+          the band exposure time, :data:`scubes.constants.EXPTIMES`) and
+          read noise;
+        * weight images with the inverse of the sky variance and
+          negative-weight (bad) pixels on the bottom rows and in a few
+          random blocks;
+        * S-PLUS-like headers (WCS, ``FILTER``, ``GAIN``, ``EXPTIME``,
+          ``NCOMBINE``, ``PIXSCALE``, ``X0TILE``, ``Y0TILE``, ``PSFFWHM``
+          and, optionally, ``MAGZP``) with the ``MAR`` or ``JYPE``
+          conventions of :mod:`scubes.headers`.
+
+    Everything is deterministic given `seed`: the same field (and each
+    band noise) is created in any order of the bands or in different
+    processes.
+
+    Parameters
+    ----------
+    ra, dec : float
+        Coordinates of the stamp center in degrees.
+
+    size : int
+        Side of the stamps in pixels.
+
+    seed : int, optional
+        Seed of the field. If None, it is derived from `ra`, `dec` and
+        `size`.
+
+    magzp : dict, optional
+        Zero point of each band (FITS band names). Default is
+        :data:`SYNTHETIC_MAGZP`.
+
+    psffwhm : dict, optional
+        PSF FWHM in arcsec of each band. Default is :data:`SYNTHETIC_PSFFWHM`.
+
+    galaxy_mag : float, optional
+        r-band total magnitude of the galaxy. Random (13 to 16) if None.
+
+    star_density : float, optional
+        Number of stars per 200x200 pixels. Default is 1.
+
+    bad_fraction : float, optional
+        Fraction of the pixels with negative weights, besides the two
+        bottom rows. Default is 0.001.
+
+    Attributes
+    ----------
+    galaxy : dict
+        Sérsic parameters of the galaxy (``x0``, ``y0``, ``mag_r``,
+        ``r_e``, ``n``, ``ba`` and ``pa``).
+
+    stars : dict
+        Positions (``x``, ``y``), r-band magnitudes (``mag_r``) and colors
+        (``t``, from 0 to 1) of the stars.
+    '''
+    def __init__(self, ra, dec, size, seed=None, magzp=None, psffwhm=None,
+                 galaxy_mag=None, star_density=1, bad_fraction=0.001):
+        self.ra = float(ra)
+        self.dec = float(dec)
+        self.size = int(size)
+        if seed is None:
+            seed = abs(hash((round(self.ra, 6), round(self.dec, 6), self.size))) % 2**32
+        self.seed = seed
+        self.magzp = SYNTHETIC_MAGZP if magzp is None else magzp
+        self.psffwhm = SYNTHETIC_PSFFWHM if psffwhm is None else psffwhm
+        self.bad_fraction = bad_fraction
+        rng = np.random.default_rng([seed, 0])
+        s = self.size
+        self.galaxy = dict(
+            x0=(s - 1)/2, y0=(s - 1)/2,
+            mag_r=rng.uniform(13, 16) if galaxy_mag is None else galaxy_mag,
+            r_e=s/10*rng.uniform(0.7, 1.3), n=rng.uniform(0.8, 4),
+            ba=rng.uniform(0.4, 1), pa=rng.uniform(0, np.pi),
+        )
+        n_stars = max(3, int(round(star_density*s**2/40000)))
+        x, y = rng.uniform(0, s - 1, (2, n_stars))
+        # keep the galaxy center clean
+        far = np.hypot(x - self.galaxy['x0'], y - self.galaxy['y0']) > s/8
+        self.stars = dict(
+            x=x[far], y=y[far],
+            mag_r=rng.uniform(14, 19, n_stars)[far], t=rng.uniform(0, 1, n_stars)[far],
+        )
+
+    def _band_rng(self, band, weight=False):
+        from ..constants import EXPTIMES
+
+        return np.random.default_rng([self.seed, 1 + list(EXPTIMES).index(band), int(weight)])
+
+    def gain(self, band):
+        from ..constants import EXPTIMES
+
+        return SYNTHETIC_CCD_GAIN*EXPTIMES[band]
+
+    def sky_sigma(self, band):
+        '''
+        Standard deviation of the sky noise of `band` per pixel.
+        '''
+        sky = 10**(-0.4*(SYNTHETIC_SKY_MAG[band] - self.magzp[band]))*SYNTHETIC_PIXSCALE**2
+        gain = self.gain(band)
+        return np.sqrt(sky/gain + SYNTHETIC_NCOMBINE*(SYNTHETIC_READ_NOISE/gain)**2)
+
+    def model(self, band):
+        '''
+        Noiseless image of `band` (galaxy and stars convolved with the PSF).
+        '''
+        from scipy.ndimage import gaussian_filter
+
+        g = self.galaxy
+        s = self.size
+        fwhm = self.psffwhm[band]/SYNTHETIC_PIXSCALE
+        img = sersic_image(
+            (s, s), g['x0'], g['y0'], mag=g['mag_r'] + _GALAXY_COLORS[band], r_e=g['r_e'],
+            n=g['n'], ba=g['ba'], pa=g['pa'], magzp=self.magzp[band],
+        )
+        img = gaussian_filter(img, fwhm/(2*np.sqrt(2*np.log(2))), mode='constant')
+        st = self.stars
+        mags = st['mag_r'] + st['t']*_RED_STAR_COLORS[band]
+        return add_gaussian_sources(img, st['x'], st['y'], 10**(-0.4*(mags - self.magzp[band])), fwhm)
+
+    def bad_pixels(self):
+        '''
+        Mask of the negative-weight pixels (the same in all bands).
+        '''
+        s = self.size
+        rng = np.random.default_rng([self.seed, 100])
+        bad = np.zeros((s, s), dtype='bool')
+        bad[:2] = True  # bad rows, as seen on some tile borders
+        n_blocks = int(self.bad_fraction*s*s/16)
+        for i, j in rng.integers(0, s - 4, (n_blocks, 2)):
+            bad[i:i + 4, j:j + 4] = True
+        return bad
+
+    def header(self, band, author='MAR', magzp=True, tile='SPLUS-synthetic'):
+        '''
+        S-PLUS-like header of a stamp of `band`.
+        '''
+        from astropy.io import fits
+        from astropy.wcs import WCS
+
+        from ..headers import get_key
+        from ..constants import EXPTIMES
+
+        s = self.size
+        w = WCS(naxis=2)
+        w.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        w.wcs.crval = [self.ra, self.dec]
+        w.wcs.crpix = [s/2 + 0.5, s/2 + 0.5]
+        w.wcs.cdelt = [-SYNTHETIC_PIXSCALE/3600, SYNTHETIC_PIXSCALE/3600]
+        header = fits.Header()
+        header.update(w.to_header())
+        header['OBJECT'] = tile
+        header['FILTER'] = band
+        header['AUTHOR'] = (author, 'Who ran the software')
+        header['GAIN'] = (self.gain(band), 'Gain (e-/ADU) of the image')
+        header['EXPTIME'] = EXPTIMES[band]
+        header['NCOMBINE'] = SYNTHETIC_NCOMBINE
+        header['PIXSCALE'] = SYNTHETIC_PIXSCALE
+        header['X0TILE'] = (SYNTHETIC_TILE_SIZE/2, 'X position of the stamp center on the tile')
+        header['Y0TILE'] = (SYNTHETIC_TILE_SIZE/2, 'Y position of the stamp center on the tile')
+        header[get_key('PSFFWHM', author.lower())] = self.psffwhm[band]
+        if magzp:
+            header['MAGZP'] = (self.magzp[band], 'Magnitude zero point')
+        return header
+
+    def stamp_hdul(self, band, weight=False, author='MAR', magzp=True, tile='SPLUS-synthetic'):
+        '''
+        Stamp (or weight stamp) of `band` as downloaded from the S-PLUS
+        Cloud: a tile-compressed image at the first extension.
+
+        Parameters
+        ----------
+        band : str
+            FITS band name (e.g. ``F378``, ``R``).
+
+        weight : bool, optional
+            Weight stamp. Default is False.
+
+        author : str, optional
+            ``MAR`` or ``JYPE``: header conventions (see
+            :mod:`scubes.headers`). Default is ``MAR``.
+
+        magzp : bool, optional
+            Write the ``MAGZP`` header key. If False, the stamps need the
+            zero points table (the `tile` must be there and the field
+            `magzp` must be the zero points of the table). Default is True.
+
+        tile : str, optional
+            S-PLUS field name. Default is ``SPLUS-synthetic``.
+
+        Returns
+        -------
+        :class:`astropy.io.fits.HDUList`
+            Stamp HDUList.
+        '''
+        from astropy.io import fits
+
+        header = self.header(band, author=author, magzp=magzp, tile=tile)
+        s = self.size
+        sig = self.sky_sigma(band)
+        if weight:
+            data = np.full((s, s), 1/sig**2, dtype='float32')
+            data[self.bad_pixels()] = -1
+        else:
+            model = self.model(band)
+            rng = self._band_rng(band)
+            noise = np.sqrt(sig**2 + np.clip(model, 0, None)/self.gain(band))
+            data = (model + noise*rng.standard_normal((s, s))).astype('float32')
+        return fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data=data, header=header)])
+
+    def write_stamps(self, output_dir, galaxy, tile='SPLUS-synthetic', bands=None, author='MAR', magzp=True, overwrite=False):
+        '''
+        Write the stamps and weight stamps with the names used by
+        :meth:`scubes.core.SCubes.get_stamps`, so a ``scubes`` run with
+        the same galaxy, tile and size uses them without downloads.
+
+        Parameters
+        ----------
+        output_dir : str
+            Output directory (``WORK_DIR/GALAXY`` for ``scubes``).
+
+        galaxy : str
+            Galaxy name.
+
+        tile : str, optional
+            S-PLUS field name. Default is ``SPLUS-synthetic``.
+
+        bands : list of str, optional
+            Bands to write. Default is all the S-PLUS bands.
+
+        author : str, optional
+            ``MAR`` or ``JYPE``. Default is ``MAR``.
+
+        magzp : bool, optional
+            Write the ``MAGZP`` header key. Default is True.
+
+        overwrite : bool, optional
+            Overwrite existing stamps. Default is False.
+
+        Returns
+        -------
+        list of str
+            Stamps filenames.
+        '''
+        from ..constants import EXPTIMES
+
+        bands = list(EXPTIMES) if bands is None else bands
+        makedirs(output_dir, exist_ok=True)
+        filenames = []
+        for band in bands:
+            for weight in [False, True]:
+                fname = stamp_filename(output_dir, galaxy, tile, band, self.size, weight=weight)
+                filenames.append(fname)
+                if overwrite or not isfile(fname):
+                    self.stamp_hdul(band, weight=weight, author=author, magzp=magzp, tile=tile).writeto(fname, overwrite=True)
+        return filenames
+
+def synthetic_stamp(ra, dec, size, band, weight=False, tile='SPLUS-synthetic', author='MAR', seed=None):
+    '''
+    A single stamp of the :class:`synthetic_field` of `ra`, `dec` and
+    `size`. See :meth:`synthetic_field.stamp_hdul`.
+    '''
+    return synthetic_field(ra, dec, size, seed=seed).stamp_hdul(band, weight=weight, author=author, tile=tile)
+
+def synthetic_cube(work_dir, galaxy, ra, dec, size, tile='SPLUS-synthetic', seed=None, author='MAR', magzp=True, scubes_argv=None, verbose=0):
+    '''
+    Write the stamps of a :class:`synthetic_field` and build its cube with
+    :class:`scubes.core.SCubes`, as a ``scubes`` run would do.
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory (``scubes --work_dir``).
+
+    galaxy : str
+        Galaxy name.
+
+    ra, dec : float
+        Coordinates in degrees.
+
+    size : int
+        Side of the stamps in pixels.
+
+    tile : str, optional
+        S-PLUS field name. Default is ``SPLUS-synthetic``.
+
+    seed : int, optional
+        Seed of the field.
+
+    author : str, optional
+        ``MAR`` or ``JYPE``. Default is ``MAR``.
+
+    magzp : bool, optional
+        Write the ``MAGZP`` header key. If False, the zero points of the
+        `tile` in the zero points table are used. Default is True.
+
+    scubes_argv : list of str, optional
+        Extra ``scubes`` options (e.g. ``['--cube_format', 'float32']``).
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Returns
+    -------
+    str
+        Path to the cube.
+    '''
+    from ..core import SCubes
+    from .args import create_parser
+    from ..entry_points import SCUBES_ARGS, scubes_argparse
+
+    argv = ['-r', '-w', work_dir, '-l', f'{size}'] + ['-v']*verbose + (scubes_argv or [])
+    argv += ['--', tile, f'{ra}', f'{dec}', galaxy]
+    args = scubes_argparse(create_parser(args_dict=SCUBES_ARGS).parse_args(argv))
+    size = args.size
+    zps = None
+    if not magzp:
+        from .. import __dr4_zp_cat__, __dr5_zp_cat__
+        from ..zeropoints import get_zero_points_index
+
+        zp_cat = __dr5_zp_cat__ if '5' in args.data_release else __dr4_zp_cat__
+        zps = get_zero_points_index(zp_cat, verbose=verbose).lookup(tile)
+        if zps is None:
+            raise ValueError(f'{tile}: not found in zero-points table')
+    field = synthetic_field(ra, dec, size, seed=seed, magzp=zps)
+    field.write_stamps(join(work_dir, galaxy), galaxy, tile=tile, author=author, magzp=magzp)
+    print_level(f'{galaxy}: synthetic stamps written at {join(work_dir, galaxy)}', 1, verbose)
+    scubes = SCubes(args)
+    scubes.create_cube()
+    return scubes.cube_path
@@ -0,0 +1,240 @@
+import json
+import threading
+from time import time, perf_counter
+from contextlib import contextmanager
+from os import replace, getpid
+from os.path import getsize, isfile
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+def _error_reason(e):
+    return f'{type(e).__name__}: {e}'.strip().rstrip(':')
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1)*q/100
+    i = int(k)
+    j = min(i + 1, len(values) - 1)
+    return values[i] + (values[j] - values[i])*(k - i)
+
+def file_bytes(filename):
+    '''
+    Size of `filename` in bytes (None if it does not exist).
+    '''
+    return getsize(filename) if (filename is not None) and isfile(filename) else None
+
+class download_stats:
+    '''
+    Thread-safe telemetry of the data-source requests (stamps, detection
+    images, Lupton RGB images and logins) of a run or of a batch of runs.
+
+    Each request is recorded with its kind, galaxy, band, bytes, latency
+    (including the retries), number of retries and, if it failed, the
+    reason of the last failure. :meth:`summary` aggregates the records in
+    latency histograms (:data:`LATENCY_BUCKETS`), percentiles and
+    throughput, and :meth:`write` exports them as JSON or as a Prometheus
+    textfile (see the node exporter textfile collector).
+
+    Attributes
+    ----------
+    records : list of dict
+        One record per request, with keys ``kind``, ``galaxy``, ``band``,
+        ``bytes``, ``latency``, ``retries``, ``status`` (``ok`` or
+        ``failed``), ``error``, ``start`` and ``end`` (unix times).
+    '''
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, galaxy=None, band=None, nbytes=None, latency=None, retries=0, error=None, start=None):
+        '''
+        Add the record of a request.
+
+        Parameters
+        ----------
+        kind : str
+            ``stamp``, ``weight``, ``detection``, ``lupton`` or ``login``.
+
+        galaxy : str, optional
+            Galaxy name.
+
+        band : str, optional
+            Band of the request.
+
+        nbytes : int, optional
+            Bytes downloaded.
+
+        latency : float, optional
+            Duration of the request in seconds, including the retries.
+
+        retries : int, optional
+            Number of failed attempts before the last one.
+
+        error : str, optional
+            Reason of the failure of the last attempt (None if successful).
+
+        start : float, optional
+            Unix time of the start of the request.
+        '''
+        end = time()
+        start = end - (latency or 0) if start is None else start
+        rec = dict(
+            kind=kind, galaxy=galaxy, band=band, bytes=nbytes, latency=latency, retries=retries,
+            status='ok' if error is None else 'failed', error=error, start=start, end=end,
+        )
+        with self._lock:
+            self.records.append(rec)
+        return rec
+
+    @contextmanager
+    def request(self, kind, galaxy=None, band=None, retries=0):
+        '''
+        Context manager recording a single-attempt request. The number of
+        bytes can be set on the yielded record (key ``bytes``).
+
+        Yields
+        ------
+        dict
+            Record of the request, filled at the end of the block.
+        '''
+        rec = dict(bytes=None)
+        start = time()
+        t0 = perf_counter()
+        try:
+            yield rec
+        except Exception as e:
+            self.add(kind, galaxy, band, rec['bytes'], perf_counter() - t0, retries, _error_reason(e), start)
+            raise
+        self.add(kind, galaxy, band, rec['bytes'], perf_counter() - t0, retries, None, start)
+
+    def _select(self, galaxy=None, kind=None):
+        with self._lock:
+            records = list(self.records)
+        return [
+            r for r in records
+            if ((galaxy is None) or (r['galaxy'] == galaxy)) and ((kind is None) or (r['kind'] == kind))
+        ]
+
+    def summary(self, galaxy=None, kind=None, buckets=LATENCY_BUCKETS):
+        '''
+        Aggregated statistics of the requests.
+
+        Parameters
+        ----------
+        galaxy : str, optional
+            Only the requests of this galaxy (i.e. of a single run).
+
+        kind : str, optional
+            Only the requests of this kind.
+
+        buckets : list of float, optional
+            Upper bounds of the latency histogram buckets in seconds.
+
+        Returns
+        -------
+        dict
+            Number of requests, failures and retries, bytes, latency sum,
+            percentiles (``p50``, ``p90``, ``p99``) and cumulative histogram
+            (``histogram``: counts of latencies ``<=`` each bucket and
+            ``+Inf``), elapsed time (first start to last end) and
+            throughput in bytes per second, the failure reasons and the
+            same statistics by kind (``kinds``).
+        '''
+        records = self._select(galaxy, kind)
+        lat = [r['latency'] for r in records if r['latency'] is not None]
+        nbytes = sum(r['bytes'] or 0 for r in records)
+        elapsed = (max(r['end'] for r in records) - min(r['start'] for r in records)) if records else 0
+        errors = {}
+        for r in records:
+            if r['error'] is not None:
+                errors[r['error']] = errors.get(r['error'], 0) + 1
+        hist = {f'{b:g}': sum(1 for x in lat if x <= b) for b in buckets}
+        hist['+Inf'] = len(lat)
+        summ = dict(
+            requests=len(records), failed=sum(r['status'] == 'failed' for r in records),
+            retries=sum(r['retries'] for r in records), bytes=nbytes,
+            latency_sum=sum(lat), p50=_percentile(lat, 50), p90=_percentile(lat, 90), p99=_percentile(lat, 99),
+            histogram=hist, elapsed=elapsed, throughput=(nbytes/elapsed) if elapsed > 0 else None,
+            errors=errors,
+        )
+        if kind is None:
+            kinds = sorted(set(r['kind'] for r in records))
+            summ['kinds'] = {k: self.summary(galaxy=galaxy, kind=k, buckets=buckets) for k in kinds}
+        return summ
+
+    def to_dict(self, buckets=LATENCY_BUCKETS):
+        '''
+        Statistics of the whole run (``summary``), of each galaxy
+        (``galaxies``) and the records of the requests (``records``).
+        '''
+        galaxies = sorted(set(r['galaxy'] for r in self._select() if r['galaxy'] is not None))
+        return dict(
+            summary=self.summary(buckets=buckets),
+            galaxies={g: self.summary(galaxy=g, buckets=buckets) for g in galaxies},
+            records=self._select(),
+        )
+
+    def to_prometheus(self, buckets=LATENCY_BUCKETS, prefix='scubes_download'):
+        '''
+        Statistics of the whole run in the Prometheus text exposition
+        format, labelled by kind (the galaxies are not used as labels).
+
+        Returns
+        -------
+        str
+            The metrics.
+        '''
+        summ = self.summary(buckets=buckets)
+        lines = [
+            f'# HELP {prefix}_requests_total Data-source requests.',
+            f'# TYPE {prefix}_requests_total counter',
+        ]
+        for k, s in summ['kinds'].items():
+            lines.append(f'{prefix}_requests_total{{kind="{k}",status="ok"}} {s["requests"] - s["failed"]}')
+            lines.append(f'{prefix}_requests_total{{kind="{k}",status="failed"}} {s["failed"]}')
+        for name, key, mtype, desc in [
+            ('retries_total', 'retries', 'counter', 'Failed attempts retried.'),
+            ('bytes_total', 'bytes', 'counter', 'Bytes downloaded.'),
+            ('throughput_bytes_per_second', 'throughput', 'gauge', 'Bytes downloaded per second of elapsed time.'),
+        ]:
+            lines += [f'# HELP {prefix}_{name} {desc}', f'# TYPE {prefix}_{name} {mtype}']
+            for k, s in summ['kinds'].items():
+                lines.append(f'{prefix}_{name}{{kind="{k}"}} {s[key] or 0}')
+        name = f'{prefix}_latency_seconds'
+        lines += [f'# HELP {name} Latency of the requests, including the retries.', f'# TYPE {name} histogram']
+        for k, s in summ['kinds'].items():
+            for le, n in s['histogram'].items():
+                lines.append(f'{name}_bucket{{kind="{k}",le="{le}"}} {n}')
+            lines.append(f'{name}_sum{{kind="{k}"}} {s["latency_sum"]}')
+            lines.append(f'{name}_count{{kind="{k}"}} {s["histogram"]["+Inf"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, fmt=None):
+        '''
+        Write the statistics to `filename`, atomically (the file can be
+        read by a Prometheus exporter or a monitor during a batch run).
+
+        Parameters
+        ----------
+        filename : str
+            Output file.
+
+        fmt : str, optional
+            ``json`` or ``prometheus``. If None, ``prometheus`` if
+            `filename` ends with ``.prom`` and ``json`` otherwise.
+        '''
+        if fmt is None:
+            fmt = 'prometheus' if filename.endswith('.prom') else 'json'
+        if fmt == 'prometheus':
+            content = self.to_prometheus()
+        elif fmt == 'json':
+            content = json.dumps(self.to_dict(), indent=1)
+        else:
+            raise ValueError(f'{fmt}: unknown download statistics format')
+        tmp = f'{filename}.{getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(content)
+        replace(tmp, filename)
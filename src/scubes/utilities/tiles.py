@@ -0,0 +1,204 @@
+import numpy as np
+from glob import glob
+from os.path import join, isdir
+from astropy.io import fits
+from astropy.wcs import WCS
+from threading import Lock
+
+from .io import print_level
+
+_TILE_FILE_PATTERNS = [
+    '{tile}_{band}_{suffix}.fits.fz',
+    '{tile}_{band}_{suffix}.fz',
+    '{tile}_{band}_{suffix}.fits',
+]
+
+# keys copied from the tile header to the stamp header besides the WCS
+_WCS_KEYS_TO_DROP = [
+    'NAXIS', 'NAXIS1', 'NAXIS2', 'BITPIX', 'EXTEND', 'SIMPLE', 'XTENSION',
+    'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'CHECKSUM', 'DATASUM',
+    'ZIMAGE', 'ZBITPIX', 'ZNAXIS', 'ZNAXIS1', 'ZNAXIS2', 'ZTILE1', 'ZTILE2',
+    'ZCMPTYPE', 'ZNAME1', 'ZVAL1', 'ZNAME2', 'ZVAL2', 'ZQUANTIZ', 'ZDITHER0',
+]
+
+def _tile_variants(tile):
+    return list(dict.fromkeys([tile, tile.replace('_', '-'), tile.replace('-', '_')]))
+
+class local_tiles:
+    '''
+    Data-source backend which cuts stamps from full-field S-PLUS tiles
+    (``swp`` and ``swpweight`` FITS files) stored on a local directory.
+    It implements the same methods used by :class:`scubes.core.SCubes`
+    from :class:`splusdata.Core`, so it could be used as a replacement of
+    the S-PLUS Cloud connection.
+
+    The tiles are opened with memory mapping and only the pixel rows
+    covered by the stamp are read (or decompressed, for tile-compressed
+    images). Opened tiles are kept open to be reused by the next stamps
+    of the same field.
+
+    The tile files are searched at `tiles_dir` and `tiles_dir/TILE`
+    using the patterns ``TILE_BAND_swp.fits.fz``, ``TILE_BAND_swp.fz``
+    and ``TILE_BAND_swp.fits`` (``swpweight`` for the weight images).
+
+    Parameters
+    ----------
+    tiles_dir : str
+        Directory containing the tiles.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+    '''
+    def __init__(self, tiles_dir, verbose=0):
+        self.tiles_dir = tiles_dir
+        self.verbose = verbose
+        self._hduls = {}
+        self._lock = Lock()
+
+    def _tile_filename(self, tile, band, weight=False):
+        suffix = 'swpweight' if weight else 'swp'
+        for t in _tile_variants(tile):
+            dirs = [self.tiles_dir] + ([join(self.tiles_dir, t)] if isdir(join(self.tiles_dir, t)) else [])
+            for d in dirs:
+                for pattern in _TILE_FILE_PATTERNS:
+                    found = glob(join(d, pattern.format(tile=t, band=band, suffix=suffix)))
+                    if len(found):
+                        return found[0]
+        raise FileNotFoundError(f'{self.tiles_dir}: {tile}: {band}: missing {suffix} tile')
+
+    def _tile_hdu(self, tile, band, weight=False):
+        '''
+        Return the image HDU of the tile, opening it with memory mapping
+        at the first call.
+        '''
+        fname = self._tile_filename(tile, band, weight)
+        with self._lock:
+            hdul = self._hduls.get(fname, None)
+            if hdul is None:
+                print_level(f'local_tiles: opening {fname}', 2, self.verbose)
+                hdul = fits.open(fname, memmap=True, lazy_load_hdus=True)
+                self._hduls[fname] = hdul
+        for hdu in hdul:
+            if hdu.is_image and (hdu.header.get('NAXIS', 0) == 2):
+                return hdu
+        raise ValueError(f'{fname}: missing image HDU')
+
+    def close(self):
+        '''
+        Close all opened tiles.
+        '''
+        with self._lock:
+            for hdul in self._hduls.values():
+                hdul.close()
+            self._hduls = {}
+
+    def _cut(self, tile, band, ra, dec, size, weight=False):
+        '''
+        Cut a ``size x size`` stamp centred at ``(ra, dec)``.
+
+        Returns
+        -------
+        tuple
+            The stamp data and header.
+        '''
+        hdu = self._tile_hdu(tile, band, weight)
+        theader = hdu.header
+        w = WCS(theader, naxis=2)
+        ny, nx = hdu.shape
+        xc, yc = w.world_to_pixel_values(ra, dec)
+        ixc, iyc = int(np.round(xc)), int(np.round(yc))
+        half = size//2
+        x0, y0 = ixc - half, iyc - half
+        x1, y1 = x0 + size, y0 + size
+        # valid region of the tile
+        vx0, vy0 = max(x0, 0), max(y0, 0)
+        vx1, vy1 = min(x1, nx), min(y1, ny)
+        data = np.full((size, size), np.nan, dtype='float32')
+        if (vx1 > vx0) and (vy1 > vy0):
+            # hdu.section only reads (or decompresses) the needed rows
+            data[vy0 - y0:vy1 - y0, vx0 - x0:vx1 - x0] = hdu.section[vy0:vy1, vx0:vx1]
+        header = theader.copy()
+        for k in _WCS_KEYS_TO_DROP:
+            header.remove(k, ignore_missing=True, remove_all=True)
+        header.update(w.slice((slice(y0, y1), slice(x0, x1))).to_header())
+        header['X0TILE'] = (xc + 1, 'X position of the stamp center on the tile')
+        header['Y0TILE'] = (yc + 1, 'Y position of the stamp center on the tile')
+        header['TILE'] = tile
+        header['FILTER'] = header.get('FILTER', band)
+        if header.get('AUTHOR', None) is None:
+            header['AUTHOR'] = ('unknown', 'Who ran the software')
+        return data, header
+
+    def stamp(self, ra, dec, size, band, weight=False, field_name=None, outfile=None, data_release='dr4', timeout=None, **kwargs):
+        '''
+        Cut a stamp from a local tile. Same interface of :meth:`splusdata.Core.stamp`.
+
+        Parameters
+        ----------
+        ra, dec : float
+            Coordinates of the stamp center in degrees.
+
+        size : int
+            Side of the stamp in pixels.
+
+        band : str
+            S-PLUS band name (e.g. ``R``, ``F660``).
+
+        weight : bool, optional
+            If True, cut the weight image. Default is False.
+
+        field_name : str
+            S-PLUS tile name.
+
+        outfile : str, optional
+            If set, save the stamp as a tile-compressed FITS.
+
+        data_release, timeout :
+            Ignored. Kept for compatibility with :meth:`splusdata.Core.stamp`.
+
+        Returns
+        -------
+        :class:`astropy.io.fits.HDUList`
+            Stamp HDUList.
+        '''
+        if field_name is None:
+            raise ValueError('local_tiles: field_name is mandatory')
+        data, header = self._cut(field_name, band, ra, dec, int(size), weight=weight)
+        # lossless: the tile values are already quantized by its compression
+        hdu = fits.CompImageHDU(data=data, header=header, compression_type='GZIP_2', quantize_level=0)
+        hdul = fits.HDUList([fits.PrimaryHDU(), hdu])
+        if outfile is not None:
+            hdul.writeto(outfile, overwrite=True)
+        return hdul
+
+    def stamp_detection(self, ra, dec, size, bands='G,R,I,Z', option=None, **kwargs):
+        '''
+        Create the detection image as the sum of `bands` stamps. Same
+        interface of :meth:`splusdata.Core.stamp_detection`.
+
+        Returns
+        -------
+        :class:`astropy.io.fits.HDUList`
+            Detection image HDUList.
+        '''
+        from .images import detection_image_hdul
+
+        if isinstance(bands, str):
+            bands = bands.split(',')
+        cuts = [self._cut(option, band, ra, dec, int(size)) for band in bands]
+        return detection_image_hdul([data for data, _ in cuts], [header for _, header in cuts], bands=bands)
+
+    def lupton_rgb(self, ra, dec, size, R='I', G='R', B='G', Q=8, stretch=3, field_name=None, **kwargs):
+        '''
+        Create a Lupton RGB image. Same interface of :meth:`splusdata.Core.lupton_rgb`.
+
+        Returns
+        -------
+        :class:`PIL.Image.Image`
+            RGB image.
+        '''
+        from .images import lupton_rgb_image
+
+        rgb = [self._cut(field_name, b, ra, dec, int(size))[0] for b in [R, G, B]]
+        # splusdata returns the image with the origin at the top
+        return lupton_rgb_image(rgb, Q=Q, stretch=stretch, flip=True)
@@ -0,0 +1,237 @@
+import json
+from threading import Lock
+from time import perf_counter, process_time
+from datetime import datetime
+from contextlib import contextmanager
+from os.path import join
+
+# open spans of all the stage timers of the process (see stage_timer.span)
+_open_spans = []
+_open_spans_lock = Lock()
+
+def _proc_status_kb(key):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def peak_rss(reset=False):
+    '''
+    Peak resident set size of the process in bytes.
+
+    On Linux the peak (``VmHWM``) is read from ``/proc/self/status`` and,
+    with `reset`, restarted at the current RSS, so the peak of each stage
+    can be measured. The reset is for the whole process: the open spans of
+    :class:`stage_timer` keep their peaks before it. Elsewhere the peak of
+    the whole process (:func:`resource.getrusage`) is returned.
+
+    Parameters
+    ----------
+    reset : bool, optional
+        Reset the peak after reading it (Linux only). Default is False.
+
+    Returns
+    -------
+    int or None
+        Peak RSS in bytes (None if unknown).
+    '''
+    hwm = _proc_status_kb('VmHWM:')
+    if hwm is not None:
+        if reset:
+            try:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')
+            except OSError:
+                pass
+        return hwm*1024
+    try:
+        import sys
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+def io_bytes():
+    '''
+    Bytes read and written by the process (``rchar`` and ``wchar`` of
+    ``/proc/self/io``, i.e. including the page cache hits).
+
+    Returns
+    -------
+    tuple
+        Bytes read and written (None, None if unknown).
+    '''
+    rw = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                k, v = line.split(':')
+                rw[k] = int(v)
+    except (OSError, ValueError):
+        pass
+    return rw.get('rchar', None), rw.get('wchar', None)
+
+def _update_peaks(rss):
+    # called with _open_spans_lock held
+    if rss is not None:
+        for s in _open_spans:
+            s['peak_rss'] = max(s['peak_rss'] or 0, rss)
+
+def _diff(a, b):
+    return None if (a is None) or (b is None) else b - a
+
+class stage_timer:
+    '''
+    Records named spans (stages) of a run: wall and CPU time, peak RSS
+    and bytes read and written by the process during each span.
+
+    The records are kept at :attr:`records` and appended as JSON lines to
+    a file with :meth:`write`, so the stages of many runs (e.g. a batch
+    of galaxies) can be aggregated. Spans can be nested: the peak RSS of a
+    span includes the peaks of its inner spans. The memory and I/O are
+    measured for the whole process, so spans running at the same time in
+    other threads (e.g. the downloads of a batch run) add to them. The
+    open spans of all the timers are kept at a registry of the process, so
+    the peak of every open span is updated before a new span restarts it.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        If False, :meth:`span` does nothing (no overhead besides the call).
+        Default is True.
+
+    profile : list of str, optional
+        Names of the spans profiled with :mod:`cProfile` (``all`` for all
+        of them). The profiles are dumped to `profile_dir`. Nested spans
+        are not profiled while an outer span is.
+
+    profile_dir : str, optional
+        Directory of the profiles. Default is the current directory.
+
+    prefix : str, optional
+        Prefix of the profiles filenames (``{prefix}{span}.prof``).
+
+    context : dict, optional
+        Added to every record (e.g. galaxy, tile and size).
+
+    verbose : int, optional
+        Verbosity level. The spans are printed at level 1.
+
+    Attributes
+    ----------
+    records : list of dict
+        Records of the finished spans, with keys ``stage``, ``start``
+        (ISO date), ``wall`` and ``cpu`` (seconds), ``peak_rss``,
+        ``read_bytes`` and ``write_bytes``, the `context` and the extra
+        keys given to :meth:`span`.
+    '''
+    def __init__(self, enabled=True, profile=None, profile_dir='.', prefix='', context=None, verbose=0):
+        self.enabled = enabled
+        self.profile = [] if profile is None else list(profile)
+        self.profile_dir = profile_dir
+        self.prefix = prefix
+        self.context = {} if context is None else dict(context)
+        self.verbose = verbose
+        self.records = []
+        self._profiling = False
+
+    def _profiled(self, name):
+        return (not self._profiling) and (('all' in self.profile) or (name in self.profile))
+
+    @contextmanager
+    def span(self, name, **extra):
+        '''
+        Context manager recording the span `name`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the span (stage).
+
+        **extra
+            Added to the record of the span.
+        '''
+        if not self.enabled:
+            yield
+            return
+        rec = dict(stage=name, start=datetime.now().isoformat(timespec='milliseconds'), peak_rss=None)
+        with _open_spans_lock:
+            # the peak of the open spans (outer spans or spans of other threads) is kept before restarting it
+            _update_peaks(peak_rss(reset=True))
+            _open_spans.append(rec)
+        profiler = None
+        if self._profiled(name):
+            import cProfile
+
+            profiler = cProfile.Profile()
+            self._profiling = True
+        r0, w0 = io_bytes()
+        c0 = process_time()
+        t0 = perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = perf_counter() - t0
+            cpu = process_time() - c0
+            r1, w1 = io_bytes()
+            with _open_spans_lock:
+                _update_peaks(peak_rss())
+                _open_spans.remove(rec)
+            rec.update(
+                wall=wall, cpu=cpu, read_bytes=_diff(r0, r1), write_bytes=_diff(w0, w1),
+                **self.context, **extra,
+            )
+            self.records.append(rec)
+            if profiler is not None:
+                self._profiling = False
+                rec['profile'] = join(self.profile_dir, f'{self.prefix}{name}.prof')
+                profiler.dump_stats(rec['profile'])
+            if self.verbose >= 1:
+                from .io import print_level
+
+                peak = '' if rec['peak_rss'] is None else f' peak RSS {rec["peak_rss"]/2**20:.1f} MiB'
+                print_level(f'{name}: {wall:.3f} s (CPU {cpu:.3f} s){peak}', 1, self.verbose)
+
+    def write(self, filename):
+        '''
+        Append the records to the JSON lines file `filename` and clear
+        them.
+
+        Parameters
+        ----------
+        filename : str
+            Output file.
+        '''
+        if not self.records:
+            return
+        with open(filename, 'a') as f:
+            for rec in self.records:
+                f.write(json.dumps(rec) + '\n')
+        self.records = []
+
+def read_timings(filename):
+    '''
+    Read a JSON lines file written by :meth:`stage_timer.write`.
+
+    Parameters
+    ----------
+    filename : str
+        Timings file.
+
+    Returns
+    -------
+    list of dict
+        The records.
+    '''
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
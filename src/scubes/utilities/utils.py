@@ -3,10 +3,10 @@ from os.path import isfile
 from astropy.io import fits
 
 from .io import print_level
-from .args import create_parser
+from .session import TOKEN_CACHE_FILE
+from .args import create_parser, SPLUS_MOTD_TOP, SPLUS_MOTD_MID, SPLUS_MOTD_BOT, SPLUS_MOTD_SEP
 
 from .. import __author__
-from ..entry_points import SPLUS_MOTD_TOP, SPLUS_MOTD_MID, SPLUS_MOTD_BOT, SPLUS_MOTD_SEP
 
 from ..constants import BANDS
 
@@ -30,6 +30,7 @@ GET_LUPTON_RGB_ARGS = {
     'verbose': ['v', dict(action='count', default=0, help='Verbosity level.')],
     'username': ['U', dict(default=None, help='S-PLUS Cloud username.')],
     'password': ['P', dict(default=None, help='S-PLUS Cloud password.')],
+    'token_cache': ['', dict(default=None, nargs='?', const=TOKEN_CACHE_FILE, metavar='FILE', help=f'Cache the S-PLUS Cloud token at FILE (readable only by the user, default FILE: {TOKEN_CACHE_FILE}), so the processes of a batch share a login.')],
     'galaxy': ['g', dict(default=None, metavar='GALAXY_NAME', help="Galaxy's name")],
 
     # positional arguments
@@ -106,7 +107,7 @@ def get_lupton_RGB():
 
     parser = create_parser(args_dict=GET_LUPTON_RGB_ARGS, program_description=GET_LUPTON_RGB_DESC)
     args = get_lupton_RGB_argsparse(parser.parse_args(args=sys.argv[1:]))
-    conn = connect_splus_cloud(args.username, args.password)
+    conn = connect_splus_cloud(args.username, args.password, token_cache=args.token_cache, verbose=args.verbose)
     _get_lupton_RGB(conn, args)
 
 #############################################################################
@@ -118,7 +119,9 @@ SCUBE_SEX_MASK_STARS_ARGS = {
     'verbose': ['v', dict(action='count', default=0, help='Verbosity level.')],
     'username': ['U', dict(default=None, help='S-PLUS Cloud username.')],
     'password': ['P', dict(default=None, help='S-PLUS Cloud password.')],
+    'token_cache': ['', dict(default=None, nargs='?', const=TOKEN_CACHE_FILE, metavar='FILE', help=f'Cache the S-PLUS Cloud token at FILE (readable only by the user, default FILE: {TOKEN_CACHE_FILE}), so the processes of a batch share a login.')],
     'force': ['f', dict(action='store_true', default=False, help='Force overwrite of existing files.')],
+    'download_images': ['', dict(action='store_true', default=False, help='Download the detection and Lupton RGB images from the S-PLUS Cloud instead of building them from the stamps or the cube.')],
     'no_interact': ['N', dict(action='store_true', default=False, help='Run only the automatic mask (a.k.a. do not check final mask)')],
     
     'sextractor': ['x', dict(default='sex', help='Path to SExtractor executable.')],
@@ -134,7 +137,7 @@ SCUBE_SEX_MASK_STARS_ARGS = {
 
 SCUBE_SEX_MASK_STARS_DESC = f'''
 {SPLUS_MOTD_TOP} | scube_sex_mask_stars entry-point script:
-{SPLUS_MOTD_MID} | Uses S-PLUS detection image and SExtractor 
+{SPLUS_MOTD_MID} | Uses a G+R+I+Z detection image and SExtractor 
 {SPLUS_MOTD_BOT} | to identify stars on the FOV using the S-Cube
 {SPLUS_MOTD_SEP} + FITSFILE of a galaxy as input.
 
@@ -189,35 +192,59 @@ def scube_sex_mask_stars_argsparse(args):
 
     return args
 
-def scube_sex_mask_stars():
+def _sex_mask_stars_images(args):
     '''
-    Uses S-PLUS detection image and SExtractor to identify stars on the FOV.
-    This entry-point script uses a S-Cube as input to gather the needed 
-    information to the retrieve the correct detection image stamp.
+    Detection image (saved as ``GALAXY_detection.fits``) and Lupton RGB
+    image of the stars mask of the cube ``args.cube_path``.
 
-    Raises
-    ------
-    SystemExit
-        If the detection file exists.
+    The images are built from the G, R, I and Z stamps next to the cube
+    or, if they are not found, from the cube itself (see
+    :mod:`scubes.utilities.images`), so no S-PLUS Cloud connection is
+    needed. With ``args.download_images`` the images are downloaded.
+
+    Parameters
+    ----------
+    args : :class:`argparse.Namespace`
+        Arguments parsed by :func:`scube_sex_mask_stars_argsparse`.
 
     Returns
     -------
-    None
+    detection_image : str
+        Detection image filename.
+
+    lupton_rgb : :class:`PIL.Image.Image`
+        Lupton RGB image.
     '''
-    from ..mask_stars import maskStars
+    from os.path import dirname, abspath
+
     from ..headers import get_author
-    
-    from .splusdata import connect_splus_cloud, detection_image_hdul
+    from .images import DETECTION_BANDS, LUPTON_RGB_BANDS
+    from .images import stamps_filenames, stamps_detection_image, stamps_lupton_rgb
+    from .images import cube_detection_image, cube_lupton_rgb
 
-    parser = create_parser(args_dict=SCUBE_SEX_MASK_STARS_ARGS, program_description=SCUBE_SEX_MASK_STARS_DESC)
-    args = scube_sex_mask_stars_argsparse(parser.parse_args(args=sys.argv[1:]))
-    conn = connect_splus_cloud(args.username, args.password)
     detection_image = f'{args.galaxy}_detection.fits'
+    conn = None
+    if args.download_images:
+        from .splusdata import connect_splus_cloud
+
+        conn = connect_splus_cloud(args.username, args.password, token_cache=args.token_cache, verbose=args.verbose)
+    stamps_dir = dirname(abspath(args.cube_path))
+    det_stamps = stamps_filenames(stamps_dir, args.galaxy, args.tile, args.size, DETECTION_BANDS)
+    rgb_stamps = stamps_filenames(stamps_dir, args.galaxy, args.tile, args.size, LUPTON_RGB_BANDS)
 
     if not isfile(detection_image) or args.force:
-        print_level(f'{args.galaxy} @ {args.tile} - downloading detection image')
-        kw = dict(ra=args.ra, dec=args.dec, size=args.size, bands=args.bands, option=args.tile)
-        hdul = detection_image_hdul(conn, **kw)
+        if conn is not None:
+            from .splusdata import detection_image_hdul
+
+            print_level(f'{args.galaxy} @ {args.tile} - downloading detection image')
+            kw = dict(ra=args.ra, dec=args.dec, size=args.size, bands=args.bands, option=args.tile)
+            hdul = detection_image_hdul(conn, **kw)
+        elif det_stamps is not None:
+            print_level(f'{args.galaxy} @ {args.tile} - creating detection image from the stamps')
+            hdul = stamps_detection_image(det_stamps)
+        else:
+            print_level(f'{args.galaxy} @ {args.tile} - creating detection image from the cube')
+            hdul = cube_detection_image(args.cube_path)
 
         author = get_author(hdul[1].header)
 
@@ -230,9 +257,170 @@ def scube_sex_mask_stars():
         hdul.writeto(detection_image, overwrite=args.force)
     else:
         print_level('Detection file exists.')
-        #sys.exit(1)
 
-    maskStars(args=args, detection_image=detection_image, lupton_rgb=_get_lupton_RGB(conn, args, save_img=False), output_dir='.')
+    if conn is not None:
+        lupton_rgb = _get_lupton_RGB(conn, args, save_img=False)
+    elif rgb_stamps is not None:
+        lupton_rgb = stamps_lupton_rgb(rgb_stamps)
+    else:
+        lupton_rgb = cube_lupton_rgb(args.cube_path)
+    return detection_image, lupton_rgb
+
+def scube_sex_mask_stars():
+    '''
+    Uses a detection image and SExtractor to identify stars on the FOV.
+    This entry-point script uses a S-Cube as input. The detection and
+    RGB images are built from the stamps next to the cube or from the
+    cube (see :func:`_sex_mask_stars_images`), unless 
+    ``--download_images`` is set.
+
+    Returns
+    -------
+    None
+    '''
+    parser = create_parser(args_dict=SCUBE_SEX_MASK_STARS_ARGS, program_description=SCUBE_SEX_MASK_STARS_DESC)
+    args = scube_sex_mask_stars_argsparse(parser.parse_args(args=sys.argv[1:]))
+
+    from ..mask_stars import maskStars
+
+    detection_image, lupton_rgb = _sex_mask_stars_images(args)
+    maskStars(args=args, detection_image=detection_image, lupton_rgb=lupton_rgb, output_dir='.')
+
+#############################################################################
+#############################################################################
+#############################################################################
+
+MOCK_CLOUD_DESC = f'''
+{SPLUS_MOTD_TOP} | scubes_mock_cloud entry-point script:
+{SPLUS_MOTD_MID} | Runs a local stand-in of the S-PLUS Cloud 
+{SPLUS_MOTD_BOT} | stamps service for offline benchmarks and 
+{SPLUS_MOTD_SEP} + tests (use with --data_source=mock).
+
+ {__author__}
+
+'''
+
+MOCK_CLOUD_ARGS = {
+    # optional arguments
+    'host': ['H', dict(default='127.0.0.1', help='Address to bind.')],
+    'port': ['p', dict(default=8000, type=int, help='Port to bind.')],
+    'fixtures_dir': ['t', dict(default=None, help='Directory with full-field tiles used to cut the stamps. If not set, synthetic stamps are served.')],
+    'latency': ['l', dict(default=0, type=float, help='Latency in seconds added to each request.')],
+    'latency_jitter': ['j', dict(default=0, type=float, help='Maximum random latency in seconds added to --latency.')],
+    'bandwidth': ['b', dict(default=None, type=float, help='Bandwidth cap in bytes per second of each response.')],
+    'failure_rate': ['F', dict(default=0, type=float, help='Probability of a request to fail with HTTP 503.')],
+    'seed': ['s', dict(default=None, type=int, help='Seed of the random number generator.')],
+    'verbose': ['v', dict(action='count', default=0, help='Verbosity level.')],
+}
+
+def mock_cloud():
+    '''
+    Entry-point function to run the mock S-PLUS Cloud server.
+
+    Returns
+    -------
+    None
+    '''
+    from .mockcloud import mock_cloud_server
+
+    parser = create_parser(args_dict=MOCK_CLOUD_ARGS, program_description=MOCK_CLOUD_DESC)
+    args = parser.parse_args(args=sys.argv[1:])
+    server = mock_cloud_server(
+        host=args.host, port=args.port, fixtures_dir=args.fixtures_dir,
+        latency=args.latency, latency_jitter=args.latency_jitter, 
+        bandwidth=args.bandwidth, failure_rate=args.failure_rate, 
+        seed=args.seed, verbose=args.verbose,
+    )
+    print_level(f'mock_cloud: serving at {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+#############################################################################
+#############################################################################
+#############################################################################
+
+SYNTHETIC_DESC = f'''
+{SPLUS_MOTD_TOP} | scubes_synthetic entry-point script:
+{SPLUS_MOTD_MID} | Writes synthetic S-PLUS stamps (and cubes) of 
+{SPLUS_MOTD_BOT} | a list of galaxies and their masterlist, for 
+{SPLUS_MOTD_SEP} + offline benchmarks and load tests.
+
+ {__author__}
+
+The stamps are written with the names used by scubes, so scubes, 
+scubesml and scubesml_batch runs with the same work directory, galaxy 
+and size use them without downloads. The masterlist SIZE__pix is the 
+stamp size divided by 10 (the scubesml default --size_multiplicator).
+
+'''
+
+SYNTHETIC_ARGS = {
+    # optional arguments
+    'n_galaxies': ['n', dict(default=1, type=int, help='Number of galaxies.')],
+    'size': ['l', dict(default=500, type=int, help='Size of the stamps in pixels.')],
+    'work_dir': ['w', dict(default='.', help='Working directory.')],
+    'tile': ['t', dict(default='SPLUS-synthetic', help='Name of the S-PLUS tile.')],
+    'ra': ['', dict(default=150.0, type=float, help='Right ascension of the first galaxy in degrees.')],
+    'dec': ['', dict(default=-5.0, type=float, help='Declination of the galaxies in degrees.')],
+    'prefix': ['p', dict(default='SYN', help='Prefix of the galaxies names.')],
+    'author': ['a', dict(default='MAR', choices=['MAR', 'JYPE'], help='Header conventions of the stamps.')],
+    'no_magzp': ['', dict(action='store_true', default=False, help='Do not write MAGZP to the stamps headers. The zero points of --tile in the zero-points table are used (the tile must be there).')],
+    'data_release': ['d', dict(default='dr4', type=str, help='S-PLUS Data Release of the zero-points table used by --no_magzp.')],
+    'seed': ['s', dict(default=None, type=int, help='Seed of the first galaxy field (the others use the next seeds).')],
+    'cubes': ['c', dict(action='store_true', default=False, help='Also build the cubes.')],
+    'masterlist': ['m', dict(default='synthetic_masterlist.csv', help='Masterlist filename (at the working directory).')],
+    'verbose': ['v', dict(action='count', default=0, help='Verbosity level.')],
+}
+
+def synthetic():
+    '''
+    Entry-point function to write synthetic stamps, cubes and masterlist.
+
+    Returns
+    -------
+    None
+    '''
+    parser = create_parser(args_dict=SYNTHETIC_ARGS, program_description=SYNTHETIC_DESC)
+    args = parser.parse_args(args=sys.argv[1:])
+
+    import csv
+    from os import makedirs
+    from os.path import join
+
+    from .synthetic import synthetic_field, synthetic_cube, SYNTHETIC_PIXSCALE
+
+    size = round(args.size/2)*2
+    zps = None
+    if args.no_magzp:
+        from .. import __dr4_zp_cat__, __dr5_zp_cat__
+        from ..zeropoints import get_zero_points_index
+
+        zp_cat = __dr5_zp_cat__ if '5' in args.data_release else __dr4_zp_cat__
+        zps = get_zero_points_index(zp_cat, verbose=args.verbose).lookup(args.tile)
+        if zps is None:
+            print_level(f'{args.tile}: not found in zero-points table')
+            sys.exit(1)
+    makedirs(args.work_dir, exist_ok=True)
+    ml_filename = join(args.work_dir, args.masterlist)
+    with open(ml_filename, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['SNAME', 'FIELD', 'RA__deg', 'DEC__deg', 'SIZE__pix'])
+        for i in range(args.n_galaxies):
+            galaxy = f'{args.prefix}{i:05d}'
+            # one stamp size apart
+            ra = round(args.ra + i*size*SYNTHETIC_PIXSCALE/3600, 6)
+            seed = None if args.seed is None else args.seed + i
+            if args.cubes:
+                argv = ['-d', args.data_release]
+                synthetic_cube(args.work_dir, galaxy, ra, args.dec, size, tile=args.tile, seed=seed, author=args.author, magzp=not args.no_magzp, scubes_argv=argv, verbose=args.verbose)
+            else:
+                field = synthetic_field(ra, args.dec, size, seed=seed, magzp=zps)
+                field.write_stamps(join(args.work_dir, galaxy), galaxy, tile=args.tile, author=args.author, magzp=not args.no_magzp)
+            print_level(f'{galaxy}: {args.tile} {ra} {args.dec} {size}x{size}', 1, args.verbose)
+            w.writerow([galaxy, args.tile, ra, args.dec, size/10])
+    print_level(f'{args.n_galaxies} synthetic galaxies written at {args.work_dir} (masterlist: {ml_filename})')
 
 #############################################################################
 #############################################################################
@@ -303,7 +491,9 @@ def ml2header_updheader(cube_filename, ml_table, force=False):
     '''
     import numpy as np
 
-    with fits.open(cube_filename, 'update') as hdul:
+    from .h5scube import open_scube
+
+    with open_scube(cube_filename, 'update') as hdul:
         hdu = hdul['PRIMARY']
 
         # SNAME CONTROL
@@ -380,11 +570,11 @@ def splots():
     -------
     None
     '''
-    from .plots import scube_plots
-
     parser = create_parser(args_dict=SPLOTS_ARGS, program_description=SPLOTS_DESC)
     args = parser.parse_args(args=sys.argv[1:])
 
+    from .plots import scube_plots
+
     splots = scube_plots(filename=args.cube, block=args.show)
 
     #######################################
@@ -543,16 +733,21 @@ SCUBE_MASK_ARGS = {
     'sky_n_iter': ['', dict(default=5, type=int, help='The number of iterations to perform for sigma clipping to remove outliers.')],
     'sky_clip_neg': ['', dict(default=False, action='store_true', help='If True, clip both negative and positive outliers. If False, only clip positive outliers.')],
     'no_interact': ['N', dict(action='store_true', default=False, help='Run automatic stars mask.')],
+    'timings': ['', dict(action='store_true', default=False, help='Record the wall and CPU time, peak memory and I/O of each stage in GALAXY_timings.jsonl (JSON lines) next to the cube.')],
+    'profile': ['', dict(default=None, nargs='+', metavar='STAGE', help='Dump a cProfile of these stages (stars_mask, isophotal_mask, final_mask, sky_mask, error_spectrum, write, plots or all) to GALAXY_STAGE.prof next to the cube. Implies --timings.')],
 }
 
 def scube_mask():
-    import matplotlib.pyplot as plt
-    
-    from .masks import masks_builder
-    from .readscube import read_scube
-
     parser = create_parser(args_dict=SCUBE_MASK_ARGS, program_description=SCUBE_MASK_DESC)
     args = parser.parse_args(args=sys.argv[1:])
 
+    import matplotlib
+    if args.no_interact:
+        # headless runs only save the figures
+        matplotlib.use('Agg')
+
+    from .masks import masks_builder
+    from .readscube import read_scube
+
     scube = read_scube(args.cube)
     masks_builder(scube, args).mask_procedure()
\ No newline at end of file
@@ -0,0 +1,325 @@
+import csv
+import hashlib
+import numpy as np
+from threading import Lock
+from os import makedirs, replace, stat, getpid
+from os.path import join, basename, expanduser
+
+from .utilities.io import print_level
+from .constants import FILTER_NAMES_FITS, FILTER_NAMES_DR4_ZP_TABLE
+
+ZP_CACHE_DIR = join('~', '.cache', 'scubes', 'zero-points')
+ZP_INDEX_VERSION = 1
+
+# zero-points table column name (without ZP_) to the FITS filter name
+_ZP_COLUMN_TO_BAND = {v: k for k, v in FILTER_NAMES_DR4_ZP_TABLE.items()}
+_ZP_COLUMN_TO_BAND.update(FILTER_NAMES_FITS)
+
+_zp_indexes = {}
+_zp_indexes_lock = Lock()
+
+def normalize_field_name(field):
+    '''
+    Normalize a S-PLUS field (tile) name, e.g. ``HYDRA_0011`` and
+    ``hydra-0011`` both become ``HYDRA-0011``.
+    '''
+    return str(field).strip().replace('_', '-').upper()
+
+def _file_signature(filename):
+    st = stat(filename)
+    return np.array([st.st_mtime_ns, st.st_size], dtype='int64')
+
+def _file_sha1(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class zero_points_index:
+    '''
+    Field-keyed index of a S-PLUS zero-points table (e.g.
+    ``iDR4_zero-points.csv`` or ``iDR5_fields_zps.csv``).
+
+    The table is parsed once into an array of normalized field names (see
+    :func:`normalize_field_name`) and a ``(n_fields, n_bands)`` array of
+    zero points. The parsed index is stored in a binary (``.npz``) sidecar
+    at `cache_dir`, which is invalidated when the modification time and size
+    of the table change and its content hash does not match anymore.
+
+    Use :func:`get_zero_points_index` to share the same index between all
+    the cubes of a process.
+
+    Parameters
+    ----------
+    filename : str
+        Zero-points table (CSV with a ``Field`` column and ``ZP_<band>``
+        columns).
+
+    cache_dir : str, optional
+        Directory of the binary sidecar. If None, the sidecar is not used.
+        Default is :data:`ZP_CACHE_DIR`.
+
+    verbose : int, optional
+        Verbosity level. Default is 0.
+
+    Attributes
+    ----------
+    fields : :class:`numpy.ndarray`
+        Normalized field names.
+
+    bands : list of str
+        FITS names of the bands (e.g. ``F378``, ``R``).
+
+    zp__fb : :class:`numpy.ndarray`
+        Zero points of each field and band.
+    '''
+    def __init__(self, filename, cache_dir=ZP_CACHE_DIR, verbose=0):
+        self.filename = filename
+        self.verbose = verbose
+        self.cache_dir = None if cache_dir is None else expanduser(cache_dir)
+        if not self._load_sidecar():
+            self._parse()
+            self._write_sidecar()
+        self._row = {f: i for i, f in enumerate(self.fields)}
+
+    @property
+    def sidecar_path(self):
+        if self.cache_dir is None:
+            return None
+        h = hashlib.sha1(str(self.filename).encode()).hexdigest()[:12]
+        return join(self.cache_dir, f'{basename(self.filename)}.{h}.npz')
+
+    def _parse(self):
+        print_level(f'Reading ZPs table: {self.filename}')
+        with open(self.filename, newline='') as f:
+            reader = csv.reader(f)
+            colnames = next(reader)
+            i_field = colnames.index('Field')
+            zp_cols = [(i, c[3:]) for i, c in enumerate(colnames) if c.startswith('ZP_')]
+            fields, zps = [], []
+            for row in reader:
+                if not row:
+                    continue
+                fields.append(normalize_field_name(row[i_field]))
+                zps.append([float(row[i]) if row[i] else np.nan for i, _ in zp_cols])
+        self.fields = np.array(fields)
+        self.bands = [_ZP_COLUMN_TO_BAND.get(c, c) for _, c in zp_cols]
+        self.zp__fb = np.array(zps, dtype='float64').reshape(len(fields), len(zp_cols))
+
+    def _load_sidecar(self):
+        path = self.sidecar_path
+        if path is None:
+            return False
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                if int(npz['version']) != ZP_INDEX_VERSION:
+                    return False
+                touched = not np.array_equal(npz['signature'], _file_signature(self.filename))
+                # touched table: only reparse if its content changed
+                if touched and (str(npz['sha1']) != _file_sha1(self.filename)):
+                    return False
+                self.fields = npz['fields']
+                self.bands = npz['bands'].tolist()
+                self.zp__fb = npz['zp__fb']
+        except (OSError, KeyError, ValueError):
+            return False
+        if touched:
+            self._write_sidecar()
+        print_level(f'{self.filename}: ZPs index read from {path}', 2, self.verbose)
+        return True
+
+    def _write_sidecar(self):
+        path = self.sidecar_path
+        if path is None:
+            return
+        try:
+            makedirs(self.cache_dir, exist_ok=True)
+            tmp = f'{path}.{getpid()}.tmp.npz'
+            np.savez(
+                tmp, version=ZP_INDEX_VERSION,
+                signature=_file_signature(self.filename), sha1=_file_sha1(self.filename),
+                fields=self.fields, bands=np.array(self.bands), zp__fb=self.zp__fb,
+            )
+            replace(tmp, path)
+        except OSError as e:
+            print_level(f'{path}: unable to write ZPs index: {e}', 1, self.verbose)
+
+    def __contains__(self, field):
+        return normalize_field_name(field) in self._row
+
+    def lookup(self, field):
+        '''
+        Zero points of a field.
+
+        Parameters
+        ----------
+        field : str
+            S-PLUS field (tile) name.
+
+        Returns
+        -------
+        dict or None
+            Zero point of each band (keyed by the FITS band names) or None
+            if the field is not in the table.
+        '''
+        i = self._row.get(normalize_field_name(field), None)
+        if i is None:
+            return None
+        return dict(zip(self.bands, self.zp__fb[i].tolist()))
+
+def get_zero_points_index(filename, cache_dir=ZP_CACHE_DIR, verbose=0):
+    '''
+    Return the :class:`zero_points_index` of `filename`, building it only
+    at the first call of the process.
+    '''
+    with _zp_indexes_lock:
+        zpi = _zp_indexes.get(filename, None)
+        if zpi is None:
+            zpi = zero_points_index(filename, cache_dir=cache_dir, verbose=verbose)
+            _zp_indexes[filename] = zpi
+    return zpi
+
+ZPCORR_GRID_SIZE = 9200  # side of the valid CCD area covered by the ZP correction grids
+SPLUS_TILE_SIZE = 11000  # side of the S-PLUS field images (X0TILE, Y0TILE frame)
+
+def zpcorr_file(data_release, band, author='mar'):
+    '''
+    ZP correction grid file of a band and the number of bins of the grid.
+
+    Parameters
+    ----------
+    data_release : str
+        S-PLUS data release (e.g. ``dr4``, ``dr5``).
+
+    band : str
+        FITS band name.
+
+    author : str, optional
+        Author of the reduction (``mar`` or ``jype``, only used by DR5).
+
+    Returns
+    -------
+    tuple
+        Path of the grid file and number of bins of the grid.
+
+    Raises
+    ------
+    ValueError
+        If there are no ZP correction grids for `data_release` or `author`.
+    '''
+    from . import __dr4_zpcorr_path__, __dr5_zpcorr__
+
+    if '4' in data_release:
+        zpcorr_dir, nbins = __dr4_zpcorr_path__, 32
+    elif '5' in data_release:
+        if author not in __dr5_zpcorr__:
+            raise ValueError(f'{data_release}: {author}: missing ZP correction grids')
+        zpcorr_dir, nbins = __dr5_zpcorr__[author], 64
+    else:
+        raise ValueError(f'{data_release}: wrong data release')
+    return join(zpcorr_dir, f'SPLUS_{band}_offsets_grid.npy'), nbins
+
+_zpcorr_splines = {}
+_zpcorr_splines_lock = Lock()
+
+def get_zpcorr_spline(data_release, band, author='mar', zpcorr_dir=None, verbose=0):
+    '''
+    Spline evaluator of the ZP correction grid of a band. The spline is
+    built only once per grid file in the process.
+
+    The spline coordinates are the position on the valid CCD area (from 0
+    to :data:`ZPCORR_GRID_SIZE`), the first one being X. See
+    :func:`zpcorr_map` for the tile coordinates.
+
+    Parameters
+    ----------
+    data_release, band, author : str
+        See :func:`zpcorr_file`.
+
+    zpcorr_dir : str, optional
+        Directory with other ZP correction grids (``SPLUS_<band>_offsets_grid.npy``)
+        to be used instead of the grids of the package.
+
+    Returns
+    -------
+    :class:`scipy.interpolate.RectBivariateSpline`
+        ZP correction spline.
+    '''
+    if zpcorr_dir is None:
+        corrfile, _ = zpcorr_file(data_release, band, author)
+    else:
+        corrfile = join(zpcorr_dir, f'SPLUS_{band}_offsets_grid.npy')
+    with _zpcorr_splines_lock:
+        spline = _zpcorr_splines.get(corrfile, None)
+        if spline is None:
+            from scipy.interpolate import RectBivariateSpline
+
+            print_level(f'Reading ZPs corr image: {corrfile}', 1, verbose)
+            grid = np.load(corrfile)
+            # a grid of nbins has nbins + 1 nodes on each axis
+            xgrid = np.linspace(0, ZPCORR_GRID_SIZE, grid.shape[0])
+            spline = RectBivariateSpline(xgrid, xgrid, grid)
+            _zpcorr_splines[corrfile] = spline
+    return spline
+
+def tile_to_zpcorr_grid(x, tile_size=SPLUS_TILE_SIZE, grid_size=ZPCORR_GRID_SIZE):
+    '''
+    Convert 0-based pixel coordinates on the S-PLUS field image (the frame
+    of ``X0TILE`` and ``Y0TILE``) to the coordinates of the ZP correction
+    grids. The grids cover only the central valid CCD area, so the field
+    image origin is shifted by half of the size difference and the
+    positions out of the valid area are clipped to its border.
+    '''
+    return np.clip(np.asarray(x, dtype='float64') - (tile_size - grid_size)/2, 0, grid_size)
+
+def zpcorr_map(spline, x0tile, y0tile, shape):
+    '''
+    Evaluate a ZP correction spline on every pixel of a stamp in a single
+    vectorized call.
+
+    Parameters
+    ----------
+    spline : :class:`scipy.interpolate.RectBivariateSpline`
+        ZP correction spline (see :func:`get_zpcorr_spline`).
+
+    x0tile, y0tile : float
+        1-based position of the stamp center on the field image (the
+        ``X0TILE`` and ``Y0TILE`` header keys).
+
+    shape : tuple of int
+        Shape ``(ny, nx)`` of the stamp.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        ZP correction map (in magnitudes) with the stamp shape.
+    '''
+    ny, nx = shape
+    x__x = tile_to_zpcorr_grid(x0tile - 1 + np.arange(nx) - nx//2)
+    y__y = tile_to_zpcorr_grid(y0tile - 1 + np.arange(ny) - ny//2)
+    # RectBivariateSpline grid evaluation: (x, y) -> (nx, ny)
+    return spline(x__x, y__y).T
+
+def zpcorr_stamp(spline, x0tile, y0tile, shape):
+    '''
+    ZP correction of a stamp: the correction at the stamp center, added to
+    the zero point of the stamp (``MAGZP``), and the per-pixel correction
+    relative to it.
+
+    Parameters
+    ----------
+    spline : :class:`scipy.interpolate.RectBivariateSpline`
+        ZP correction spline (see :func:`get_zpcorr_spline`).
+
+    x0tile, y0tile : float
+        1-based position of the stamp center on the field image.
+
+    shape : tuple of int
+        Shape ``(ny, nx)`` of the stamp.
+
+    Returns
+    -------
+    tuple
+        Central correction (float) and the per-pixel correction map
+        relative to it (:class:`numpy.ndarray`), in magnitudes.
+    '''
+    zpcorr = round(float(spline.ev(*tile_to_zpcorr_grid([x0tile - 1, y0tile - 1]))), 5)
+    return zpcorr, zpcorr_map(spline, x0tile, y0tile, shape) - zpcorr